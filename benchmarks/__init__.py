@@ -0,0 +1,69 @@
+"""
+Benchmarks for coverator.
+
+These are not shipped with the package. Run them from the root of the
+source tree, for example::
+
+    $ build/bin/python -m benchmarks.combine
+"""
+from __future__ import unicode_literals
+
+from coverator.combine import write_data_file
+
+import os
+import random
+import resource
+import sys
+import time
+
+
+def make_data_files(path, builders=20, files=500, lines=200, windows=0.25):
+    """
+    Write `builders` synthetic coverage data files to `path`, each
+    covering a random subset of `lines` lines from `files` source files.
+
+    About `windows` percent of the builders record Windows paths.
+
+    Returns the list of created data files.
+    """
+    random.seed(builders * files * lines)
+    sources = [
+        'pkg/module_%d/source_%d.py' % (i % 20, i) for i in range(files)]
+    result = []
+    for index in range(builders):
+        is_windows = index < builders * windows
+        if is_windows:
+            root = 'C:\\builder-%d\\checkout\\' % index
+        else:
+            root = '/srv/builder-%d/checkout/' % index
+        data = {}
+        for source in sources:
+            if is_windows:
+                source = source.replace('/', '\\')
+            data[root + source] = sorted(
+                random.sample(range(1, lines + 1), lines // 2))
+        name = 'coverage.data.builder-%s%d' % (
+            'win-' if is_windows else '', index)
+        write_data_file(os.path.join(path, name), {'lines': data})
+        result.append(os.path.join(path, name))
+    return result
+
+
+def timeit(function, *args, **kwargs):
+    """
+    Return the wall time in seconds taken to call `function`.
+    """
+    start = time.time()
+    function(*args, **kwargs)
+    return time.time() - start
+
+
+def peak_rss():
+    """
+    Return the peak resident set size of the process, in megabytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Reported in bytes instead of kilobytes.
+        peak = peak / 1024
+    return peak / 1024.0
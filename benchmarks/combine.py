@@ -0,0 +1,96 @@
+"""
+Compare the native combine engine with `coverage combine` subprocesses.
+
+    $ build/bin/python -m benchmarks.combine [builders] [files]
+"""
+from __future__ import unicode_literals
+
+from benchmarks import make_data_files, timeit
+from coverator.combine import PathAliases, combine_files
+from subprocess import call
+
+import glob
+import os
+import shutil
+import sys
+import tempfile
+
+
+COVERAGERC = """
+[paths]
+source =
+    pkg/
+    */pkg
+    *\\pkg
+"""
+
+
+def combine_subprocess(data_files, output, checkout):
+    """
+    The former code path: copy the files to a temporary folder and call
+    `coverage combine` for the non-Windows files, the Windows files and
+    finally to merge the two.
+    """
+    tempdir = tempfile.mkdtemp()
+    for data_file in data_files:
+        shutil.copy(data_file, tempdir)
+
+    old_path = os.getcwd()
+    os.chdir(checkout)
+    try:
+        env = os.environ.copy()
+        env['COVERAGE_FILE'] = output
+        args = ['coverage', 'combine']
+        call(args + [
+            f for f in glob.glob('%s/*' % tempdir) if 'win' not in f],
+            env=env)
+
+        env['COVERAGE_FILE'] = '%s.win' % output
+        call(args + glob.glob('%s/*win*' % tempdir), env=env)
+        with open('%s.win' % output) as stream:
+            content = stream.read().replace('\\\\', '/')
+        with open('%s.win' % output, 'w') as stream:
+            stream.write(content)
+
+        env['COVERAGE_FILE'] = output
+        call(args + ['-a', '%s.win' % output], env=env)
+    finally:
+        os.chdir(old_path)
+        shutil.rmtree(tempdir)
+
+
+def combine_native(data_files, output, checkout):
+    """
+    The in-process combine engine.
+    """
+    aliases = PathAliases(checkout)
+    aliases.add('*/pkg', 'pkg/')
+    combine_files(data_files, output, aliases)
+
+
+def main(builders=20, files=500):
+    tempdir = tempfile.mkdtemp()
+    try:
+        checkout = os.path.join(tempdir, 'checkout')
+        data_path = os.path.join(tempdir, 'data')
+        os.makedirs(checkout)
+        os.makedirs(data_path)
+        with open(os.path.join(checkout, '.coveragerc'), 'w') as stream:
+            stream.write(COVERAGERC)
+
+        data_files = make_data_files(data_path, builders, files)
+        output = os.path.join(tempdir, 'combined')
+
+        print('Combining %d data files with %d source files each.' % (
+            builders, files))
+        native = timeit(combine_native, data_files, output, checkout)
+        print('native:     %8.3fs' % (native,))
+        subprocess = timeit(combine_subprocess, data_files, output, checkout)
+        print('subprocess: %8.3fs' % (subprocess,))
+        print('speedup:    %8.1fx' % (subprocess / native,))
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,175 @@
+"""
+End to end benchmark of the uploads and of the report for a commit.
+
+The builders upload their synthetic data files concurrently to a server,
+then the report is generated from a worktree of a local git fixture, first
+without and then with the analysis cache.
+
+    $ build/bin/python -m benchmarks.pipeline [builders] [files] [uploaders]
+
+The data is generated with fixed seeds, so the results can be compared
+between versions.
+"""
+from __future__ import unicode_literals
+
+from benchmarks import make_data_files, peak_rss
+from benchmarks.combine import COVERAGERC
+from benchmarks.upload import QuietHandler, upload
+from benchmarks.xmlreport import make_sources
+from coverator.analysis import AnalysisCache
+from coverator.load import percentile
+from coverator.server import PooledHTTPServer, ReportGenerator
+from Queue import Empty, Queue
+from requests import Request
+from subprocess import check_call, check_output
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+
+REPOSITORY = 'bench/pipeline'
+
+
+class QuietGenerator(ReportGenerator):
+    def log_message(self, format, *args):
+        pass
+
+
+def make_git_fixture(path, files, lines):
+    """
+    Commit the source files for the synthetic data files to a new git
+    repository at `path`, and return the commit SHA.
+    """
+    os.makedirs(path)
+    with open(os.path.join(path, '.coveragerc'), 'w') as stream:
+        stream.write(COVERAGERC)
+    make_sources(path, files, lines)
+    check_call(['git', 'init', '-q', path])
+    check_call(['git', 'add', '.'], cwd=path)
+    check_call([
+        'git', '-c', 'user.name=benchmark', '-c', 'user.email=benchmark',
+        'commit', '-q', '-m', 'sources'], cwd=path)
+    return check_output(['git', 'rev-parse', 'HEAD'], cwd=path).strip()
+
+
+def upload_all(storage, data_files, commit, uploaders, workers):
+    """
+    Upload the `data_files` with `uploaders` concurrent clients.
+
+    Return the (total seconds, latency of each upload) tuple.
+    """
+    QuietHandler.PATH = storage
+    QuietHandler.MINIMUM_FILES = sys.maxsize
+    server = PooledHTTPServer(('localhost', 0), QuietHandler, workers)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.start()
+
+    requests = Queue()
+    for data_file in data_files:
+        with open(data_file, 'rb') as stream:
+            requests.put(Request(
+                'POST', 'http://localhost/',
+                data={
+                    'repository': REPOSITORY,
+                    'commit': commit,
+                    'build': os.path.basename(data_file).split('.')[-1],
+                    },
+                files={'file': stream},
+                ).prepare())
+    latencies = []
+    errors = []
+
+    def uploader():
+        while True:
+            try:
+                request = requests.get_nowait()
+            except Empty:
+                return
+            start = time.time()
+            status = upload(
+                server.server_address, request.body, request.headers, 0)
+            latencies.append(time.time() - start)
+            if status != 200:
+                errors.append(status)
+
+    threads = [
+        threading.Thread(target=uploader) for _ in range(uploaders)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.time() - start
+
+    server.shutdown()
+    server_thread.join()
+    server.server_close()
+    if errors:
+        raise AssertionError('Failed uploads: %r' % (errors,))
+    return duration, latencies
+
+
+def stage_seconds(metrics):
+    """
+    Return the total seconds of each report stage from `metrics`.
+    """
+    result = {}
+    for name, labels, value in metrics.toRaw()['values']:
+        if name == 'coverator_report_stage_seconds':
+            # The histogram value is the [buckets, sum, count] list.
+            result[dict(labels)['stage']] = value[1]
+    return result
+
+
+def report(storage, fixture, commit, cache):
+    """
+    Return the seconds to generate the report for `commit`, and the
+    seconds of each stage.
+    """
+    generator = QuietGenerator(analysis_cache=cache)
+    generator.github_base_url = 'file://%s' % (fixture,)
+    start = time.time()
+    generator.generateReport(storage, REPOSITORY, commit, None, None)
+    return time.time() - start, stage_seconds(generator.metrics)
+
+
+def main(builders=20, files=2000, uploaders=8, lines=100):
+    tempdir = tempfile.mkdtemp()
+    try:
+        fixture = os.path.join(tempdir, 'fixture')
+        commit = make_git_fixture(
+            os.path.join(fixture, REPOSITORY), files, lines)
+        data_path = os.path.join(tempdir, 'data')
+        os.makedirs(data_path)
+        data_files = make_data_files(data_path, builders, files, lines)
+        storage = os.path.join(tempdir, 'storage')
+        os.makedirs(storage)
+
+        print(
+            '%d builders with %d source files each, '
+            '%d concurrent uploaders.' % (builders, files, uploaders))
+        duration, latencies = upload_all(
+            storage, data_files, commit, uploaders, uploaders)
+        print('uploads:        %8.2f uploads/s' % (len(latencies) / duration,))
+        print('upload p50:     %8.3fs' % (percentile(latencies, 50),))
+        print('upload p99:     %8.3fs' % (percentile(latencies, 99),))
+        print('peak RSS:       %8.1fMB' % (peak_rss(),))
+
+        cache = AnalysisCache(os.path.join(tempdir, 'analysis.sqlite'))
+        for name in ('cold', 'cached'):
+            duration, stages = report(storage, fixture, commit, cache)
+            print('report %-8s%8.3fs (%s)' % (
+                name + ':', duration, ', '.join(
+                    '%s %.3fs' % (stage, seconds)
+                    for stage, seconds in sorted(stages.items()))))
+        print('peak RSS:       %8.1fMB' % (peak_rss(),))
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,60 @@
+"""
+Compare the heap scheduler with the former scan of all pending reports.
+
+    $ build/bin/python -m benchmarks.scheduler [pending]
+"""
+from __future__ import unicode_literals
+
+from benchmarks import timeit
+from coverator.scheduler import DebounceScheduler
+
+import random
+import sys
+
+
+def scan(jobs, reschedules):
+    """
+    The former code path: a dictionary, scanned with min() to find the
+    next report at each wakeup.
+    """
+    pending = {}
+    for key, when in jobs:
+        pending[key] = when
+    for key, when in reschedules:
+        pending[key] = when
+        min(pending.items(), key=lambda v: v[1])
+    while pending:
+        first = min(pending.items(), key=lambda v: v[1])
+        del pending[first[0]]
+
+
+def heap(jobs, reschedules):
+    """
+    The heap scheduler, with O(log n) operations.
+    """
+    scheduler = DebounceScheduler()
+    for key, when in jobs:
+        scheduler.schedule(key, when, None)
+    for key, when in reschedules:
+        scheduler.schedule(key, when, None)
+        scheduler.nextTime()
+    while scheduler:
+        scheduler.popDue(scheduler.nextTime())
+
+
+def main(pending=10000):
+    random.seed(pending)
+    jobs = [('repo:%d' % i, random.random()) for i in range(pending)]
+    reschedules = [
+        ('repo:%d' % random.randrange(pending), 1 + random.random())
+        for _ in range(1000)]
+
+    print(
+        '%d pending reports, 1000 reschedules, then all reports started.' % (
+            pending,))
+    print('heap: %8.3fs' % (timeit(heap, jobs, reschedules),))
+    print('scan: %8.3fs' % (timeit(scan, jobs, reschedules),))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,115 @@
+"""
+Load test for the upload path, with parallel uploaders.
+
+One of the uploaders sends its data file in small chunks, with a delay
+between them, to simulate a remote builder on a slow connection. The
+other uploaders send their files as fast as possible.
+
+    $ build/bin/python -m benchmarks.upload [uploaders] [uploads] [delay]
+"""
+from __future__ import unicode_literals
+
+from benchmarks import make_data_files
+from coverator.server import CoveratorHandler, PooledHTTPServer
+from httplib import HTTPConnection
+from requests import Request
+
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+
+class QuietHandler(CoveratorHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def upload(address, body, headers, delay, chunk_size=4 * 1024):
+    """
+    Upload `body`, sending a chunk every `delay` seconds.
+    """
+    connection = HTTPConnection(*address)
+    connection.putrequest('POST', '/')
+    for name, value in headers.items():
+        connection.putheader(name, value)
+    connection.endheaders()
+    for start in range(0, len(body), chunk_size):
+        connection.send(body[start:start + chunk_size])
+        if delay:
+            time.sleep(delay)
+    response = connection.getresponse()
+    response.read()
+    connection.close()
+    return response.status
+
+
+def run(workers, uploaders, uploads, delay, data_path):
+    """
+    Return the number of uploads per second done by the fast uploaders,
+    when a server with `workers` threads also receives a slow upload.
+    """
+    storage = tempfile.mkdtemp()
+    QuietHandler.PATH = storage
+    QuietHandler.MINIMUM_FILES = sys.maxsize
+    server = PooledHTTPServer(('localhost', 0), QuietHandler, workers)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.start()
+
+    def uploader(index, count, delay):
+        for upload_index in range(count):
+            request = Request(
+                'POST', 'http://localhost/',
+                data={
+                    'repository': 'bench/upload',
+                    'commit': 'commit-%d' % (upload_index,),
+                    'build': 'builder-%d' % (index,),
+                    },
+                files={'file': open(data_path, 'rb')},
+                ).prepare()
+            upload(server.server_address, request.body,
+                   request.headers, delay)
+
+    slow = threading.Thread(target=uploader, args=(0, 1, delay))
+    slow.start()
+    # Let the slow upload start first.
+    time.sleep(0.1)
+
+    threads = [
+        threading.Thread(target=uploader, args=(index, uploads, 0))
+        for index in range(1, uploaders)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.time() - start
+
+    slow.join()
+    server.shutdown()
+    server_thread.join()
+    server.server_close()
+    shutil.rmtree(storage)
+    return len(threads) * uploads / duration
+
+
+def main(uploaders=8, uploads=10, delay=0.1):
+    tempdir = tempfile.mkdtemp()
+    try:
+        data_path = make_data_files(tempdir, builders=1, files=200)[0]
+        print(
+            '%d uploaders, %d uploads each, '
+            'one slow uploader with %.3fs between chunks.' % (
+                uploaders, uploads, delay))
+        for workers in (1, uploaders):
+            print('%3d workers: %8.2f uploads/s' % (
+                workers,
+                run(workers, uploaders, uploads, delay, data_path)))
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main(*[
+        float(arg) if '.' in arg else int(arg) for arg in sys.argv[1:]])
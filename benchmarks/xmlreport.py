@@ -0,0 +1,101 @@
+"""
+Compare the native XML report, with and without the analysis cache, with
+`coverage xml` subprocesses.
+
+    $ build/bin/python -m benchmarks.xmlreport [files] [lines]
+"""
+from __future__ import unicode_literals
+
+from benchmarks import make_data_files, timeit
+from benchmarks.combine import COVERAGERC
+from coverator.combine import (
+    CoverageCombiner,
+    PathAliases,
+    read_coverage_config,
+    )
+from coverator.analysis import AnalysisCache
+from coverator.xmlreport import write_xml_report
+from subprocess import call, check_call
+
+import os
+import shutil
+import sys
+import tempfile
+
+
+def make_sources(checkout, files, lines):
+    """
+    Write the source files for the synthetic data files to `checkout`.
+    """
+    for index in range(files):
+        path = os.path.join(
+            checkout, 'pkg', 'module_%d' % (index % 20,),
+            'source_%d.py' % (index,))
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as stream:
+            for line in range(lines):
+                stream.write('value_%d = %d\n' % (line, line))
+
+
+def xml_subprocess(combiner, output, checkout):
+    """
+    The former code path: write the combined data file and call
+    `coverage xml` from the checkout.
+    """
+    data_path = output + '.data'
+    combiner.write(data_path)
+    env = os.environ.copy()
+    env['COVERAGE_FILE'] = data_path
+    call(['coverage', 'xml', '-o', output], env=env, cwd=checkout)
+
+
+def xml_native(combiner, output, checkout, cache=None):
+    """
+    The in-process XML report.
+    """
+    write_xml_report(
+        combiner, output, checkout, read_coverage_config(checkout), cache)
+
+
+def main(files=500, lines=200):
+    tempdir = tempfile.mkdtemp()
+    try:
+        checkout = os.path.join(tempdir, 'checkout')
+        data_path = os.path.join(tempdir, 'data')
+        os.makedirs(checkout)
+        os.makedirs(data_path)
+        with open(os.path.join(checkout, '.coveragerc'), 'w') as stream:
+            stream.write(COVERAGERC)
+        make_sources(checkout, files, lines)
+        check_call(['git', 'init', '-q', checkout])
+        check_call(['git', 'add', '.'], cwd=checkout)
+        check_call([
+            'git', '-c', 'user.name=benchmark', '-c', 'user.email=benchmark',
+            'commit', '-q', '-m', 'sources'], cwd=checkout)
+
+        aliases = PathAliases.fromConfig(
+            read_coverage_config(checkout), checkout)
+        combiner = CoverageCombiner(aliases)
+        for data_file in make_data_files(data_path, 4, files, lines):
+            combiner.updateFromFile(data_file)
+        output = os.path.join(tempdir, 'coverage.xml')
+
+        print('Reporting %d source files with %d lines each.' % (
+            files, lines))
+        native = timeit(xml_native, combiner, output, checkout)
+        print('native:     %8.3fs' % (native,))
+        cache = AnalysisCache(os.path.join(tempdir, 'analysis.sqlite'))
+        xml_native(combiner, output, checkout, cache)
+        cached = timeit(xml_native, combiner, output, checkout, cache)
+        print('cached:     %8.3fs' % (cached,))
+        subprocess = timeit(xml_subprocess, combiner, output, checkout)
+        print('subprocess: %8.3fs' % (subprocess,))
+        print('speedup:    %8.1fx native, %.1fx cached' % (
+            subprocess / native, subprocess / cached))
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
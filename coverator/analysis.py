@@ -0,0 +1,351 @@
+"""
+Analysis of the source files, and its persistent cache.
+
+The statements and branches of the source files are found with the parser
+from coverage.py. Most source files are not changed between consecutive
+commits, so the analysis is kept in a SQLite database from the storage
+path, keyed by the git blob SHA of the file.
+"""
+from __future__ import unicode_literals
+
+from coverage import __version__ as COVERAGE_VERSION
+from coverage.misc import CoverageException, join_regex
+from coverage.parser import PythonParser
+from coverator.tracing import FILE, SUBPROCESS, span
+from git import Git
+from git.exc import GitCommandError
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+
+# Number of keys used in a single SQL query.
+QUERY_SIZE = 500
+
+# The tokenizer from coverage.py caches the last parsed file in a global,
+# so files can not be parsed at the same time by the report threads.
+_PARSER_LOCK = threading.Lock()
+
+
+def git_blobs(root):
+    """
+    Return the git blob SHA for each file from the commit checked out at
+    `root`, by absolute path.
+    """
+    with span('git ls-tree', SUBPROCESS):
+        output = Git(root).ls_tree('-r', '-z', 'HEAD')
+    blobs = {}
+    for entry in output.split('\0'):
+        if not entry:
+            continue
+        info, name = entry.split('\t', 1)
+        mode, kind, sha = info.split(' ')
+        if kind == 'blob':
+            blobs[os.path.join(root, name)] = sha
+    return blobs
+
+
+class SourceAnalysis(object):
+    """
+    The statements and branches of a Python source file, as found by
+    coverage.py.
+    """
+
+    def __init__(
+            self, statements, multiline, arcs, exit_counts, no_branch,
+            excluded=()):
+        self.statements = statements
+        self.excluded = excluded
+        # Maps the lines of a multi-line statement to its first line.
+        self.multiline = multiline
+        self.arcs = arcs
+        # The number of exits for the lines with more than one exit.
+        self.exit_counts = exit_counts
+        self.no_branch = no_branch
+
+    @classmethod
+    def fromFile(cls, path, config, has_arcs=False):
+        """
+        Analyze the source file at `path`, using the exclusion rules from
+        the coverage.py `config`.
+
+        The arcs are only computed when `has_arcs` is True.
+        """
+        with _PARSER_LOCK:
+            parser = PythonParser(
+                filename=path, exclude=join_regex(config.exclude_list))
+            parser.parse_source()
+            arcs = set()
+            exit_counts = {}
+            no_branch = set()
+            if has_arcs:
+                arcs = parser.arcs()
+                exit_counts = dict(
+                    (line, count)
+                    for line, count in parser.exit_counts().items()
+                    if count > 1)
+                no_branch = parser.lines_matching(
+                    join_regex(config.partial_list),
+                    join_regex(config.partial_always_list))
+        return cls(
+            parser.statements, parser._multiline, arcs, exit_counts,
+            no_branch, parser.excluded)
+
+    @classmethod
+    def fromRaw(cls, data):
+        """
+        Return the analysis from the dictionary created by toRaw.
+        """
+        return cls(
+            statements=set(data['statements']),
+            multiline=dict(data['multiline']),
+            arcs=set(tuple(arc) for arc in data['arcs']),
+            exit_counts=dict(data['exit_counts']),
+            no_branch=set(data['no_branch']),
+            excluded=set(data['excluded']),
+            )
+
+    def toRaw(self):
+        """
+        Return the analysis as a dictionary which can be serialized as
+        JSON.
+        """
+        return {
+            'statements': sorted(self.statements),
+            'multiline': sorted(self.multiline.items()),
+            'arcs': sorted(self.arcs),
+            'exit_counts': sorted(self.exit_counts.items()),
+            'no_branch': sorted(self.no_branch),
+            'excluded': sorted(self.excluded),
+            }
+
+    def firstLine(self, line):
+        """
+        Return the first line of the statement including `line`.
+        """
+        return self.multiline.get(line, line)
+
+    def lines(self, executed_lines, executed_arcs=None):
+        """
+        Return the (line, hits, branch) tuples for the statements, sorted
+        by line.
+
+        `branch` is None for lines which are not branches, otherwise the
+        (total exits, taken exits, missing exits) tuple.
+        """
+        executed = set(self.firstLine(line) for line in executed_lines)
+        branches = {}
+        if executed_arcs is not None:
+            executed_arcs = set(
+                (self.firstLine(start), self.firstLine(end))
+                for start, end in executed_arcs)
+            for line, total in self.exit_counts.items():
+                missing = sorted(
+                    end for start, end in self.arcs
+                    if start == line and
+                    (start, end) not in executed_arcs and
+                    start not in self.no_branch)
+                branches[line] = (total, total - len(missing), missing)
+
+        return [
+            (line, int(line in executed), branches.get(line))
+            for line in sorted(self.statements)]
+
+
+class SourceAnalyzer(object):
+    """
+    Analyzes the source files checked out at `root`, using the exclusion
+    rules from the coverage.py `config`.
+
+    When `cache` is an AnalysisCache, the files are only analyzed when
+    their git blob is not already in the cache.
+    """
+
+    def __init__(self, root, config, cache=None):
+        self.root = root
+        self.config = config
+        self.cache = cache
+        self._git_blobs = None
+
+    def analyze(self, paths, has_arcs):
+        """
+        Return the SourceAnalysis for the files from `paths`, by path.
+
+        Files which are not found or which are not Python are not in the
+        result.
+        """
+        result = {}
+        keys = {}
+        if self.cache is not None:
+            blobs = self._blobs()
+            for path in paths:
+                if path in blobs:
+                    keys[path] = self.cache.key(
+                        blobs[path], self.config, has_arcs)
+            cached = self.cache.load(keys.values())
+            for path, key in keys.items():
+                if key in cached:
+                    result[path] = cached[key]
+
+        analyzed = {}
+        for path in paths:
+            if path in result:
+                continue
+            try:
+                with span(path, FILE, step='analyze'):
+                    result[path] = SourceAnalysis.fromFile(
+                        path, self.config, has_arcs)
+            except (CoverageException, EnvironmentError, SyntaxError):
+                # Missing source file or not Python.
+                continue
+            if path in keys:
+                analyzed[keys[path]] = result[path]
+
+        if self.cache is not None:
+            self.cache.store(analyzed)
+        return result
+
+    def _blobs(self):
+        """
+        Return the git blob SHA of the files from the checkout.
+        """
+        if self._git_blobs is None:
+            try:
+                self._git_blobs = git_blobs(self.root)
+            except GitCommandError:
+                # Not a git checkout.
+                self._git_blobs = {}
+        return self._git_blobs
+
+
+class AnalysisCache(object):
+    """
+    SourceAnalysis results by git blob SHA, keeping at most `size`
+    entries.
+
+    The least recently used entries are removed when there are more than
+    `size`. `hits` and `misses` count the lookups since the cache was
+    created.
+
+    As for JobStore, a new connection is used for each operation.
+    """
+
+    def __init__(self, path, size=100000):
+        self.path = path
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        connection = self._connect()
+        try:
+            connection.execute('PRAGMA journal_mode=WAL')
+            with connection:
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS analysis ('
+                    ' key TEXT PRIMARY KEY,'
+                    ' data BLOB NOT NULL,'
+                    ' used REAL NOT NULL'
+                    ')')
+                connection.execute(
+                    'CREATE INDEX IF NOT EXISTS analysis_used'
+                    ' ON analysis (used)')
+        finally:
+            connection.close()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    @staticmethod
+    def key(blob, config, has_arcs):
+        """
+        Return the cache key for the file with the `blob` SHA.
+
+        The result of the analysis also depends on the exclusion rules from
+        the coverage.py `config` and on the version of coverage.py.
+        """
+        rules = json.dumps([
+            COVERAGE_VERSION,
+            has_arcs,
+            config.exclude_list,
+            config.partial_list,
+            config.partial_always_list,
+            ])
+        return '%s:%s' % (
+            blob, hashlib.sha1(rules.encode('utf-8')).hexdigest())
+
+    def load(self, keys):
+        """
+        Return the cached SourceAnalysis for `keys`, by key.
+
+        The keys which are not in the cache are not in the result.
+        """
+        keys = list(keys)
+        result = {}
+        connection = self._connect()
+        try:
+            with connection:
+                for index in range(0, len(keys), QUERY_SIZE):
+                    chunk = keys[index:index + QUERY_SIZE]
+                    marks = ', '.join('?' * len(chunk))
+                    for key, data in connection.execute(
+                            'SELECT key, data FROM analysis'
+                            ' WHERE key IN (%s)' % (marks,), chunk):
+                        result[key] = SourceAnalysis.fromRaw(json.loads(
+                            zlib.decompress(data).decode('utf-8')))
+                    connection.execute(
+                        'UPDATE analysis SET used = ?'
+                        ' WHERE key IN (%s)' % (marks,),
+                        [time.time()] + chunk)
+        finally:
+            connection.close()
+
+        with self._lock:
+            self.hits += len(result)
+            self.misses += len(keys) - len(result)
+        return result
+
+    def store(self, analyses):
+        """
+        Add the SourceAnalysis from the `analyses` dictionary, by key, and
+        remove the least recently used entries over the cache size.
+        """
+        if not analyses:
+            return
+        now = time.time()
+        connection = self._connect()
+        try:
+            with connection:
+                connection.executemany(
+                    'INSERT OR REPLACE INTO analysis VALUES (?, ?, ?)',
+                    [(key, sqlite3.Binary(zlib.compress(
+                        json.dumps(analysis.toRaw()).encode('utf-8'))), now)
+                     for key, analysis in analyses.items()])
+                count, = connection.execute(
+                    'SELECT COUNT(*) FROM analysis').fetchone()
+                if count > self.size:
+                    connection.execute(
+                        'DELETE FROM analysis WHERE key IN ('
+                        ' SELECT key FROM analysis ORDER BY used LIMIT ?)',
+                        (count - self.size,))
+        finally:
+            connection.close()
+
+    def __len__(self):
+        connection = self._connect()
+        try:
+            count, = connection.execute(
+                'SELECT COUNT(*) FROM analysis').fetchone()
+            return count
+        finally:
+            connection.close()
@@ -0,0 +1,155 @@
+"""
+JSON API for the repositories, branches, PRs and commits.
+
+The responses are read from the MetadataIndex instead of listing the
+storage directories, and they are cached until the index is changed by an
+upload or by a report.
+
+    /api/repos
+    /api/repos/<repository>/branches
+    /api/repos/<repository>/prs
+    /api/repos/<repository>/commits[?branch=<name>|pr=<id>]
+
+The lists are paginated with the `page` and `per_page` query arguments.
+"""
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+
+import json
+import threading
+import urllib
+import urlparse
+
+
+DEFAULT_PER_PAGE = 30
+MAXIMUM_PER_PAGE = 100
+
+API_PREFIX = '/api/'
+
+# The kind of references from the index listed by a resource.
+REFERENCE_RESOURCES = {'branches': 'branch', 'prs': 'pr'}
+
+
+class ApiError(Exception):
+    """
+    The request can not be answered, with the HTTP status `code`.
+    """
+
+    def __init__(self, code, message):
+        super(ApiError, self).__init__(message)
+        self.code = code
+        self.message = message
+
+
+def _page(query):
+    """
+    Return the (page, per page) pagination arguments from `query`.
+    """
+    try:
+        page = int(query.get('page', 1))
+        per_page = int(query.get('per_page', DEFAULT_PER_PAGE))
+    except ValueError:
+        raise ApiError(400, 'Invalid pagination arguments.')
+    if page < 1 or per_page < 1:
+        raise ApiError(400, 'Invalid pagination arguments.')
+    return page, min(per_page, MAXIMUM_PER_PAGE)
+
+
+class JsonApi(object):
+    """
+    Answers the API requests from the `index`, keeping the last
+    `cache_size` responses until the index is changed.
+    """
+
+    def __init__(self, index, cache_size=1000):
+        self.index = index
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        # Maps the request path to the (revision, response) tuple.
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def handle(self, path):
+        """
+        Return the (HTTP status, JSON body) for the request `path`.
+        """
+        revision = self.index.revision()
+        with self._lock:
+            cached = self._cache.pop(path, None)
+            if cached is not None and cached[0] == revision:
+                self.hits += 1
+                self._cache[path] = cached
+                return cached[1]
+            self.misses += 1
+
+        try:
+            data = self._route(path)
+            response = (200, json.dumps(data, sort_keys=True))
+        except ApiError as error:
+            response = (
+                error.code, json.dumps({'message': error.message}))
+
+        with self._lock:
+            self._cache[path] = (revision, response)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return response
+
+    def _route(self, path):
+        """
+        Return the data for the request `path`.
+        """
+        url = urlparse.urlparse(path)
+        query = dict(urlparse.parse_qsl(url.query))
+        words = [urllib.unquote(word)
+                 for word in url.path[len(API_PREFIX):].split('/') if word]
+        if words == ['repos']:
+            return self._paginate(query, [
+                {'name': name} for name in self.index.repositories()])
+
+        if len(words) < 3 or words[0] != 'repos':
+            raise ApiError(404, 'Not found.')
+        repository = '/'.join(words[1:-1])
+        resource = words[-1]
+        if resource in REFERENCE_RESOURCES:
+            kind = REFERENCE_RESOURCES[resource]
+            return self._paginate(query, [
+                {'name': name, 'head': head, 'updated': added}
+                for name, head, added in self.index.heads(repository, kind)])
+        if resource == 'commits':
+            return self._commits(repository, query)
+        raise ApiError(404, 'Not found.')
+
+    def _paginate(self, query, items):
+        """
+        Return the page of `items` requested by `query`.
+        """
+        page, per_page = _page(query)
+        start = (page - 1) * per_page
+        return {
+            'items': items[start:start + per_page],
+            'page': page,
+            'per_page': per_page,
+            'total': len(items),
+            }
+
+    def _commits(self, repository, query):
+        """
+        Return the page of commits for `repository`, for the branch or PR
+        from `query`.
+        """
+        page, per_page = _page(query)
+        kind = name = None
+        for key in ('branch', 'pr'):
+            if key in query:
+                kind, name = key, query[key]
+        return {
+            'items': self.index.summaries(
+                repository, kind, name,
+                limit=per_page, offset=(page - 1) * per_page),
+            'page': page,
+            'per_page': per_page,
+            'total': self.index.countCommits(repository, kind, name),
+            }
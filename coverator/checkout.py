@@ -0,0 +1,108 @@
+"""
+Checkouts of the reported commits.
+
+Each repository has a bare mirror, updated with incremental fetches, and
+a worktree for each reported commit. The worktrees are kept in a LRU cache
+so that reports for recently seen commits skip the checkout.
+"""
+from __future__ import unicode_literals
+
+from coverator.tracing import SUBPROCESS, span
+from git import Repo
+from git.exc import GitCommandError
+
+import os
+import shutil
+
+
+class WorktreeCache(object):
+    """
+    Manages the git mirror and the worktrees for the repositories stored
+    by coverator.
+
+    `size` is the maximum number of worktrees kept for a repository.
+    """
+    MIRROR = 'git-mirror'
+    WORKTREES = 'worktrees'
+
+    def __init__(self, size=10, log=None):
+        self.size = size
+        self._log = log or (lambda format, *args: None)
+
+    def mirrorPath(self, repository_path):
+        """
+        Return the path of the bare mirror for the repository stored at
+        `repository_path`.
+        """
+        return os.path.join(repository_path, self.MIRROR)
+
+    def worktreePath(self, repository_path, commit):
+        """
+        Return the path of the worktree for `commit`.
+        """
+        return os.path.join(repository_path, self.WORKTREES, commit)
+
+    def _getMirror(self, url, repository_path):
+        """
+        Return the bare mirror, cloning it from `url` the first time.
+        """
+        mirror_path = self.mirrorPath(repository_path)
+        if os.path.exists(mirror_path):
+            return Repo(mirror_path)
+
+        self._log('Cloning git mirror for %s to %s', url, mirror_path)
+        with span('git clone', SUBPROCESS):
+            return Repo.clone_from(url, mirror_path, mirror=True)
+
+    def checkout(self, url, repository_path, commit):
+        """
+        Return the path of a worktree with `commit` checked out.
+
+        The mirror is only fetched when the worktree is not already
+        in the cache.
+        """
+        worktree_path = self.worktreePath(repository_path, commit)
+        if os.path.exists(os.path.join(worktree_path, '.git')):
+            self._log('Using cached worktree %s', worktree_path)
+            # Mark it as recently used.
+            os.utime(worktree_path, None)
+            return worktree_path
+
+        mirror = self._getMirror(url, repository_path)
+        self._log('Fetching changes for %s', url)
+        with span('git fetch', SUBPROCESS):
+            mirror.git.fetch('--prune', 'origin')
+
+        if os.path.exists(worktree_path):
+            # Left behind by an interrupted checkout.
+            shutil.rmtree(worktree_path)
+            mirror.git.worktree('prune')
+
+        self._log('Adding worktree for %s at %s', commit, worktree_path)
+        with span('git worktree add', SUBPROCESS):
+            mirror.git.worktree('add', '--detach', worktree_path, commit)
+
+        self.evict(repository_path)
+        return worktree_path
+
+    def evict(self, repository_path):
+        """
+        Remove the least recently used worktrees, over the cache size.
+        """
+        worktrees_path = os.path.join(repository_path, self.WORKTREES)
+        worktrees = [
+            os.path.join(worktrees_path, name)
+            for name in os.listdir(worktrees_path)]
+        worktrees.sort(key=os.path.getmtime, reverse=True)
+        evicted = worktrees[self.size:]
+        if not evicted:
+            return
+
+        for worktree_path in evicted:
+            self._log('Removing worktree %s', worktree_path)
+            shutil.rmtree(worktree_path)
+
+        try:
+            Repo(self.mirrorPath(repository_path)).git.worktree('prune')
+        except GitCommandError as error:
+            self._log('Failed to prune worktrees: %s', error)
@@ -1,49 +1,199 @@
 from __future__ import unicode_literals
 
+from coverator.combine import BUILD_PART_SEPARATOR, compress_file
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+
 import requests
 import argparse
+import glob
+import os
 import sys
+import time
 
 
 DEFAULT_URL = 'http://coverage.chevah.com:8080'
 
+# Errors after which an upload is retried, together with the 5xx responses.
+# Uploading again is safe, as a data file replaces the previous data file
+# from the same builder.
+RETRIED_ERRORS = (requests.ConnectionError, requests.Timeout)
+
+
+def _post(filepath, data, url, timeout, compress, session):
+    """
+    Send the data file, returning the HTTP status of the response.
+    """
+    if compress:
+        stream = compress_file(filepath)
+        files = {'file': (
+            os.path.basename(filepath),
+            stream,
+            'application/octet-stream',
+            {'Content-Encoding': 'gzip'},
+            )}
+    else:
+        stream = open(filepath, 'rb')
+        files = {'file': stream}
+    try:
+        return (session or requests).post(
+            url, data=data, files=files, timeout=timeout).status_code
+    finally:
+        stream.close()
+
 
 def upload_coverage(
         filepath, repository=None, build=None, commit=None,
-        branch=None, pr=None, url=DEFAULT_URL, timeout=30):
+        branch=None, pr=None, url=DEFAULT_URL, timeout=30, compress=True,
+        session=None, verbose=True, retries=0, backoff=1, parts=None):
     """
     Sends a POST request uploading a coverage data file to a coverator server.
+
+    When `compress` is True, the file is sent gzip compressed.
+    The request is sent with the requests `session`, when given.
+
+    `parts` is the number of data files uploaded by the builder, when
+    known, so that the server removes the parts left by an earlier upload.
+
+    After a connection error, a timeout or a 5xx response, the upload is
+    retried up to `retries` times, waiting `backoff` seconds and then
+    twice as long after each attempt.
+    """
+    if verbose:
+        print(
+            'Uploading coverage data file with the following configuration:')
+        print('FILE: %s' % filepath)
+        print('REPOSITORY: %s' % repository)
+        print('BUILDER: %s' % build)
+        print('COMMIT: %s' % commit)
+        print('BRANCH: %s' % branch)
+        print('GITHUB_PR: %s' % pr)
+        print('URL: %s' % url)
+        print('TIMEOUT: %s' % timeout)
+        print('COMPRESS: %s' % compress)
+
+    data = dict(
+        repository=repository, pr=pr, commit=commit, build=build,
+        branch=branch, parts=parts)
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        try:
+            status = _post(filepath, data, url, timeout, compress, session)
+        except RETRIED_ERRORS as error:
+            if attempt == retries:
+                raise
+            if verbose:
+                print('Failed to upload: %s. Retrying.' % (error,))
+            continue
+        if status < 500 or attempt == retries:
+            break
+        if verbose:
+            print('Failed to upload, response code was %d. Retrying.' % (
+                status,))
+
+    if status != 200:
+        if verbose:
+            print('Failed to upload, response code was %d.' % (status,))
+        return status
+    if verbose:
+        print('Done.')
+    return 0
+
+
+def upload_files(
+        patterns, repository=None, build=None, commit=None,
+        branch=None, pr=None, url=DEFAULT_URL, timeout=30, compress=True,
+        retries=3, backoff=1, workers=4):
+    """
+    Upload the coverage data files matching the glob `patterns`,
+    concurrently over `workers` connections of a requests session.
+
+    When there are multiple files, each one is uploaded as a part of the
+    `build`, with the BUILD_PART_SEPARATOR and its number appended to the
+    builder name. The number of files is sent with each upload.
+
+    Returns 0 when all the files were uploaded, or the result of the first
+    failed upload.
     """
-    files = {'file': open(filepath)}
-    print('Uploading coverage data file with the following configuration:')
-    print('FILE: %s' % filepath)
-    print('REPOSITORY: %s' % repository)
-    print('BUILDER: %s' % build)
-    print('COMMIT: %s' % commit)
-    print('BRANCH: %s' % branch)
-    print('GITHUB_PR: %s' % pr)
-    print('URL: %s' % url)
-    print('TIMEOUT: %s' % timeout)
-
-    response = requests.post(
-        url,
-        data=dict(
-            repository=repository, pr=pr, commit=commit,
-            build=build, branch=branch),
-        files=files,
-        timeout=timeout)
-    if response.status_code != 200:
-        print('Failed to upload, response code was %d.' % response.status_code)
-        return response.status_code
-    print('Done.')
+    paths = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            if path not in paths:
+                paths.append(path)
+    if not paths:
+        print('No coverage data file matching: %s' % (', '.join(patterns),))
+        return 1
+
+    verbose = len(paths) == 1
+    if verbose:
+        builds = [build]
+    else:
+        builds = [
+            '%s%s%d' % (build or 'no-buildslave', BUILD_PART_SEPARATOR, part)
+            for part in range(1, len(paths) + 1)]
+        print('Uploading %d coverage data files with the following '
+              'configuration:' % (len(paths),))
+        print('REPOSITORY: %s' % repository)
+        print('BUILDER: %s' % build)
+        print('COMMIT: %s' % commit)
+        print('BRANCH: %s' % branch)
+        print('GITHUB_PR: %s' % pr)
+        print('URL: %s' % url)
+        print('TIMEOUT: %s' % timeout)
+        print('COMPRESS: %s' % compress)
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    def upload(job):
+        path, part_build = job
+        try:
+            result = upload_coverage(
+                path, repository, part_build, commit, branch, pr, url,
+                timeout, compress, session=session, verbose=verbose,
+                retries=retries, backoff=backoff, parts=len(paths))
+        except requests.RequestException as error:
+            print('Failed to upload %s: %s' % (path, error))
+            return 1
+        if not verbose:
+            if result:
+                print('Failed to upload %s, response code was %d.' % (
+                    path, result))
+            else:
+                print('Uploaded %s as %s.' % (path, part_build))
+        return result
+
+    pool = ThreadPool(min(workers, len(paths)))
+    try:
+        results = pool.map(upload, zip(paths, builds))
+    finally:
+        pool.close()
+        pool.join()
+        session.close()
+
+    failed = [result for result in results if result]
+    if not verbose:
+        print('Uploaded %d of %d coverage data files.' % (
+            len(paths) - len(failed), len(paths)))
+    if failed:
+        return failed[0]
     return 0
 
 
 def main():
+    if sys.argv[1:2] == ['load']:
+        # Imported here, as the load generator uses upload_coverage.
+        from coverator import load
+        return load.main(sys.argv[2:])
+
     parser = argparse.ArgumentParser(
         prog='coverator-publish', add_help=True,
         formatter_class=argparse.RawDescriptionHelpFormatter,
-        epilog="Upload reports to a coverator server")
+        epilog="Upload reports to a coverator server, "
+               "or generate load with 'coverator-publish load URL'")
 
     parser.add_argument(
         'url',
@@ -51,8 +201,9 @@ def main():
         help='URL to upload to')
     parser.add_argument(
         '--file',
-        default=None,
-        help='Coverage.py data file')
+        action='append',
+        default=[],
+        help='Coverage.py data file or glob, can be used multiple times')
     parser.add_argument(
         '--repository',
         default=None,
@@ -73,12 +224,29 @@ def main():
         '--branch',
         default=None,
         help='Specify a custom branch name')
+    parser.add_argument(
+        '--no-compress',
+        dest='compress',
+        action='store_false',
+        default=True,
+        help='Upload the data file without compressing it')
+    parser.add_argument(
+        '--retries',
+        type=int,
+        default=3,
+        help='Number of retries after a connection error or a 5xx response')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=4,
+        help='Number of data files uploaded concurrently')
 
     args = parser.parse_args(sys.argv[1:])
 
-    return upload_coverage(
+    return upload_files(
         args.file, args.repository, args.build,
-        args.commit, args.branch, args.pr, args.url)
+        args.commit, args.branch, args.pr, args.url,
+        compress=args.compress, retries=args.retries, workers=args.workers)
 
 
 if __name__ == '__main__':
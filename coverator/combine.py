@@ -0,0 +1,429 @@
+"""
+Native combination of coverage.py data files.
+
+This replaces calling `coverage combine` in a subprocess. The data files
+uploaded by the builders are read directly and the executed lines (and arcs)
+are merged, per source file, in a single pass.
+"""
+from __future__ import unicode_literals
+
+from coverage.config import CoverageConfig
+
+import fnmatch
+import gzip
+import json
+import ntpath
+import os
+import posixpath
+import re
+import shutil
+import tempfile
+import zlib
+
+
+# The name of the file storing the running combination of the data files.
+COVERAGE_STATE_FILE = 'coverage.state'
+
+# Separates the builder name from the part number, when a builder uploads
+# multiple data files. The parts are counted by the server as one builder.
+BUILD_PART_SEPARATOR = '+'
+
+# The first bytes of a gzip file.
+GZIP_MAGIC = b'\x1f\x8b'
+
+# The header written by coverage.py 4.x at the start of a JSON data file.
+COVERAGE_DATA_HEADER = (
+    "!coverage.py: This is a private format, don't read it directly!")
+
+
+class CoverageDataError(Exception):
+    """
+    Raised when a coverage data file can not be read.
+    """
+
+
+def normalize_path(path):
+    """
+    Return `path` using forward slashes.
+
+    Data files generated on Windows use backslashes as the path separator.
+    """
+    return path.replace('\\', '/')
+
+
+def is_compressed(path):
+    """
+    Return True if the file at `path` is gzip compressed.
+    """
+    with open(path, 'rb') as stream:
+        return stream.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+
+
+class _LimitedReader(object):
+    """
+    Reads the data file at `path` from `stream`, failing once more than
+    `limit` bytes were read.
+    """
+
+    def __init__(self, stream, limit, path):
+        self._stream = stream
+        self._limit = limit
+        self._remaining = limit
+        self._path = path
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            while True:
+                chunk = self.read(64 * 1024)
+                if not chunk:
+                    return b''.join(chunks)
+                chunks.append(chunk)
+
+        # Read one more byte than allowed, to detect the larger files
+        # without reading them entirely.
+        data = self._stream.read(min(size, self._remaining + 1))
+        self._remaining -= len(data)
+        if self._remaining < 0:
+            raise CoverageDataError(
+                'Data file larger than %d bytes: %s' % (
+                    self._limit, self._path))
+        return data
+
+
+def read_data_file(path, max_size=None):
+    """
+    Return the raw dictionary stored in the coverage.py data file at `path`.
+
+    The file can be gzip compressed. When `max_size` is given, files with
+    more than `max_size` bytes once decompressed are not read.
+    """
+    if is_compressed(path):
+        opener = gzip.open
+    else:
+        opener = open
+
+    with opener(path, 'rb') as stream:
+        if max_size is not None:
+            stream = _LimitedReader(stream, max_size, path)
+        try:
+            header = stream.read(len(COVERAGE_DATA_HEADER))
+            if header != COVERAGE_DATA_HEADER.encode('ascii'):
+                raise CoverageDataError(
+                    'Not a coverage.py data file: %s' % (path,))
+            return json.load(stream)
+        except (ValueError, IOError, EOFError, zlib.error) as error:
+            # A corrupted compressed file fails when decompressed.
+            raise CoverageDataError(
+                'Invalid coverage.py data file %s: %s' % (path, error))
+
+
+def write_data_file(path, data):
+    """
+    Write the raw dictionary `data` as a coverage.py data file at `path`.
+    """
+    with open(path, 'wb') as stream:
+        stream.write(COVERAGE_DATA_HEADER.encode('ascii'))
+        stream.write(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+
+
+def compress_file(filepath):
+    """
+    Return a temporary file with the gzip compressed content of `filepath`.
+    """
+    compressed = tempfile.TemporaryFile()
+    with open(filepath, 'rb') as source:
+        with gzip.GzipFile(fileobj=compressed, mode='wb') as target:
+            shutil.copyfileobj(source, target)
+    compressed.seek(0)
+    return compressed
+
+
+def read_coverage_config(root):
+    """
+    Return the coverage.py configuration from the `.coveragerc` file found
+    at `root`.
+    """
+    config = CoverageConfig()
+    config.from_file(os.path.join(root, '.coveragerc'), our_file=True)
+    return config
+
+
+def _isabs_anywhere(path):
+    """
+    Is `path` an absolute path on any OS?
+    """
+    return ntpath.isabs(path) or posixpath.isabs(path)
+
+
+class PathAliases(object):
+    """
+    Maps the source paths recorded on the builders to the paths from
+    the git checkout, as configured by the `[paths]` section of coverage.py.
+
+    This follows the rules of coverage.files.PathAliases, but relative
+    paths are resolved against `root` instead of the current directory.
+    """
+
+    def __init__(self, root=None):
+        self.root = root
+        self.aliases = []
+
+    @classmethod
+    def fromConfig(cls, config, root):
+        """
+        Create the aliases from a coverage.py `config`.
+        """
+        aliases = cls(root)
+        for paths in config.paths.values():
+            result = paths[0]
+            for pattern in paths[1:]:
+                aliases.add(pattern, result)
+        return aliases
+
+    def _absolute(self, path):
+        """
+        Return `path` resolved against the root.
+        """
+        if self.root is None or _isabs_anywhere(path):
+            return path
+        return posixpath.join(normalize_path(self.root), path)
+
+    def add(self, pattern, result):
+        """
+        Map the paths starting with the fnmatch-style `pattern` to `result`.
+        """
+        pattern = normalize_path(pattern)
+        if len(pattern) > 1:
+            pattern = pattern.rstrip('/')
+
+        if pattern.endswith('*'):
+            raise CoverageDataError(
+                'Pattern must not end with wildcards: %s' % (pattern,))
+
+        if not pattern.startswith('*'):
+            pattern = self._absolute(pattern)
+        if not pattern.endswith('/'):
+            pattern += '/'
+
+        # fnmatch always matches the whole string, while we only want
+        # to match the start of the path.
+        regex = re.sub(r'\\Z(\(|$)', r'\1', fnmatch.translate(pattern))
+        result = normalize_path(result).rstrip('/') + '/'
+        self.aliases.append((re.compile('(?i)' + regex), result))
+
+    def map(self, path):
+        """
+        Return `path` mapped through the first matching alias.
+        """
+        path = normalize_path(path)
+        for regex, result in self.aliases:
+            match = regex.match(path)
+            if match:
+                return self._absolute(result + path[match.end():])
+        return path
+
+
+class CoverageCombiner(object):
+    """
+    Union of the lines and arcs executed by a set of coverage data files.
+    """
+
+    def __init__(self, aliases=None):
+        self.aliases = aliases
+        self.lines = {}
+        self.arcs = {}
+
+    def _filename(self, filename):
+        if self.aliases is None:
+            return normalize_path(filename)
+        return self.aliases.map(filename)
+
+    def update(self, data):
+        """
+        Add the raw `data` read from a coverage data file.
+        """
+        for filename, lines in (data.get('lines') or {}).items():
+            self.lines.setdefault(
+                self._filename(filename), set()).update(lines)
+
+        for filename, arcs in (data.get('arcs') or {}).items():
+            self.arcs.setdefault(
+                self._filename(filename), set()).update(
+                    tuple(arc) for arc in arcs)
+
+    def updateFromFile(self, path):
+        """
+        Add the data from the coverage data file at `path`.
+        """
+        self.update(read_data_file(path))
+
+    def hasArcs(self):
+        """
+        Return True if the combined data has arcs.
+
+        coverage.py can not mix line and arc data, so when some builders
+        only measured lines, the arcs are reduced to the lines they cover.
+        """
+        return bool(self.arcs) and not self.lines
+
+    def executedLines(self, filename):
+        """
+        Return the set of lines executed for `filename`.
+        """
+        lines = set(self.lines.get(filename, ()))
+        for start, end in self.arcs.get(filename, ()):
+            for line in (start, end):
+                if line > 0:
+                    lines.add(line)
+        return lines
+
+    def measuredFiles(self):
+        """
+        Return the sorted names of all files with coverage data.
+        """
+        return sorted(set(self.lines) | set(self.arcs))
+
+    def toRaw(self):
+        """
+        Return the combined data in the coverage.py data file format.
+        """
+        if self.hasArcs():
+            return {'arcs': dict(
+                (filename, sorted(list(arc) for arc in arcs))
+                for filename, arcs in self.arcs.items())}
+
+        return {'lines': dict(
+            (filename, sorted(self.executedLines(filename)))
+            for filename in self.measuredFiles())}
+
+    def write(self, path):
+        """
+        Write the combined data as a coverage.py data file at `path`.
+        """
+        write_data_file(path, self.toRaw())
+
+
+class CoverageCounter(object):
+    """
+    Running combination of the data files uploaded for a commit.
+
+    For each line and arc we keep the number of data files which executed
+    it, so that the contribution of a builder can be removed when it
+    uploads a new data file.
+
+    Paths are only normalized, as the path aliases are only known when
+    the git repository is checked out for the report.
+    """
+
+    def __init__(self, lines=None, arcs=None):
+        self.lines = lines or {}
+        self.arcs = arcs or {}
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load the counters saved at `path`.
+
+        Return empty counters when there is no such file.
+        """
+        if not os.path.exists(path):
+            return cls()
+        with open(path, 'rb') as stream:
+            data = json.loads(stream.read().decode('utf-8'))
+
+        lines = {}
+        for filename, groups in data.get('lines', {}).items():
+            counters = lines[filename] = {}
+            for count, values in groups.items():
+                counters.update(dict.fromkeys(values, int(count)))
+
+        arcs = {}
+        for filename, groups in data.get('arcs', {}).items():
+            counters = arcs[filename] = {}
+            for count, values in groups.items():
+                counters.update(dict.fromkeys(map(tuple, values), int(count)))
+
+        return cls(lines, arcs)
+
+    def save(self, path):
+        """
+        Save the counters to `path`, replacing any previous file.
+
+        Lines and arcs are grouped by their counter, as most of them are
+        executed by all builders.
+        """
+        data = {}
+        for name, items in (('lines', self.lines), ('arcs', self.arcs)):
+            data[name] = {}
+            for filename, counters in items.items():
+                groups = data[name][filename] = {}
+                for value, count in counters.items():
+                    groups.setdefault(count, []).append(value)
+
+        temporary_path = '%s.tmp' % (path,)
+        with open(temporary_path, 'wb') as stream:
+            stream.write(json.dumps(
+                data, separators=(',', ':')).encode('utf-8'))
+        os.rename(temporary_path, path)
+
+    def _apply(self, counters, items, delta):
+        """
+        Add `delta` to the counters of the `items` of each file.
+        """
+        for filename, values in (items or {}).items():
+            filename = normalize_path(filename)
+            file_counters = counters.setdefault(filename, {})
+            for value in values:
+                if isinstance(value, list):
+                    value = tuple(value)
+                count = file_counters.get(value, 0) + delta
+                if count > 0:
+                    file_counters[value] = count
+                else:
+                    file_counters.pop(value, None)
+            if not file_counters:
+                del counters[filename]
+
+    def add(self, data):
+        """
+        Add the raw `data` read from a coverage data file.
+        """
+        self._apply(self.lines, data.get('lines'), 1)
+        self._apply(self.arcs, data.get('arcs'), 1)
+
+    def remove(self, data):
+        """
+        Remove the raw `data` which was previously added.
+        """
+        self._apply(self.lines, data.get('lines'), -1)
+        self._apply(self.arcs, data.get('arcs'), -1)
+
+    def toRaw(self):
+        """
+        Return the executed lines and arcs in the coverage.py data file
+        format.
+        """
+        data = {}
+        if self.lines:
+            data['lines'] = dict(
+                (filename, list(lines))
+                for filename, lines in self.lines.items())
+        if self.arcs:
+            data['arcs'] = dict(
+                (filename, [list(arc) for arc in arcs])
+                for filename, arcs in self.arcs.items())
+        return data
+
+
+def combine_files(paths, output, aliases=None):
+    """
+    Combine the coverage data files from `paths` into `output`.
+
+    The source data files are left in place.
+    """
+    combiner = CoverageCombiner(aliases)
+    for path in paths:
+        combiner.updateFromFile(path)
+    combiner.write(output)
+    return combiner
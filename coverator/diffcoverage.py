@@ -0,0 +1,220 @@
+"""
+Coverage of the lines changed by a commit.
+
+This replaces calling `diff-cover` in a subprocess, which had to run
+`git diff` and parse the XML report again for each report. The changed
+lines are parsed from the diff between the merge base and the commit, and
+are cached as the diff only depends on these two commits. The coverage of
+the changed lines comes from the data combined for the XML report.
+
+The HTML report and the percentage are generated with diff-cover, so they
+are the same as the ones from the `diff-cover` command.
+"""
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from diff_cover.report_generator import HtmlReportGenerator
+from diff_cover.snippets import Snippet
+from diff_cover.violationsreporters.base import Violation
+from coverator.tracing import SUBPROCESS, span
+from git import Git
+
+import io
+import os
+import re
+import threading
+
+
+# Regular expressions used by diff-cover to parse the diff output.
+SOURCE_FILE_RE = re.compile(r'^diff --git "?a/.*"? "?b/([^ \n"]*)"?')
+HUNK_START_RE = re.compile(r'\+([0-9]*)')
+
+
+def parse_diff(diff):
+    """
+    Return the lines added or modified by the `diff` output from git,
+    sorted, by path.
+
+    This follows the parser from diff-cover.
+    """
+    result = {}
+    added = None
+    line_number = None
+    for line in diff.split('\n'):
+        if line.startswith('diff --git'):
+            path = SOURCE_FILE_RE.findall(line)[0]
+            added = result.setdefault(path, set())
+            line_number = None
+        elif added is None:
+            continue
+        elif line.startswith('@@'):
+            line_number = int(HUNK_START_RE.findall(line.split('@@')[1])[0])
+        elif line_number is None or line.startswith('-'):
+            # Headers before the first hunk and deleted lines.
+            continue
+        elif line.startswith('+'):
+            added.add(line_number)
+            line_number += 1
+        else:
+            line_number += 1
+    return dict((path, sorted(lines)) for path, lines in result.items())
+
+
+class ChangedLinesCache(object):
+    """
+    The lines changed by a commit from its merge base with the compare
+    branch, for the last `size` diffs.
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._diffs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def changedLines(self, root, commit, compare_branch='master'):
+        """
+        Return the lines changed by `commit` from the git repository at
+        `root`, by path.
+        """
+        # Repo() can not open the worktrees with GitPython 1.0.
+        git = Git(root)
+        with span('git merge-base', SUBPROCESS):
+            merge_base = git.merge_base(compare_branch, commit).strip()
+        key = (merge_base, commit)
+        with self._lock:
+            changed = self._diffs.pop(key, None)
+            if changed is not None:
+                self.hits += 1
+                self._diffs[key] = changed
+                return changed
+            self.misses += 1
+
+        # The prefixes are set as diff.mnemonicprefix would change them.
+        with span('git diff', SUBPROCESS):
+            diff = git.diff(
+                merge_base, commit, '--no-color', '--no-ext-diff',
+                '--src-prefix=a/', '--dst-prefix=b/')
+        changed = parse_diff(diff)
+        with self._lock:
+            self._diffs[key] = changed
+            while len(self._diffs) > self.size:
+                self._diffs.popitem(last=False)
+        return changed
+
+
+class _ChangedLines(object):
+    """
+    The diff reporter used by the diff-cover report generator.
+    """
+
+    def __init__(self, name, changed):
+        self._name = name
+        self._changed = changed
+
+    def name(self):
+        return self._name
+
+    def src_paths_changed(self):
+        return sorted(self._changed, key=lambda path: path.lower())
+
+    def lines_changed(self, src_path):
+        return self._changed.get(src_path, [])
+
+
+class _LineCoverage(object):
+    """
+    The violations reporter used by the diff-cover report generator, with
+    the lines from the XML report.
+    """
+
+    def __init__(self, lines):
+        # Maps a path to the (violations, measured lines) tuple.
+        self._lines = lines
+
+    def name(self):
+        return 'XML'
+
+    def violations(self, src_path):
+        return self._lines.get(src_path, (set(), set()))[0]
+
+    def measured_lines(self, src_path):
+        return self._lines.get(src_path, (set(), set()))[1]
+
+
+class DiffCoverageReport(HtmlReportGenerator):
+    """
+    The diff-cover HTML report, reading the source files from `root`
+    instead of the current directory.
+    """
+
+    def __init__(self, root, violations_reporter, diff_reporter):
+        super(DiffCoverageReport, self).__init__(
+            violations_reporter, diff_reporter)
+        self.root = root
+
+    def _loadSnippets(self, src_path, violation_lines):
+        """
+        Return the HTML for the source snippets with `violation_lines`.
+        """
+        with io.open(
+                os.path.join(self.root, src_path), 'rb') as stream:
+            contents = stream.read().decode('utf-8', 'replace')
+        ranges = Snippet._snippet_ranges(
+            len(contents.split('\n')), violation_lines)
+        groups = Snippet._group_tokens(
+            Snippet._parse_src(contents, src_path), ranges)
+        return [
+            Snippet(tokens, src_path, start, violation_lines).html()
+            for (start, _), tokens in sorted(groups.items())]
+
+    def _src_path_stats(self, src_path):
+        violation_lines = self.violation_lines(src_path)
+        try:
+            snippets = self._loadSnippets(src_path, violation_lines)
+        except IOError:
+            snippets = []
+        return {
+            'percent_covered': self.percent_covered(src_path),
+            'violation_lines': self.combine_adjacent_lines(violation_lines),
+            'violations': sorted(
+                self._diff_violations()[src_path].violations),
+            'snippets_html': snippets,
+            }
+
+
+def diff_coverage(
+        xml_report, combiner, changed, output=None, compare_branch='master'):
+    """
+    Return the percentage of the `changed` lines which are covered, as
+    reported by diff-cover.
+
+    `xml_report` is the XmlReport used for the data from `combiner`, which
+    should keep the lines of the changed files, so that they are not
+    analyzed again.
+    When `output` is given, the diff-cover HTML report is written to this
+    path.
+    """
+    lines = {}
+    for path in changed:
+        file_lines = xml_report.fileLines(
+            combiner, os.path.join(xml_report.root, path))
+        if file_lines is None:
+            continue
+        lines[path] = (
+            set(Violation(line, None)
+                for line, hits, _ in file_lines if not hits),
+            set(line for line, _, _ in file_lines),
+            )
+
+    report = DiffCoverageReport(
+        xml_report.root,
+        _LineCoverage(lines),
+        _ChangedLines('%s...HEAD' % (compare_branch,), changed))
+    if output is not None:
+        temporary_path = output + '.tmp'
+        with open(temporary_path, 'wb') as stream:
+            report.generate_report(stream)
+        os.rename(temporary_path, output)
+    return report.total_percent_covered()
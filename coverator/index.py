@@ -0,0 +1,387 @@
+"""
+Index of the metadata for the uploaded data files.
+
+The commits, the builders which uploaded data files, the branches and PRs
+of the commits and the status of the reports are kept in a SQLite database
+from the storage path. It is updated in a single transaction for each
+upload, and it is queried without scanning the storage directories.
+"""
+from __future__ import unicode_literals
+
+import os
+import sqlite3
+import time
+
+
+# Status of the report for a commit.
+REPORT_QUEUED = 'queued'
+REPORT_RUNNING = 'running'
+REPORT_DONE = 'done'
+REPORT_FAILED = 'failed'
+REPORT_CANCELLED = 'cancelled'
+
+# The kinds of references for a commit.
+REFERENCE_KINDS = ('branch', 'pr')
+
+
+# The columns from the commits table returned for a commit.
+COMMIT_COLUMNS = (
+    'commit_sha',
+    'created',
+    'updated',
+    'report_status',
+    'report_updated',
+    'coverage_total',
+    'coverage_diff',
+    )
+
+
+def _commit_row(row):
+    """
+    Return the dictionary for a `row` with the COMMIT_COLUMNS.
+    """
+    result = dict(zip(COMMIT_COLUMNS, row))
+    result['commit'] = result.pop('commit_sha')
+    return result
+
+
+class MetadataIndex(object):
+    """
+    Metadata of the commits, by repository.
+
+    A commit is part of a branch or of a PR when an upload for the commit
+    was made with the branch or PR name. The head of a branch or PR is the
+    commit with the last upload made for it, as for the report generator,
+    so a commit pushed again to a branch is its head again.
+
+    As for JobStore, a new connection is used for each operation, so the
+    index can be used from the request threads and from the report
+    generator process.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        connection = self._connect()
+        try:
+            connection.execute('PRAGMA journal_mode=WAL')
+            with connection:
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS commits ('
+                    ' repository TEXT NOT NULL,'
+                    ' commit_sha TEXT NOT NULL,'
+                    ' created REAL NOT NULL,'
+                    ' updated REAL NOT NULL,'
+                    ' report_status TEXT,'
+                    ' report_updated REAL,'
+                    ' coverage_total REAL,'
+                    ' coverage_diff REAL,'
+                    ' PRIMARY KEY (repository, commit_sha)'
+                    ')')
+                connection.execute(
+                    'CREATE INDEX IF NOT EXISTS commits_updated'
+                    ' ON commits (repository, updated)')
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS uploads ('
+                    ' repository TEXT NOT NULL,'
+                    ' commit_sha TEXT NOT NULL,'
+                    ' builder TEXT NOT NULL,'
+                    ' uploaded REAL NOT NULL,'
+                    ' size INTEGER,'
+                    ' PRIMARY KEY (repository, commit_sha, builder)'
+                    ')')
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS refs ('
+                    ' repository TEXT NOT NULL,'
+                    ' kind TEXT NOT NULL,'
+                    ' name TEXT NOT NULL,'
+                    ' commit_sha TEXT NOT NULL,'
+                    ' added REAL NOT NULL,'
+                    ' PRIMARY KEY (repository, kind, name, commit_sha)'
+                    ')')
+                connection.execute(
+                    'CREATE INDEX IF NOT EXISTS refs_added'
+                    ' ON refs (repository, kind, name, added)')
+                connection.execute(
+                    'CREATE INDEX IF NOT EXISTS refs_commit'
+                    ' ON refs (repository, commit_sha)')
+                # The revision is increased by each change, so the data read
+                # from the index can be cached until the next change.
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS state ('
+                    ' name TEXT PRIMARY KEY,'
+                    ' value INTEGER NOT NULL'
+                    ')')
+                connection.execute(
+                    "INSERT OR IGNORE INTO state VALUES ('revision', 0)")
+        finally:
+            connection.close()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def _changed(self, connection):
+        """
+        Increase the revision, as part of the current transaction.
+        """
+        connection.execute(
+            "UPDATE state SET value = value + 1 WHERE name = 'revision'")
+
+    def revision(self):
+        """
+        Return the number increased by each change of the index.
+        """
+        connection = self._connect()
+        try:
+            value, = connection.execute(
+                "SELECT value FROM state WHERE name = 'revision'").fetchone()
+            return value
+        finally:
+            connection.close()
+
+    def recordUpload(
+            self, repository, commit, builder, branch=None, pr=None,
+            size=None, tstamp=None, report_status=None, removed=()):
+        """
+        Record the upload of a data file by `builder` for `commit`, made
+        for the `branch` and `pr`.
+
+        When the upload requests a report, its `report_status` is set in the
+        same transaction. The uploads of the `removed` builders are
+        forgotten.
+        """
+        if tstamp is None:
+            tstamp = time.time()
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute(
+                    'INSERT OR IGNORE INTO commits'
+                    ' (repository, commit_sha, created, updated)'
+                    ' VALUES (?, ?, ?, ?)',
+                    (repository, commit, tstamp, tstamp))
+                connection.execute(
+                    'UPDATE commits SET updated = ?'
+                    ' WHERE repository = ? AND commit_sha = ?',
+                    (tstamp, repository, commit))
+                connection.execute(
+                    'INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?)',
+                    (repository, commit, builder, tstamp, size))
+                connection.executemany(
+                    'DELETE FROM uploads'
+                    ' WHERE repository = ? AND commit_sha = ? AND builder = ?',
+                    [(repository, commit, name) for name in removed])
+                if report_status is not None:
+                    connection.execute(
+                        'UPDATE commits'
+                        ' SET report_status = ?, report_updated = ?'
+                        ' WHERE repository = ? AND commit_sha = ?',
+                        (report_status, tstamp, repository, commit))
+                for kind, name in zip(REFERENCE_KINDS, (branch, pr)):
+                    if name is None:
+                        continue
+                    connection.execute(
+                        'INSERT OR REPLACE INTO refs VALUES (?, ?, ?, ?, ?)',
+                        (repository, kind, name, commit, tstamp))
+                self._changed(connection)
+        finally:
+            connection.close()
+
+    def setReportStatus(self, repository, commit, status, tstamp=None):
+        """
+        Set the status of the report for `commit`.
+        """
+        if tstamp is None:
+            tstamp = time.time()
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute(
+                    'UPDATE commits SET report_status = ?, report_updated = ?'
+                    ' WHERE repository = ? AND commit_sha = ?',
+                    (status, tstamp, repository, commit))
+                self._changed(connection)
+        finally:
+            connection.close()
+
+    def setCoverage(self, repository, commit, total, diff=None):
+        """
+        Set the percentage of covered lines for `commit`, and of the
+        lines changed by `commit`.
+        """
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute(
+                    'UPDATE commits SET coverage_total = ?, coverage_diff = ?'
+                    ' WHERE repository = ? AND commit_sha = ?',
+                    (total, diff, repository, commit))
+                self._changed(connection)
+        finally:
+            connection.close()
+
+    def getCommit(self, repository, commit):
+        """
+        Return the metadata for `commit` as a dictionary, or None if
+        nothing was uploaded for it.
+        """
+        connection = self._connect()
+        try:
+            row = connection.execute(
+                'SELECT %s FROM commits'
+                ' WHERE repository = ? AND commit_sha = ?' % (
+                    ', '.join(COMMIT_COLUMNS),),
+                (repository, commit)).fetchone()
+            if row is None:
+                return None
+            result = _commit_row(row)
+            result.update({
+                'builders': {},
+                'branch': [],
+                'pr': [],
+                })
+            for builder, uploaded in connection.execute(
+                    'SELECT builder, uploaded FROM uploads'
+                    ' WHERE repository = ? AND commit_sha = ?'
+                    ' ORDER BY builder', (repository, commit)):
+                result['builders'][builder] = uploaded
+            for kind, name in connection.execute(
+                    'SELECT kind, name FROM refs'
+                    ' WHERE repository = ? AND commit_sha = ?'
+                    ' ORDER BY added', (repository, commit)):
+                result[kind].append(name)
+            return result
+        finally:
+            connection.close()
+
+    def commits(self, repository, kind=None, name=None):
+        """
+        Return the commits of `repository`, the last updated first.
+
+        When `kind` and `name` are given, only the commits of this branch or
+        PR are returned, the last added first.
+        """
+        connection = self._connect()
+        try:
+            if kind is None:
+                rows = connection.execute(
+                    'SELECT commit_sha FROM commits WHERE repository = ?'
+                    ' ORDER BY updated DESC', (repository,))
+            else:
+                rows = connection.execute(
+                    'SELECT commit_sha FROM refs'
+                    ' WHERE repository = ? AND kind = ? AND name = ?'
+                    ' ORDER BY added DESC', (repository, kind, name))
+            return [commit for commit, in rows]
+        finally:
+            connection.close()
+
+    def summaries(
+            self, repository, kind=None, name=None, limit=None, offset=0):
+        """
+        Return the metadata of the commits returned by `commits`, as
+        dictionaries, for at most `limit` commits after the first `offset`
+        ones.
+        """
+        columns = ', '.join('commits.%s' % (column,)
+                            for column in COMMIT_COLUMNS)
+        if limit is None:
+            limit = -1
+        connection = self._connect()
+        try:
+            if kind is None:
+                rows = connection.execute(
+                    'SELECT %s FROM commits WHERE repository = ?'
+                    ' ORDER BY updated DESC LIMIT ? OFFSET ?' % (columns,),
+                    (repository, limit, offset))
+            else:
+                rows = connection.execute(
+                    'SELECT %s FROM refs JOIN commits'
+                    ' ON commits.repository = refs.repository'
+                    ' AND commits.commit_sha = refs.commit_sha'
+                    ' WHERE refs.repository = ? AND kind = ? AND name = ?'
+                    ' ORDER BY added DESC LIMIT ? OFFSET ?' % (columns,),
+                    (repository, kind, name, limit, offset))
+            return [_commit_row(row) for row in rows]
+        finally:
+            connection.close()
+
+    def countCommits(self, repository, kind=None, name=None):
+        """
+        Return the number of commits returned by `commits`.
+        """
+        connection = self._connect()
+        try:
+            if kind is None:
+                row = connection.execute(
+                    'SELECT COUNT(*) FROM commits WHERE repository = ?',
+                    (repository,)).fetchone()
+            else:
+                row = connection.execute(
+                    'SELECT COUNT(*) FROM refs'
+                    ' WHERE repository = ? AND kind = ? AND name = ?',
+                    (repository, kind, name)).fetchone()
+            return row[0]
+        finally:
+            connection.close()
+
+    def heads(self, repository, kind):
+        """
+        Return the (name, head commit, time added) tuples for the branches
+        or PRs of `repository`, sorted by name.
+        """
+        connection = self._connect()
+        try:
+            # The other columns are taken from the row with the maximum.
+            return [tuple(row) for row in connection.execute(
+                'SELECT name, commit_sha, MAX(added) FROM refs'
+                ' WHERE repository = ? AND kind = ?'
+                ' GROUP BY name ORDER BY name', (repository, kind))]
+        finally:
+            connection.close()
+
+    def head(self, repository, kind, name):
+        """
+        Return the commit with the last upload for the branch or PR, or
+        None.
+        """
+        connection = self._connect()
+        try:
+            row = connection.execute(
+                'SELECT commit_sha FROM refs'
+                ' WHERE repository = ? AND kind = ? AND name = ?'
+                ' ORDER BY added DESC LIMIT 1',
+                (repository, kind, name)).fetchone()
+            return row[0] if row is not None else None
+        finally:
+            connection.close()
+
+    def names(self, repository, kind):
+        """
+        Return the names of the branches or PRs of `repository`, sorted.
+        """
+        connection = self._connect()
+        try:
+            return [name for name, in connection.execute(
+                'SELECT DISTINCT name FROM refs'
+                ' WHERE repository = ? AND kind = ? ORDER BY name',
+                (repository, kind))]
+        finally:
+            connection.close()
+
+    def repositories(self):
+        """
+        Return the names of the repositories, sorted.
+        """
+        connection = self._connect()
+        try:
+            return [name for name, in connection.execute(
+                'SELECT DISTINCT repository FROM commits'
+                ' ORDER BY repository')]
+        finally:
+            connection.close()
@@ -0,0 +1,100 @@
+"""
+Persistent store for the pending report jobs.
+
+The jobs are kept in a SQLite database from the storage path, so that the
+reports waiting to be generated are not lost when the server is restarted.
+"""
+from __future__ import unicode_literals
+
+import os
+import sqlite3
+
+
+class JobStore(object):
+    """
+    Pending report jobs, deduplicated by repository and commit.
+
+    A job is the tuple (base_path, repository, commit, branch, pr, tstamp)
+    sent on the ReportGenerator queue.
+
+    A new connection is used for each operation, so the store can be
+    used from multiple threads and processes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        connection = self._connect()
+        try:
+            # WAL allows reading the jobs while an upload adds a new one.
+            connection.execute('PRAGMA journal_mode=WAL')
+            with connection:
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS jobs ('
+                    ' key TEXT PRIMARY KEY,'
+                    ' base_path TEXT NOT NULL,'
+                    ' repository TEXT NOT NULL,'
+                    ' commit_sha TEXT NOT NULL,'
+                    ' branch TEXT,'
+                    ' pr TEXT,'
+                    ' tstamp REAL NOT NULL'
+                    ')')
+        finally:
+            connection.close()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        # With WAL, a commit is durable after a crash of the process.
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    @staticmethod
+    def key(repository, commit):
+        """
+        Return the key used to deduplicate the jobs.
+        """
+        return '%s:%s' % (repository, commit)
+
+    def add(self, job):
+        """
+        Add `job`, replacing the pending job for the same commit.
+        """
+        base_path, repository, commit, branch, pr, tstamp = job
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute(
+                    'INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (self.key(repository, commit),
+                     base_path, repository, commit, branch, pr, tstamp))
+        finally:
+            connection.close()
+
+    def remove(self, repository, commit, tstamp):
+        """
+        Remove the job for `commit`, unless it was added again after
+        `tstamp`.
+        """
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute(
+                    'DELETE FROM jobs WHERE key = ? AND tstamp <= ?',
+                    (self.key(repository, commit), tstamp))
+        finally:
+            connection.close()
+
+    def pending(self):
+        """
+        Return the pending jobs, the oldest first.
+        """
+        connection = self._connect()
+        try:
+            return [tuple(row) for row in connection.execute(
+                'SELECT base_path, repository, commit_sha, branch, pr, tstamp'
+                ' FROM jobs ORDER BY tstamp')]
+        finally:
+            connection.close()
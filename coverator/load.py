@@ -0,0 +1,266 @@
+"""
+Load generator for a coverator server.
+
+The data files of a matrix of builders are uploaded for a number of
+commits, by concurrent clients and at a target rate, and the histogram of
+the upload latencies is printed. The data files are replayed from disk, or
+synthesized with a given size.
+
+    $ coverator-publish load http://localhost:8080 --concurrency 16 --rate 20
+
+With a target rate, the latency of an upload is measured from the time it
+was scheduled, so that the uploads waiting for a free client are not hidden
+by a slow server.
+"""
+from __future__ import unicode_literals
+
+from coverator.client import DEFAULT_URL, upload_coverage
+from coverator.combine import write_data_file
+from coverator.metrics import LATENCY_BUCKETS
+from Queue import Empty, Queue
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import requests
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+
+DEFAULT_REPOSITORY = 'load/test'
+
+# The result of a successful upload.
+UPLOAD_OK = 0
+
+
+def make_payload(path, size):
+    """
+    Write a synthetic coverage data file of about `size` bytes to `path`.
+    """
+    lines = list(range(1, 201))
+    lines_size = len(json.dumps(lines, separators=(',', ':')))
+    data = {}
+    total = 0
+    while total < size:
+        source = '/srv/load/checkout/pkg/module_%d/source_%d.py' % (
+            len(data) % 20, len(data))
+        data[source] = lines
+        total += len(source) + lines_size + 4
+    write_data_file(path, {'lines': data})
+
+
+def percentile(values, percent):
+    """
+    Return the `percent` percentile of `values`, by the nearest rank.
+    """
+    values = sorted(values)
+    if not values:
+        return 0
+    rank = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def run_load(
+        url, payloads, builders=6, commits=10, concurrency=8, rate=0,
+        repository=DEFAULT_REPOSITORY, timeout=30, compress=True):
+    """
+    Upload one of the `payloads` data files from each of the `builders`
+    for each of the `commits`, with `concurrency` clients, starting
+    `rate` uploads per second or as fast as possible when `rate` is 0.
+
+    Return the list of (latency, result) tuples, where the result is
+    UPLOAD_OK, the HTTP status of a failed upload or the name of the
+    error.
+    """
+    run_id = uuid.uuid4().hex
+    jobs = Queue()
+    for commit_index in range(commits):
+        commit = hashlib.sha1(
+            ('%s-%d' % (run_id, commit_index)).encode('ascii')).hexdigest()
+        for builder_index in range(builders):
+            index = commit_index * builders + builder_index
+            jobs.put((
+                index, commit, 'builder-%d' % (builder_index,),
+                payloads[index % len(payloads)]))
+
+    results = []
+    start = time.time()
+
+    def client():
+        session = requests.Session()
+        while True:
+            try:
+                index, commit, build, payload = jobs.get_nowait()
+            except Empty:
+                break
+            scheduled = time.time()
+            if rate:
+                scheduled = start + index / float(rate)
+                delay = scheduled - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            try:
+                result = upload_coverage(
+                    payload, repository, build, commit, url=url,
+                    timeout=timeout, compress=compress, session=session,
+                    verbose=False)
+            except requests.RequestException as error:
+                result = type(error).__name__
+            results.append((time.time() - scheduled, result))
+        session.close()
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def format_histogram(latencies, width=40):
+    """
+    Return the lines of the histogram for `latencies`, with the
+    LATENCY_BUCKETS.
+    """
+    bounds = LATENCY_BUCKETS + (float('inf'),)
+    counts = [0] * len(bounds)
+    for latency in latencies:
+        for index, bound in enumerate(bounds):
+            if latency <= bound:
+                counts[index] += 1
+                break
+    used = [index for index, count in enumerate(counts) if count]
+    if not used:
+        return []
+
+    lines = []
+    for index in range(used[0], used[-1] + 1):
+        if bounds[index] == float('inf'):
+            label = '> %gs' % (bounds[index - 1],)
+        else:
+            label = '<= %gs' % (bounds[index],)
+        bar = '#' * int(round(width * counts[index] / float(max(counts))))
+        lines.append(('%10s %6d %s' % (label, counts[index], bar)).rstrip())
+    return lines
+
+
+def format_report(results, duration):
+    """
+    Return the lines describing the `results` of a load run which took
+    `duration` seconds.
+    """
+    latencies = [latency for latency, _ in results]
+    failures = {}
+    for _, result in results:
+        if result != UPLOAD_OK:
+            failures[result] = failures.get(result, 0) + 1
+
+    lines = [
+        'Uploads: %d, failed: %d, in %.2fs, %.2f uploads/s.' % (
+            len(results), sum(failures.values()), duration,
+            len(results) / float(duration) if duration else 0),
+        ]
+    for result, count in sorted(failures.items()):
+        lines.append('  %s: %d' % (result, count))
+    if latencies:
+        lines.append(
+            'Latency p50: %.3fs, p90: %.3fs, p99: %.3fs, max: %.3fs' % (
+                percentile(latencies, 50), percentile(latencies, 90),
+                percentile(latencies, 99), max(latencies)))
+    lines.extend(format_histogram(latencies))
+    return lines
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog='coverator-publish load', add_help=True,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="Generate upload load for a coverator server")
+
+    parser.add_argument(
+        'url',
+        default=DEFAULT_URL,
+        help='URL to upload to')
+    parser.add_argument(
+        '--file',
+        action='append',
+        default=[],
+        help='Coverage.py data file to replay, can be used multiple times')
+    parser.add_argument(
+        '--payload-size',
+        type=int,
+        default=100000,
+        help='Size in bytes of the synthesized data file, without --file')
+    parser.add_argument(
+        '--repository',
+        default=DEFAULT_REPOSITORY,
+        help='Repository of the uploads')
+    parser.add_argument(
+        '--builders',
+        type=int,
+        default=6,
+        help='Number of builders uploading for each commit')
+    parser.add_argument(
+        '--commits',
+        type=int,
+        default=10,
+        help='Number of commits')
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=8,
+        help='Number of concurrent uploads')
+    parser.add_argument(
+        '--rate',
+        type=float,
+        default=0,
+        help='Target uploads per second, 0 for as fast as possible')
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        default=30,
+        help='Timeout in seconds for an upload')
+    parser.add_argument(
+        '--no-compress',
+        dest='compress',
+        action='store_false',
+        default=True,
+        help='Upload the data files without compressing them')
+
+    args = parser.parse_args(argv)
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        payloads = args.file
+        if not payloads:
+            payloads = [os.path.join(tempdir, 'coverage.data')]
+            make_payload(payloads[0], args.payload_size)
+
+        print('Uploading %d data files for %d commits of %d builders, '
+              'with %d concurrent uploads.' % (
+                  args.builders * args.commits, args.commits, args.builders,
+                  args.concurrency))
+        start = time.time()
+        results = run_load(
+            args.url, payloads, args.builders, args.commits,
+            args.concurrency, args.rate, args.repository, args.timeout,
+            args.compress)
+        for line in format_report(results, time.time() - start):
+            print(line)
+    finally:
+        shutil.rmtree(tempdir)
+
+    if any(result != UPLOAD_OK for _, result in results):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
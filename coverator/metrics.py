@@ -0,0 +1,229 @@
+"""
+Metrics for the uploads and the reports, in the Prometheus text format.
+
+The uploads are measured by the HTTP server and the reports by the report
+generator process. The report generator saves its metrics to a snapshot
+file from the storage path, which is served together with the metrics of
+the HTTP server from `/metrics`.
+"""
+from __future__ import unicode_literals
+
+from contextlib import contextmanager
+
+import copy
+import json
+import numbers
+import os
+import threading
+import time
+
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+# Buckets, in seconds, for the duration of the requests and of the
+# report stages.
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120,
+    300)
+
+# Buckets, in bytes, for the size of the uploads.
+SIZE_BUCKETS = tuple(1024 * 4 ** power for power in range(10))
+
+# The help text for the metrics.
+DESCRIPTIONS = {
+    'coverator_upload_seconds': 'Time to handle an upload request.',
+    'coverator_upload_bytes': 'Size of the uploaded data files.',
+    'coverator_uploads_total': 'Upload requests, by response status.',
+    'coverator_report_seconds': 'Time to generate a report.',
+    'coverator_report_stage_seconds': 'Time of each report stage.',
+    'coverator_reports_total': 'Reports, by result.',
+    'coverator_reports_scheduled': 'Reports waiting for their time.',
+    'coverator_reports_waiting': (
+        'Due reports waiting for another report of the repository.'),
+    'coverator_reports_running': 'Reports being generated.',
+    'coverator_cache_hits_total': 'Cache hits, by cache.',
+    'coverator_cache_misses_total': 'Cache misses, by cache.',
+    'coverator_github_statuses_total': 'GitHub statuses, by result.',
+    'coverator_github_status_seconds': 'Time to send a GitHub status.',
+    'coverator_codecov_upload_seconds': 'Time to upload to codecov.io.',
+    'coverator_codecov_uploads_total': 'codecov.io uploads, by result.',
+    'coverator_snapshot_timestamp_seconds': (
+        'Time when the report generator metrics were saved.'),
+    }
+
+
+def _label_value(value):
+    return ('%s' % (value,)).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % (','.join(
+        '%s="%s"' % (name, _label_value(value)) for name, value in labels),)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, numbers.Integral) or (
+            isinstance(value, float) and value.is_integer()):
+        return '%d' % (value,)
+    return repr(value)
+
+
+class Metrics(object):
+    """
+    Counters, gauges and histograms, by name and labels.
+
+    The kind of a metric is set by its first update. The metrics can be
+    updated from multiple threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Maps a name to its (kind, buckets) tuple.
+        self._kinds = {}
+        # Maps a (name, labels) tuple to the value, or to the
+        # [bucket counts, sum, count] list for histograms.
+        self._values = {}
+
+    def _key(self, name, kind, labels, buckets=None):
+        """
+        Return the key for the metric, registering its kind.
+        """
+        known = self._kinds.setdefault(name, (kind, buckets))
+        if known[0] != kind:
+            raise ValueError('%s is a %s, not a %s' % (name, known[0], kind))
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increase the counter `name`.
+        """
+        with self._lock:
+            key = self._key(name, COUNTER, labels)
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, kind=GAUGE, **labels):
+        """
+        Set the value of the gauge `name`, or of a counter kept by another
+        object when `kind` is COUNTER.
+        """
+        with self._lock:
+            self._values[self._key(name, kind, labels)] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        """
+        Add `value` to the histogram `name`.
+        """
+        with self._lock:
+            key = self._key(name, HISTOGRAM, labels, tuple(buckets))
+            buckets = self._kinds[name][1]
+            histogram = self._values.get(key)
+            if histogram is None:
+                histogram = self._values[key] = [[0] * len(buckets), 0.0, 0]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def time(self, name, **labels):
+        """
+        Add the seconds spent in the context to the histogram `name`.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def render(self):
+        """
+        Return the metrics in the Prometheus text format.
+        """
+        with self._lock:
+            values = sorted(self._values.items())
+            kinds = dict(self._kinds)
+
+        lines = []
+        last_name = None
+        for (name, labels), value in values:
+            kind, buckets = kinds[name]
+            if name != last_name:
+                last_name = name
+                if name in DESCRIPTIONS:
+                    lines.append('# HELP %s %s' % (name, DESCRIPTIONS[name]))
+                lines.append('# TYPE %s %s' % (name, kind))
+            if kind != HISTOGRAM:
+                lines.append('%s%s %s' % (
+                    name, _format_labels(labels), _format_value(value)))
+                continue
+
+            counts, total, count = value
+            for bound, bucket_count in zip(
+                    buckets + (float('inf'),), counts + [count]):
+                lines.append('%s_bucket%s %d' % (
+                    name,
+                    _format_labels(labels + (('le', _format_value(bound)),)),
+                    bucket_count))
+            lines.append('%s_sum%s %s' % (
+                name, _format_labels(labels), _format_value(total)))
+            lines.append('%s_count%s %d' % (
+                name, _format_labels(labels), count))
+        return ''.join('%s\n' % (line,) for line in lines)
+
+    def toRaw(self):
+        """
+        Return the metrics as a dictionary which can be serialized as JSON.
+        """
+        with self._lock:
+            return {
+                'kinds': dict(
+                    (name, [kind, buckets])
+                    for name, (kind, buckets) in self._kinds.items()),
+                'values': [
+                    [name, labels, copy.deepcopy(value)]
+                    for (name, labels), value in self._values.items()],
+                }
+
+    @classmethod
+    def fromRaw(cls, data):
+        """
+        Return the metrics from the dictionary created by toRaw.
+        """
+        result = cls()
+        for name, (kind, buckets) in data['kinds'].items():
+            if buckets is not None:
+                buckets = tuple(buckets)
+            result._kinds[name] = (kind, buckets)
+        for name, labels, value in data['values']:
+            labels = tuple(tuple(label) for label in labels)
+            result._values[(name, labels)] = value
+        return result
+
+    def save(self, path):
+        """
+        Write the metrics to the snapshot file at `path`.
+        """
+        temporary_path = '%s.tmp' % (path,)
+        with open(temporary_path, 'wb') as stream:
+            stream.write(json.dumps(self.toRaw()).encode('utf-8'))
+        os.rename(temporary_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Return the metrics from the snapshot file at `path`, or empty
+        metrics if the file does not exist.
+        """
+        try:
+            with open(path, 'rb') as stream:
+                return cls.fromRaw(json.loads(stream.read().decode('utf-8')))
+        except (IOError, ValueError):
+            return cls()
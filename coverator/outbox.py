@@ -0,0 +1,262 @@
+"""
+Delivery of the commit statuses to GitHub.
+
+The statuses are sent from a background thread, so a slow or rate limited
+GitHub API does not delay the reports. The failed statuses are scheduled to
+be retried later, so they do not delay the statuses of the other commits.
+The requests share a pool of persistent HTTP connections, and the
+repositories are revalidated with conditional requests, which do not count
+against the rate limit.
+"""
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from coverator.metrics import Metrics
+from coverator.scheduler import DebounceScheduler
+from Queue import Empty, Queue as ThreadQueue
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+
+import json
+import requests
+import threading
+import time
+
+
+GITHUB_API_URL = 'https://api.github.com'
+
+# Seconds for which a repository is used without asking GitHub if it
+# was changed.
+REPOSITORY_TTL = 300
+
+# Maximum number of seconds to wait before retrying a request.
+MAXIMUM_BACKOFF = 300
+
+
+class RetryLater(Exception):
+    """
+    The request failed, and it can be sent again after `wait` seconds or,
+    when `wait` is None, after the backoff.
+    """
+
+    def __init__(self, reason, wait=None):
+        super(RetryLater, self).__init__(reason)
+        self.wait = wait
+
+
+class StatusOutbox(threading.Thread):
+    """
+    Sends commit statuses to the GitHub API from `api_url`, authenticated
+    with `token`.
+
+    A failed status is retried up to `retries` times, after `backoff`
+    seconds and then twice as long for each new attempt. When the rate
+    limit is exceeded, the status is retried after the time requested
+    by GitHub. The other statuses are sent while a status waits to be
+    retried.
+
+    Only the last status of a commit is sent for a context, when the
+    previous one was not sent yet.
+    """
+
+    def __init__(
+            self, token, api_url=GITHUB_API_URL, retries=5, backoff=1,
+            timeout=30, log=None, metrics=None):
+        super(StatusOutbox, self).__init__(name='github-outbox')
+        self.daemon = True
+        self.api_url = api_url.rstrip('/')
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self._log = log or (lambda format, *args: None)
+        self._metrics = metrics or Metrics()
+        self._queue = ThreadQueue()
+        # Maps a (repository, commit, context) tuple to the last status,
+        # queued or waiting to be retried.
+        self._pending = OrderedDict()
+        # The keys of the failed statuses, with their next attempt.
+        self._retries = DebounceScheduler()
+        self._lock = threading.Lock()
+        # Maps a repository to its (ETag, data, time checked) tuple.
+        self._repositories = {}
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'Accept': 'application/vnd.github.v3+json',
+            'Authorization': 'token %s' % (token,),
+            'User-Agent': 'coverator',
+            })
+
+    def post(self, repository, commit, state, target_url, description,
+             context):
+        """
+        Queue the status for `commit` to be sent.
+        """
+        key = (repository, commit, context)
+        status = {
+            'state': state,
+            'target_url': target_url,
+            'description': description,
+            'context': context,
+            }
+        with self._lock:
+            is_queued = key in self._pending
+            self._pending[key] = status
+        if not is_queued:
+            self._queue.put((key, 1))
+
+    def stop(self):
+        """
+        Send the queued statuses and stop the thread.
+
+        The statuses waiting to be retried are not sent.
+        """
+        self._queue.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            now = time.time()
+            for key, attempt in self._retries.popDue(now):
+                self._queue.put((key, attempt))
+
+            timeout = None
+            next_time = self._retries.nextTime()
+            if next_time is not None:
+                timeout = max(next_time - now, 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except Empty:
+                continue
+            if item is None:
+                break
+            self._process(*item)
+
+        for (repository, commit, _), _ in self._retries.items():
+            self._log('Status not retried for %s %s', repository, commit)
+        self.session.close()
+
+    def _process(self, key, attempt):
+        """
+        Send the last status for `key` and schedule it again if it failed.
+        """
+        with self._lock:
+            status = self._pending.pop(key)
+        repository, commit, _ = key
+        try:
+            with self._metrics.time('coverator_github_status_seconds'):
+                self.send(repository, commit, status)
+        except RetryLater as error:
+            if attempt > self.retries:
+                self.failed += 1
+                self._log(
+                    'Giving up on status for %s %s after %d attempts: %s',
+                    repository, commit, attempt, error)
+                return
+            wait = error.wait
+            if wait is None:
+                wait = self.backoff * 2 ** (attempt - 1)
+            wait = min(wait, MAXIMUM_BACKOFF)
+            with self._lock:
+                if key in self._pending:
+                    # A newer status was queued while this one was sent.
+                    return
+                self._pending[key] = status
+            self._log(
+                'Failed to send status for %s %s, retrying in %.1f '
+                'seconds: %s', repository, commit, wait, error)
+            self.retried += 1
+            self._retries.schedule(key, time.time() + wait, attempt + 1)
+        except Exception as error:
+            self.failed += 1
+            self._log(
+                'Failed to send status for %s %s: %s',
+                repository, commit, error)
+
+    def send(self, repository, commit, status):
+        """
+        Send the `status` for `commit` right away.
+
+        Raise RetryLater when the status can be sent again later.
+        """
+        data = self.getRepository(repository)
+        url = data['statuses_url'].replace('{sha}', commit)
+        self._request('POST', url, data=json.dumps(status))
+        self.sent += 1
+        self._log(
+            'Sent %s status for %s %s', status['state'], repository, commit)
+
+    def getRepository(self, repository):
+        """
+        Return the data from GitHub for `repository`.
+
+        The data is cached and it is only requested again, with a
+        conditional request, after REPOSITORY_TTL seconds.
+        """
+        if repository.endswith('.git'):
+            repository = repository[:-4]
+        etag, data, checked = self._repositories.get(
+            repository, (None, None, 0))
+        if data is not None and time.time() - checked < REPOSITORY_TTL:
+            return data
+
+        headers = {}
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        response = self._request(
+            'GET', '%s/repos/%s' % (self.api_url, repository),
+            headers=headers)
+        if response.status_code != 304:
+            etag = response.headers.get('ETag')
+            data = response.json()
+        self._repositories[repository] = (etag, data, time.time())
+        return data
+
+    def _request(self, method, url, **kwargs):
+        """
+        Return the response for the request.
+
+        Raise RetryLater on connection errors, server errors and when the
+        rate limit is exceeded.
+        """
+        try:
+            response = self.session.request(
+                method, url, timeout=self.timeout, **kwargs)
+        except RequestException as error:
+            raise RetryLater('%s %s failed: %s' % (method, url, error))
+        if response.status_code < 400:
+            return response
+
+        wait = self._retryAfter(response)
+        if (wait is None and
+                response.status_code < 500 and
+                response.status_code != 429):
+            # Not something which is fixed by trying again.
+            response.raise_for_status()
+        raise RetryLater(
+            '%s %s failed with HTTP %d' % (
+                method, url, response.status_code), wait)
+
+    def _retryAfter(self, response):
+        """
+        Return the number of seconds to wait requested by GitHub when the
+        rate limit is exceeded, or None.
+        """
+        if response.status_code not in (403, 429):
+            return None
+
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is not None:
+            return max(float(retry_after), 0)
+
+        if response.headers.get('X-RateLimit-Remaining') == '0':
+            reset = float(response.headers.get('X-RateLimit-Reset', 0))
+            return max(reset - time.time(), 0)
+
+        return None
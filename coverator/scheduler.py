@@ -0,0 +1,96 @@
+"""
+Scheduler for the debounced report jobs.
+"""
+from __future__ import unicode_literals
+
+import heapq
+import itertools
+
+
+class DebounceScheduler(object):
+    """
+    Values which are due at a given time, identified by a key.
+
+    Scheduling a key again replaces its previous value and time, which
+    is how the reports are debounced while builders are still uploading.
+
+    The values are kept in a heap ordered by time. Replaced and cancelled
+    entries are left in the heap and skipped when they reach the top, so
+    scheduling is O(log n) and no operation scans all the values.
+    """
+
+    def __init__(self):
+        self._heap = []
+        # Maps a key to its live [when, sequence, key, value] heap entry.
+        self._entries = {}
+        # Breaks the ties between entries due at the same time.
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """
+        Return the value scheduled for `key`.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        return entry[3]
+
+    def items(self):
+        """
+        Return the (key, value) pairs, in no particular order.
+        """
+        return [(key, entry[3]) for key, entry in self._entries.items()]
+
+    def schedule(self, key, when, value):
+        """
+        Schedule `value` for `key` at `when`, replacing any previous value.
+        """
+        self.cancel(key)
+        entry = [when, next(self._sequence), key, value]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+
+    def cancel(self, key):
+        """
+        Remove the value scheduled for `key` and return it.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        # Mark it as removed. It is discarded when it reaches the top.
+        entry[2] = None
+        return entry[3]
+
+    def _discardRemoved(self):
+        while self._heap and self._heap[0][2] is None:
+            heapq.heappop(self._heap)
+
+    def nextTime(self):
+        """
+        Return the time when the next value is due, or None if nothing is
+        scheduled.
+        """
+        self._discardRemoved()
+        if not self._heap:
+            return None
+        return self._heap[0][0]
+
+    def popDue(self, now):
+        """
+        Remove and return the (key, value) pairs due at `now`, the oldest
+        first.
+        """
+        due = []
+        while True:
+            self._discardRemoved()
+            if not self._heap or self._heap[0][0] > now:
+                return due
+            when, _, key, value = heapq.heappop(self._heap)
+            del self._entries[key]
+            due.append((key, value))
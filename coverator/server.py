@@ -1,28 +1,308 @@
 from __future__ import unicode_literals
 
 from BaseHTTPServer import HTTPServer
+from collections import OrderedDict
 from ConfigParser import SafeConfigParser
-from git import Repo
-from github import Github
-from Queue import Empty
+from contextlib import contextmanager
+from coverator.analysis import AnalysisCache
+from coverator.api import API_PREFIX, JsonApi
+from coverator.checkout import WorktreeCache
+from coverator.diffcoverage import ChangedLinesCache, diff_coverage
+from coverator.index import (
+    REPORT_CANCELLED,
+    REPORT_DONE,
+    REPORT_FAILED,
+    REPORT_QUEUED,
+    REPORT_RUNNING,
+    MetadataIndex,
+    )
+from coverator.jobs import JobStore
+from coverator.metrics import COUNTER, SIZE_BUCKETS, Metrics
+from coverator.outbox import StatusOutbox
+from coverator.scheduler import DebounceScheduler
+from coverator.tracing import Trace, activate, span
+from coverator.uploader import CodecovUploader
+from coverator.xmlreport import XmlReport
+from coverator.combine import (
+    BUILD_PART_SEPARATOR,
+    COVERAGE_STATE_FILE,
+    CoverageCombiner,
+    CoverageCounter,
+    CoverageDataError,
+    PathAliases,
+    compress_file,
+    read_coverage_config,
+    read_data_file,
+    )
+from Queue import Empty, Queue as ThreadQueue
 from multiprocessing import Queue, Process
+from multiprocessing.pool import ThreadPool
 from SimpleHTTPServer import SimpleHTTPRequestHandler
-from subprocess import call
 
 import argparse
 import cgi
+import cProfile
+import errno
 import glob
 import os
 import posixpath
 import shutil
 import sys
 import tempfile
+import threading
 import time
+import traceback
 import urllib
+import uuid
 
 
 COVERAGE_DATA_PREFIX = 'coverage.data.'
 
+# Number of superseded commits remembered by the report generator.
+MAXIMUM_SUPERSEDED = 10000
+
+# Directory from the storage path with the files used by the server.
+STATE_DIR = '.coverator'
+
+# Sent on the report generator queue when a report was generated.
+JOB_DONE = 'job-done'
+
+# Path of the metrics in the Prometheus text format.
+METRICS_URL = '/metrics'
+
+# Size of the chunks used when writing uploaded files to disk.
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Report files which are also written gzip compressed, with the `.gz`
+# extension, to be served to the clients accepting it.
+PRECOMPRESSED_FILES = ('coverage.xml', 'diff-cover.html')
+
+# Files from the storage path are revalidated by the clients on each use,
+# as a report is generated again when a late builder uploads.
+CACHE_CONTROL = 'no-cache'
+
+# Written next to the report when profiling the reports: the trace of the
+# report, for chrome://tracing, and the cProfile statistics.
+TRACE_FILE = 'trace.json'
+PROFILE_FILE = 'profile.pstats'
+
+
+def uploaded_builders(path):
+    """
+    Return the names of the builders which uploaded a data file for the
+    commit stored at `path`.
+
+    The data files uploaded as parts of a builder count as one builder.
+    """
+    return set(
+        os.path.basename(data_path)[len(COVERAGE_DATA_PREFIX):].split(
+            BUILD_PART_SEPARATOR)[0]
+        for data_path in glob.glob(
+            os.path.join(path, '%s*' % COVERAGE_DATA_PREFIX)))
+
+
+def stale_parts(path, build, parts):
+    """
+    Return the names of the builders from the data files of the commit
+    stored at `path` which are replaced by the upload of `build`, sent as
+    one of `parts` data files.
+
+    These are left by an earlier upload of the same builder with a
+    different number of parts. A builder uploading a single data file
+    has no parts.
+    """
+    if parts > 1:
+        builder = build.rsplit(BUILD_PART_SEPARATOR, 1)[0]
+        current = set(
+            '%s%s%d' % (builder, BUILD_PART_SEPARATOR, part)
+            for part in range(1, parts + 1))
+    else:
+        builder = build
+        current = set([build])
+
+    names = []
+    for filename in sorted(os.listdir(path)):
+        if not filename.startswith(COVERAGE_DATA_PREFIX):
+            continue
+        name = filename[len(COVERAGE_DATA_PREFIX):]
+        if name in current:
+            continue
+        if (name == builder or
+                name.startswith(builder + BUILD_PART_SEPARATOR)):
+            names.append(name)
+    return names
+
+
+def has_all_builders(expected_builders, repository, path):
+    """
+    Return True if all the builders expected for `repository` have
+    uploaded a data file for the commit stored at `path`.
+    """
+    expected = expected_builders.get(repository)
+    if not expected:
+        return False
+    return expected.issubset(uploaded_builders(path))
+
+
+# Locks serializing the updates of the same symlink, when requests are
+# handled by multiple threads. A path always uses the same lock.
+_PATH_LOCKS = [threading.Lock() for _ in range(64)]
+
+# Serializes the merge of the uploads, which loads the data files in
+# memory, so that the memory used is bounded by a single merge.
+_MERGE_LOCK = threading.Lock()
+
+
+def _lock_for(path):
+    """
+    Return the lock protecting the updates to `path`.
+    """
+    return _PATH_LOCKS[hash(path) % len(_PATH_LOCKS)]
+
+
+def _makedirs(path):
+    """
+    Create the directory at `path`, if it was not created already,
+    possibly by another request.
+    """
+    try:
+        os.makedirs(path)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise
+
+
+def _replace_symlink(target, link_path):
+    """
+    Atomically point the symlink at `link_path` to `target`.
+    """
+    temporary_path = '%s.%s.tmp' % (link_path, uuid.uuid4().hex)
+    os.symlink(target, temporary_path)
+    os.rename(temporary_path, link_path)
+
+
+def _write_temporary(source, directory):
+    """
+    Copy the `source` file object to a new temporary file from
+    `directory`, in chunks of UPLOAD_CHUNK_SIZE bytes, and return its path.
+    """
+    temporary = tempfile.NamedTemporaryFile(
+        dir=directory, prefix='.upload-', delete=False)
+    try:
+        with temporary:
+            shutil.copyfileobj(source, temporary, UPLOAD_CHUNK_SIZE)
+    except Exception:
+        os.remove(temporary.name)
+        raise
+    return temporary.name
+
+
+def _write_atomic(source, path):
+    """
+    Copy the `source` file object to `path`, so that a reader never sees a
+    partially written file.
+    """
+    temporary_path = _write_temporary(source, os.path.dirname(path))
+    try:
+        os.rename(temporary_path, path)
+    except Exception:
+        os.remove(temporary_path)
+        raise
+
+
+def _write_compressed(path):
+    """
+    Write the gzip compressed content of `path` next to it, with the
+    `.gz` extension.
+    """
+    compressed = compress_file(path)
+    try:
+        _write_atomic(compressed, path + '.gz')
+    finally:
+        compressed.close()
+
+
+def accepts_gzip(accept_encoding):
+    """
+    Return True if the `accept_encoding` header allows gzip responses.
+    """
+    for value in (accept_encoding or '').split(','):
+        parts = value.split(';')
+        if parts[0].strip().lower() not in ('gzip', 'x-gzip', '*'):
+            continue
+        for parameter in parts[1:]:
+            name, _, quality = parameter.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    return float(quality) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Return True if the `etag` is in the `if_none_match` header.
+    """
+    for value in (if_none_match or '').split(','):
+        value = value.strip()
+        if value.startswith('W/'):
+            value = value[2:]
+        if value in (etag, '*'):
+            return True
+    return False
+
+
+class PooledHTTPServer(HTTPServer):
+    """
+    HTTP server handling the requests with a fixed pool of threads, so that
+    a slow upload does not block the other uploads and page views.
+    """
+
+    def __init__(self, server_address, RequestHandlerClass, workers=8):
+        HTTPServer.__init__(self, server_address, RequestHandlerClass)
+        self._requests = ThreadQueue()
+        self._workers = []
+        for _ in range(workers):
+            worker = threading.Thread(target=self._processRequests)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _processRequests(self):
+        """
+        Worker thread loop, handling the accepted requests.
+        """
+        while True:
+            request, client_address = self._requests.get()
+            if request is None:
+                break
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        """
+        Pass the accepted request to the pool of threads.
+        """
+        self._requests.put((request, client_address))
+
+    def server_close(self):
+        """
+        Stop the worker threads after the pending requests are handled.
+
+        This waits for the requests which are still in progress.
+        """
+        HTTPServer.server_close(self)
+        for _ in self._workers:
+            self._requests.put((None, None))
+        for worker in self._workers:
+            worker.join()
+
 
 class CoveratorHandler(SimpleHTTPRequestHandler):
     """
@@ -33,14 +313,97 @@ class CoveratorHandler(SimpleHTTPRequestHandler):
     """
     PATH = None
     MINIMUM_FILES = 6
+    MAX_UPLOAD_SIZE = 100 * 1024 * 1024
+    # Maps a repository to the set of builders which upload data files.
+    # Reports are requested as soon as all of them uploaded, even if there
+    # are less than MINIMUM_FILES.
+    EXPECTED_BUILDERS = {}
+    # The MetadataIndex updated for each upload.
+    INDEX = None
+    # Keep the `branch/` and `pr/` symlinks to the commit directories, for
+    # the tools still reading the branches and PRs from the files.
+    SYMLINKS = True
+    # The JsonApi serving the requests for API_PREFIX.
+    API = None
+    # The metrics of the requests, served from METRICS_URL together with
+    # the metrics saved by the report generator to METRICS_SNAPSHOT.
+    METRICS = Metrics()
+    METRICS_SNAPSHOT = None
     report_generator = None
 
+    def do_GET(self):
+        """
+        Serve the API requests and the metrics, and the files from PATH for
+        the other requests.
+        """
+        if self.path.split('?', 1)[0] == METRICS_URL:
+            body = self.METRICS.render()
+            if self.METRICS_SNAPSHOT is not None:
+                body += Metrics.load(self.METRICS_SNAPSHOT).render()
+            self._sendBody(
+                200, 'text/plain; version=0.0.4; charset=utf-8', body)
+            return
+
+        if self.API is None or not self.path.startswith(API_PREFIX):
+            return SimpleHTTPRequestHandler.do_GET(self)
+
+        code, body = self.API.handle(self.path)
+        self._sendBody(code, 'application/json', body)
+
+    def _sendBody(self, code, content_type, body):
+        body = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', '%d' % (len(body),))
+        self.end_headers()
+        self.wfile.write(body)
+
     def do_POST(self):
+        """
+        Handle an upload, measuring its duration and response status.
+        """
+        self.response_code = None
+        with self.METRICS.time('coverator_upload_seconds'):
+            self._receiveUpload()
+        self.METRICS.inc(
+            'coverator_uploads_total', code='%s' % (self.response_code,))
+
+    def send_response(self, code, message=None):
+        self.response_code = code
+        SimpleHTTPRequestHandler.send_response(self, code, message)
+
+    def _receiveUpload(self):
         """
         Receives a report file associated to a branch and or a PR,
         combine all reports by branch and PR and generate the HTML
         report.
+
+        The uploaded file is copied to disk in chunks, from the temporary
+        file spooled by cgi.FieldStorage, concurrently with the other
+        uploads. Its data is then loaded, with the data previously uploaded
+        by the builder and the combined state, and merged one upload at a
+        time, so the memory used is bounded by a single merge of data files
+        of up to MAX_UPLOAD_SIZE decompressed bytes.
+
+        The file can be sent gzip compressed, using a Content-Encoding
+        header for the file part.
         """
+        try:
+            length = int(self.headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            self.send_error(411, 'Content-Length required')
+            return
+
+        if length > self.MAX_UPLOAD_SIZE:
+            self.log_message(
+                'Upload of %d bytes is larger than %d bytes.',
+                length, self.MAX_UPLOAD_SIZE)
+            self.close_connection = 1
+            self.send_error(413, 'Upload too large')
+            return
+        self.METRICS.observe(
+            'coverator_upload_bytes', length, buckets=SIZE_BUCKETS)
+
         form = cgi.FieldStorage(
             fp=self.rfile,
             headers=self.headers,
@@ -49,9 +412,18 @@ class CoveratorHandler(SimpleHTTPRequestHandler):
                      })
 
         if 'file' in form:
+            # The data file can be compressed by the client, in which
+            # case it is stored compressed.
+            encoding = form['file'].headers.get(
+                'Content-Encoding', 'identity').strip().lower()
+            if encoding not in ('identity', 'gzip'):
+                self.send_error(
+                    415, 'Unsupported Content-Encoding: %s' % (encoding,))
+                return
+
             if not os.path.exists(self.PATH):
                 self.log_message('Creating dir: %s.', self.PATH)
-                os.mkdir(self.PATH)
+                _makedirs(self.PATH)
 
             repo = form.getvalue('repository', None)
 
@@ -62,55 +434,93 @@ class CoveratorHandler(SimpleHTTPRequestHandler):
 
             if not os.path.exists(repository_path):
                 self.log_message('Creating dir: %s.', repository_path)
-                os.makedirs(repository_path)
+                _makedirs(repository_path)
 
-            for dir_name in ('commit', 'branch', 'pr'):
-                if not os.path.exists(
-                        os.path.join(repository_path, dir_name)):
-                    os.mkdir(os.path.join(repository_path, dir_name))
+            dir_names = ('commit',)
+            if self.SYMLINKS:
+                dir_names += ('branch', 'pr')
+            for dir_name in dir_names:
+                _makedirs(os.path.join(repository_path, dir_name))
 
             coverage_file = form['file'].file
             commit = form.getvalue('commit', 'no-commit')
             build = form.getvalue('build', 'no-buildslave')
+            try:
+                parts = int(form.getvalue('parts', 0))
+            except ValueError:
+                self.send_error(400, 'Invalid number of parts')
+                return
             path = os.path.join(repository_path, 'commit', commit)
 
-            if not os.path.exists(path):
-                os.mkdir(path)
+            _makedirs(path)
 
             self.log_message('Writing coverage file: (%s,%s)', build, commit)
+            temporary_path = _write_temporary(coverage_file, path)
+
+            # The data files are loaded in memory to be merged, so only one
+            # upload is merged at a time, whatever the number of workers.
+            # The upload is checked before it replaces the previous data
+            # file of the builder, which would be lost otherwise.
+            with _MERGE_LOCK:
+                try:
+                    data = read_data_file(temporary_path, self.MAX_UPLOAD_SIZE)
+                except CoverageDataError as error:
+                    os.remove(temporary_path)
+                    self.log_message('Rejecting coverage file: %s', error)
+                    self.send_error(400, 'Invalid coverage data file')
+                    return
+
+                data_path = os.path.join(
+                    path, '%s%s' % (COVERAGE_DATA_PREFIX, build))
+                previous_data = self._readCoverageData(data_path)
+
+                os.rename(temporary_path, data_path)
+
+                # When the number of data files sent by the builder is
+                # known, the files left by an earlier upload with a
+                # different number of parts are replaced too.
+                removed_data = [previous_data]
+                stale = []
+                if parts:
+                    stale = stale_parts(path, build, parts)
+                for name in stale:
+                    stale_path = os.path.join(
+                        path, '%s%s' % (COVERAGE_DATA_PREFIX, name))
+                    removed_data.append(self._readCoverageData(stale_path))
+                    os.remove(stale_path)
+
+                self._updateCoverageState(path, removed_data, data)
+
+                self.log_message('Done.')
+
+                builders = uploaded_builders(path)
+                expected = self.EXPECTED_BUILDERS.get(repo)
+                queue_report = (
+                    len(builders) > self.MINIMUM_FILES or
+                    (expected and expected.issubset(builders)))
 
-            f = open(os.path.join(path, '%s%s' % (
-                COVERAGE_DATA_PREFIX, build)), 'wb')
-            f.write(coverage_file.read())
-            f.close()
-
-            self.log_message('Done.')
-
-            for key in ('branch', 'pr'):
-                # Check if we are setting a branch and/or a PR and update
-                # the directory structure
-                if key in form:
-                    value = form.getvalue(key)
-                    open(os.path.join(path, '.coverage_%ss' % key), 'a').write(
-                        value + os.linesep)
-                    link_path = os.path.join(
-                        repository_path, '%s' % key, value)
-                    self.log_message(
-                        'Updating symlink for %s -> %s', link_path, path)
-                    if os.path.exists(link_path):
-                        os.unlink(link_path)
-                    os.symlink(path, link_path)
-
-            coverage_files = glob.glob(os.path.join(
-                path, '%s*' % COVERAGE_DATA_PREFIX))
-
-            if len(coverage_files) > self.MINIMUM_FILES:
+                branch = form.getvalue('branch', None)
+                pr = form.getvalue('pr', None)
+                if self.INDEX is not None:
+                    # The queued status is set with the upload, so an
+                    # upload is a single write to the index.
+                    self.INDEX.recordUpload(
+                        repo, commit, build, branch, pr,
+                        size=os.path.getsize(data_path),
+                        report_status=(
+                            REPORT_QUEUED if queue_report else None),
+                        removed=stale)
+
+            if self.SYMLINKS:
+                for kind, name in (('branch', branch), ('pr', pr)):
+                    if name is not None:
+                        self._updateLink(repo, kind, name, commit)
+
+            if queue_report:
                 now = time.time()
                 self.log_message(
                     'Adding (%s, %f) to the queue' % (commit, now))
-                branch = form.getvalue('branch', None)
-                pr = form.getvalue('pr', None)
-                self.report_generator.queue.put(
+                self.report_generator.queueReport(
                     (self.PATH, repo, commit, branch, pr, now))
 
         self.log_message('Writing response.')
@@ -122,6 +532,136 @@ class CoveratorHandler(SimpleHTTPRequestHandler):
         self.wfile.write(response)
         self.log_message('Response written.')
 
+    def send_head(self):
+        """
+        Send the headers for a file from PATH, with an ETag, and return the
+        file to be sent, or None.
+
+        A 304 response is sent when the client has the same version of the
+        file. The `.gz` variant of the file is sent when it is up to date
+        and the client accepts gzip. Directories are handled as in
+        SimpleHTTPRequestHandler.
+        """
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            return SimpleHTTPRequestHandler.send_head(self)
+
+        try:
+            source = open(path, 'rb')
+        except IOError:
+            self.send_error(404, 'File not found')
+            return None
+
+        stat = os.fstat(source.fileno())
+        encoding = None
+        compressed_path = path + '.gz'
+        has_compressed = (
+            os.path.basename(path) in PRECOMPRESSED_FILES and
+            os.path.isfile(compressed_path))
+        if has_compressed and accepts_gzip(
+                self.headers.get('Accept-Encoding')):
+            try:
+                compressed = open(compressed_path, 'rb')
+            except IOError:
+                compressed = None
+            if compressed is not None:
+                compressed_stat = os.fstat(compressed.fileno())
+                if compressed_stat.st_mtime >= stat.st_mtime:
+                    source.close()
+                    source = compressed
+                    stat = compressed_stat
+                    encoding = 'gzip'
+                else:
+                    # The report was generated again and the compressed
+                    # file was not updated yet.
+                    compressed.close()
+
+        etag = '"%x-%x-%x"' % (
+            stat.st_ino, stat.st_size, int(stat.st_mtime * 1000000))
+        try:
+            if etag_matches(self.headers.get('If-None-Match'), etag):
+                source.close()
+                self.send_response(304)
+                self._sendCacheHeaders(etag, has_compressed)
+                self.end_headers()
+                return None
+
+            self.send_response(200)
+            self.send_header('Content-type', self.guess_type(path))
+            self.send_header('Content-Length', '%d' % (stat.st_size,))
+            self.send_header(
+                'Last-Modified', self.date_time_string(stat.st_mtime))
+            if encoding is not None:
+                self.send_header('Content-Encoding', encoding)
+            self._sendCacheHeaders(etag, has_compressed)
+            self.end_headers()
+            return source
+        except Exception:
+            source.close()
+            raise
+
+    def _sendCacheHeaders(self, etag, has_compressed):
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', CACHE_CONTROL)
+        if has_compressed:
+            self.send_header('Vary', 'Accept-Encoding')
+
+    def copyfile(self, source, outputfile):
+        """
+        Send the `source` file in chunks of UPLOAD_CHUNK_SIZE bytes.
+        """
+        shutil.copyfileobj(source, outputfile, UPLOAD_CHUNK_SIZE)
+
+    def _updateLink(self, repo, kind, name, commit):
+        """
+        Point the `branch/` or `pr/` symlink of the branch or PR `name` to
+        the directory of its head commit.
+
+        With the index, the head is the commit with the last upload for
+        the branch or PR, so concurrent uploads for different commits do
+        not leave the link to another commit.
+        """
+        repository_path = os.path.join(self.PATH, repo)
+        link_path = os.path.join(repository_path, kind, name)
+        with _lock_for(link_path):
+            if self.INDEX is not None:
+                commit = self.INDEX.head(repo, kind, name) or commit
+            path = os.path.join(repository_path, 'commit', commit)
+            self.log_message(
+                'Updating symlink for %s -> %s', link_path, path)
+            _replace_symlink(path, link_path)
+
+    def _readCoverageData(self, path):
+        """
+        Return the raw data of the coverage data file at `path`.
+
+        Return None if the file does not exist or is not valid.
+        """
+        if not os.path.exists(path):
+            return None
+        try:
+            return read_data_file(path, self.MAX_UPLOAD_SIZE)
+        except CoverageDataError as error:
+            self.log_message('Ignoring coverage file: %s', error)
+            return None
+
+    def _updateCoverageState(self, path, removed_data, data):
+        """
+        Update the running combination of the data files for the
+        commit at `path`.
+
+        `removed_data` is the data from the previous uploads of the same
+        builder, which are replaced by `data`. Missing data is None.
+        """
+        state_path = os.path.join(path, COVERAGE_STATE_FILE)
+        state = CoverageCounter.load(state_path)
+        for previous_data in removed_data:
+            if previous_data is not None:
+                state.remove(previous_data)
+        if data is not None:
+            state.add(data)
+        state.save(state_path)
+
     def translate_path(self, path):
         """
         This code is copied from SimpleHTTPRequestHandler.
@@ -151,9 +691,20 @@ class CoveratorHandler(SimpleHTTPRequestHandler):
         return path
 
 
+class ReportCancelled(Exception):
+    """
+    Raised when a report in progress is cancelled.
+    """
+
+
 class ReportGenerator(Process):
     """
     Consumer process for generating reports without blocking the HTTP server.
+
+    The reports are generated by a pool of threads, in parallel for
+    different repositories.
+
+    Only the report for the last commit of a branch or PR is generated.
     """
 
     # This is here to help with testing
@@ -161,18 +712,51 @@ class ReportGenerator(Process):
 
     def __init__(
             self, github_token=None, url=None, codecov_tokens={},
-            time_to_wait=200):
+            time_to_wait=200, workers=1, worktree_cache_size=10,
+            job_store=None, expected_builders=None, analysis_cache=None,
+            index=None, metrics_path=None, trace=False, profile=False):
         self.queue = Queue()
-        self._to_be_generated = {}
+        self.index = index
+        self.metrics = Metrics()
+        self.metrics_path = metrics_path
+        # Write the trace and the profile of each report next to it.
+        self.trace = trace
+        self.profile = profile
+        self.analysis_cache = analysis_cache
+        self.changed_lines = ChangedLinesCache()
+        self.expected_builders = expected_builders or {}
+        self.job_store = job_store
+        self.worktrees = WorktreeCache(
+            worktree_cache_size, log=self.log_message)
+        self._to_be_generated = DebounceScheduler()
+        # Repositories with a report being generated.
+        self._running = set()
+        # Due reports waiting for the report of the same repository.
+        self._waiting = {}
+        # The last commit queued for each branch and PR of a repository.
+        self._heads = {}
+        # Maps the commits superseded by a newer commit of their branch or
+        # PR to the time of the job superseding them.
+        self._superseded = OrderedDict()
+        # Events set to cancel the reports in progress.
+        self._cancel_events = {}
+        self._workers = workers
+        self._pool = None
         self._stop = False
         self._time_to_wait = time_to_wait
         self.url = url
         self.codecov_tokens = codecov_tokens
+        self.codecov = None
         self.github = None
 
+        if codecov_tokens:
+            self.codecov = CodecovUploader(
+                log=self.log_message, metrics=self.metrics)
+
         if github_token:
             self.github_base_url = 'https://%s@github.com' % github_token
-            self.github = Github(github_token)
+            self.github = StatusOutbox(
+                github_token, log=self.log_message, metrics=self.metrics)
 
         super(ReportGenerator, self).__init__()
 
@@ -196,56 +780,13 @@ class ReportGenerator(Process):
                 day, self.monthname[month], year, hh, mm, ss)
         return s
 
-    def cloneGitRepo(self, repo, path, commit):
-        """
-        Clone a repository `repo` from github into `path` and
-        checkout the revision `commit`.
-        """
-        # Check if we have already cloned this repository,
-        # if not, we clone it from github.
-        if not os.path.exists(path):
-            self.log_message(
-                'Cloning git repository %s/%s to %s',
-                self.github_base_url, repo, path)
-            git_repo = Repo.clone_from(
-                '%s/%s' % (self.github_base_url, repo), path)
-        else:
-            self.log_message('Checking out master branch in %s', path)
-            git_repo = Repo(path)
-            git_repo.head.reference = git_repo.refs['master']
-            git_repo.head.reset(index=True, working_tree=True)
-
-        self.log_message('Git pull')
-        git_repo.remote().pull()
-
-        # Checkout the commit
-        self.log_message('Checking out commit: %s', commit)
-        git_commit = git_repo.commit(commit)
-        git_repo.head.reference = git_commit
-        git_repo.head.reset(index=True, working_tree=True)
-
     def notifyGithub(
             self, repo, commit, coverage_total=None, coverage_diff=None):
         """
         Creates a commit status on github to report the coverage results.
-        """
-        repo_url = repo
-        if repo_url.endswith('.git'):
-            repo_url = repo_url[:-4]
-        github_commit = self.github.get_repo(repo_url).get_commit(commit)
-
-        # status_total = 'pending'
-        # status_total_msg = 'Waiting for status to be reported'
-        # if coverage_total is not None:
-        #     status_total = 'failure'
-        #     status_total_msg = 'Coverage is %.2f%%' % coverage_total
-        # github_commit.create_status(
-        #         status_total,
-        #         '%s/%s/commit/%s' % (
-        #             self.url, repo, commit),
-        #         status_total_msg,
-        #         'coverator/project')
 
+        The status is queued and sent by the outbox thread.
+        """
         status_diff = 'pending'
         status_diff_msg = 'Waiting for status to be reported'
         if coverage_diff is not None:
@@ -254,35 +795,51 @@ class ReportGenerator(Process):
             if coverage_diff == 100:
                 status_diff = 'success'
 
-        github_commit.create_status(
+        self.github.post(
+            repo,
+            commit,
             status_diff,
             '%s/%s/commit/%s/diff-cover.html' % (
                 self.url, repo, commit),
             status_diff_msg,
             'coverator/project/diff')
 
-    def publishToCodecov(self, token, commit_path, branch, pr):
+    def publishToCodecov(
+            self, token, commit_path, commit, branch, pr, git_repo_path):
         """
         Publish a XML report to codecov.io.
-        """
-        args = ['codecov', '--build', 'coverator',
-                '--file', os.path.join(commit_path, 'coverage.xml'),
-                '-t', token]
 
-        if branch:
-            # We know the branch name from the env.
-            args.extend(['--branch', branch])
-
-        if pr:
-            # We are publishing for a PR.
-            args.extend(['--pr', pr])
-
-        call(args)
+        The report is queued and uploaded by the codecov uploader thread,
+        with the files from `git_repo_path`, the checkout of the reported
+        commit.
+        """
+        self.codecov.upload(
+            token,
+            os.path.join(commit_path, 'coverage.xml'),
+            commit,
+            branch=branch,
+            pr=pr,
+            git_repo_path=git_repo_path,
+            )
+
+    def diffCover(self, xml_report, combiner, changed, commit_path):
+        """
+        Generate the diff-cover HTML report for the `changed` lines and
+        return the percentage of covered lines.
+        """
+        output = os.path.join(commit_path, 'diff-cover.html')
+        result = diff_coverage(xml_report, combiner, changed, output=output)
+        _write_compressed(output)
+        return result
 
     def generateReport(self, base_path, repository, commit, branch, pr):
         """
         Combine coverage data files, generate XML report and send to
         codecov.io.
+
+        All the steps use explicit paths and the data is combined in
+        memory, so reports can be generated concurrently from the same
+        process.
         """
 
         # The path to save the reports
@@ -290,169 +847,433 @@ class ReportGenerator(Process):
         git_repo_path = os.path.join(base_path, repository, 'git-repo')
 
         # This check is here to help with testing
-        if self.github_base_url is not None:  # pragma: no cover
+        if self.github_base_url is not None:
             # self.notifyGithub(repository, commit)
-            self.cloneGitRepo(repository, git_repo_path, commit)
-
-        # Coverage.py will delete the coverage data files when
-        # combining them. We don't want that, so let's copy to a
-        # temporary dir first.
-        tempdir = tempfile.mkdtemp(dir=tempfile.gettempdir())
-        coverage_files = glob.glob(
-            os.path.join(path, '%s*' % COVERAGE_DATA_PREFIX))
-        self.log_message('Copying files to %s', tempdir)
-        for coverage_file in coverage_files:
-            shutil.copy(coverage_file, tempdir)
-
-        # Save actual path and move to the cloned repository
-        old_path = os.getcwd()
-        os.chdir(os.path.join(git_repo_path))
+            with self._stage('checkout'):
+                git_repo_path = self.worktrees.checkout(
+                    '%s/%s' % (self.github_base_url, repository),
+                    os.path.join(base_path, repository),
+                    commit)
+
+        self._checkCancelled(repository, commit)
+        self.log_message('Starting to combine coverage files...')
+
+        with self._stage('combine'):
+            # The data files are merged as they are uploaded, so here we
+            # only need to map the paths from the builders to the git
+            # repository, using the [paths] aliases from the checkout.
+            coverage_config = read_coverage_config(git_repo_path)
+            aliases = PathAliases.fromConfig(coverage_config, git_repo_path)
+            combiner = CoverageCombiner(aliases)
+            state_path = os.path.join(path, COVERAGE_STATE_FILE)
+            if os.path.exists(state_path):
+                combiner.update(CoverageCounter.load(state_path).toRaw())
+            else:
+                # Files uploaded before the running state was introduced.
+                for coverage_file in glob.glob(
+                        os.path.join(path, '%s*' % COVERAGE_DATA_PREFIX)):
+                    combiner.updateFromFile(coverage_file)
+
+        changed = {}
+        if self.github is not None:  # pragma: no cover
+            # The changes from master are known before the XML report, so
+            # it keeps the lines of the changed files for diff-cover.
+            # They are cached by merge base and commit, so they are reused
+            # when the report is generated again for the same commit.
+            with self._stage('changed_lines'):
+                changed = self.changed_lines.changedLines(
+                    git_repo_path, commit)
+
+        self._checkCancelled(repository, commit)
+        self.log_message('Files combined, generating xml report.')
+        with self._stage('xml'):
+            xml_report = XmlReport(
+                git_repo_path, coverage_config, self.analysis_cache)
+            coverage_total = xml_report.write(
+                combiner, os.path.join(path, 'coverage.xml'),
+                keep=[os.path.join(xml_report.root, name)
+                      for name in changed])
+            _write_compressed(os.path.join(path, 'coverage.xml'))
+
+        self.log_message(
+            'XML file created at %s', os.path.join(path, 'coverage.xml'))
+        if self.analysis_cache is not None:
+            self.log_message(
+                'Analysis cache hits: %d, misses: %d',
+                self.analysis_cache.hits, self.analysis_cache.misses)
+
+        self._checkCancelled(repository, commit)
+
+        coverage_diff = None
+        if self.github is not None:  # pragma: no cover
+            # Generate the diff-coverage report.
+            self.log_message('Generating diff-cover')
+            with self._stage('diff_cover'):
+                coverage_diff = self.diffCover(
+                    xml_report, combiner, changed, path)
+            self.log_message(
+                'Diff-cover generated, now notifying github.')
+            self.notifyGithub(
+                repository, commit, None, coverage_diff)
+
+            codecov_token = self.codecov_tokens.get(repository, None)
+            if codecov_token:
+                self.log_message('Publishing to codecov.io')
+                with self._stage('codecov'):
+                    self.publishToCodecov(
+                        codecov_token, path, commit, branch, pr,
+                        git_repo_path)
+
+        if self.index is not None:
+            self.index.setCoverage(
+                repository, commit, coverage_total, coverage_diff)
 
+    @contextmanager
+    def _stage(self, name):
+        """
+        Measure the report stage `name`, and record it in the trace.
+        """
+        with self.metrics.time('coverator_report_stage_seconds', stage=name):
+            with span(name):
+                yield
+
+    def _saveMetrics(self):
+        """
+        Save the metrics of the reports, with the state of the queue and
+        the counters of the caches and notifiers, for the HTTP server.
+        """
+        if self.metrics_path is None:
+            return
+
+        metrics = self.metrics
+        metrics.set('coverator_reports_scheduled', len(self._to_be_generated))
+        metrics.set('coverator_reports_waiting', sum(
+            len(jobs) for jobs in self._waiting.values()))
+        metrics.set('coverator_reports_running', len(self._cancel_events))
+        for name, cache in (
+                ('analysis', self.analysis_cache),
+                ('changed_lines', self.changed_lines),
+                ):
+            if cache is None:
+                continue
+            metrics.set(
+                'coverator_cache_hits_total', cache.hits, COUNTER,
+                cache=name)
+            metrics.set(
+                'coverator_cache_misses_total', cache.misses, COUNTER,
+                cache=name)
+        if self.github is not None:
+            for result in ('sent', 'failed'):
+                metrics.set(
+                    'coverator_github_statuses_total',
+                    getattr(self.github, result), COUNTER, result=result)
+        if self.codecov is not None:
+            for result in ('uploaded', 'failed', 'retried'):
+                metrics.set(
+                    'coverator_codecov_uploads_total',
+                    getattr(self.codecov, result), COUNTER, result=result)
+        metrics.set('coverator_snapshot_timestamp_seconds', time.time())
         try:
-            self.log_message('Starting to combine coverage files...')
-            combined_coverage_file = os.path.join(
-                path, COVERAGE_DATA_PREFIX[:-1])
-            env = os.environ.copy()
-            env['COVERAGE_FILE'] = combined_coverage_file
-
-            # FIXME:4516:
-            # We call coverage combine three times, one for non-windows
-            # generated files, one for windows generated files and
-            # one for combine the two calls.
-            args = ['coverage', 'combine']
-            non_win_files = [
-                    f for f in glob.glob('%s/*' % tempdir)
-                    if 'win' not in f]
-            if non_win_files:
-                self.log_message('Combining non-windows files.')
-                call(args + non_win_files, env=env)
-
-            win_files = glob.glob('%s/*win*' % tempdir)
-            if win_files:
-                env['COVERAGE_FILE'] = '%s.win' % (
-                    combined_coverage_file)
-                self.log_message('Combining windows files.')
-                call(args + win_files, env=env)
-
-                # Manually replace the windows path for linux path
-                windows_file = open('%s.win' % combined_coverage_file)
-                content = windows_file.read()
-                windows_file.close()
-                new_content = content.replace('\\\\', '/')
-                windows_file = open('%s.win' % combined_coverage_file, 'w')
-                windows_file.write(new_content)
-                windows_file.close()
+            metrics.save(self.metrics_path)
+        except EnvironmentError as error:
+            self.log_message('Failed to save the metrics: %s', error)
 
-                self.log_message(
-                    'Merging windows and non-windows files.')
-                env['COVERAGE_FILE'] = combined_coverage_file
-                call([
-                    'coverage',
-                    'combine',
-                    '-a',
-                    '%s.win' % combined_coverage_file
-                    ], env=env)
-
-            shutil.rmtree(tempdir)
-
-            self.log_message('Files combined, generating xml report.')
-            call([
-                'coverage',
-                'xml',
-                '-o',
-                os.path.join(path, 'coverage.xml'),
-                ], env=env)
-
-            # Delete the data file after the xml file is generated.
-            os.remove(combined_coverage_file)
+    def queueReport(self, job):
+        """
+        Called from the HTTP server to request a report.
 
-            self.log_message(
-                'XML file created at %s',
-                os.path.join(path, 'coverage.xml'))
-
-            if self.github is not None:  # pragma: no cover
-                # Generate the diff-coverage report.
-                from diff_cover.tool import generate_coverage_report
-                from diff_cover.git_path import GitPathTool
-                GitPathTool.set_cwd(os.getcwd())
-                self.log_message('Generating diff-cover')
-                coverage_diff = generate_coverage_report(
-                    [os.path.join(path, 'coverage.xml')],
-                    'master',
-                    os.path.join(path, 'diff-cover.html'))
-                self.log_message(
-                    'Diff-cover generated, now notifying github.')
-                self.notifyGithub(
-                    repository, commit, None, coverage_diff)
+        The job is saved before being sent to the consumer process, so it
+        is not lost if the server is restarted. The queued status of the
+        report is recorded in the index by the upload requesting it.
+        """
+        if self.job_store is not None:
+            self.job_store.add(job)
+        self.queue.put(job)
 
-                codecov_token = self.codecov_tokens.get(repository, None)
-                if codecov_token:
-                    self.log_message('Publishing to codecov.io')
-                    self.publishToCodecov(
-                        codecov_token, path, branch, pr)
+    def _setReportStatus(self, repository, commit, status):
+        """
+        Record the status of the report for `commit` in the index.
+        """
+        if self.index is not None:
+            self.index.setReportStatus(repository, commit, status)
 
-        finally:
-            os.chdir(old_path)
+    def _resumeReports(self):
+        """
+        Schedule the reports which were pending when the server stopped.
+        """
+        if self.job_store is None:
+            return
+
+        for job in self.job_store.pending():
+            self.log_message('Resuming report for: %s', job)
+            self._scheduleReport(job)
 
     def run(self):
         """
         Main process loop.
         """
-        while True:
-            try:
-                self._processQueue()
-            except KeyboardInterrupt:
-                self.log_message('Exiting consumer process.')
-                break
-            except Exception:
-                print('Exception in consumer process:', sys.exc_info())
-            finally:
-                self.log_message('Queue task done.')
+        self._resumeReports()
+        for notifier in (self.github, self.codecov):
+            if notifier is not None:
+                notifier.start()
+        self._pool = ThreadPool(self._workers)
+        try:
+            while True:
+                try:
+                    self._processQueue()
+                except KeyboardInterrupt:
+                    self.log_message('Exiting consumer process.')
+                    break
+                except Exception:
+                    print('Exception in consumer process:', sys.exc_info())
+                finally:
+                    self._saveMetrics()
+                    self.log_message('Queue task done.')
+        finally:
+            self._pool.close()
+            self._pool.join()
+            for notifier in (self.github, self.codecov):
+                if notifier is not None:
+                    notifier.stop()
 
-    def _processQueue(self):
+    def _generateReportSafe(self, job):
         """
-        Execute tasks from the queue.
+        Generate a report from a thread of the report pool.
+
+        Return the repository of the report, even when the report or the
+        update of its status failed, as the pool has no error callback and
+        the next reports of the repository wait for this one.
         """
-        wait = 100000
+        base_path, repo, commit, branch, pr, tstamp = job
+        status = REPORT_DONE
+        start = time.time()
         try:
-            value = self.queue.get(True, wait)
+            self._setReportStatus(repo, commit, REPORT_RUNNING)
+            self._generateProfiled(base_path, repo, commit, branch, pr)
+        except ReportCancelled:
+            self.log_message('Report cancelled for %s:%s', repo, commit)
+            status = REPORT_CANCELLED
+        except Exception:
+            self.log_message(
+                'Failed to generate report for %s:%s: %s',
+                repo, commit, traceback.format_exc())
+            status = REPORT_FAILED
 
-            if value is None:
-                self.log_message('Received signal to stop.')
-                self._stop = True
-            else:
-                self.log_message('New value from queue: %s', value)
-                key = "%s:%s" % (value[1], value[2])
-                self._to_be_generated[key] = value
-                wait = 1
-        except Empty:
+        self.metrics.observe('coverator_report_seconds', time.time() - start)
+        self.metrics.inc('coverator_reports_total', result=status)
+        self._cancel_events.pop(JobStore.key(repo, commit), None)
+        try:
+            self._setReportStatus(repo, commit, status)
+            if self.job_store is not None:
+                self.job_store.remove(repo, commit, tstamp)
+        except Exception:
             self.log_message(
-                'Queue is empty, check reports to be generated: %s' %
-                self._to_be_generated)
-            if len(self._to_be_generated) == 0:
-                if self._stop:
-                    # Means there is nothing else to consume.
-                    self.log_message(
-                        'Nothing to consume, exiting process.')
-                    raise KeyboardInterrupt()
-                wait = 100000
-                return
+                'Failed to record the report for %s:%s: %s',
+                repo, commit, traceback.format_exc())
+        return repo
 
-            first_in_queue = min(
-                self._to_be_generated.items(), key=lambda v: v[1][-1])
-            when = first_in_queue[1][-1] + self._time_to_wait
+    def _generateProfiled(self, base_path, repo, commit, branch, pr):
+        """
+        Generate the report, writing its trace and its profile next to the
+        report when enabled, even when the report failed.
+        """
+        trace = None
+        if self.trace:
+            trace = Trace(JobStore.key(repo, commit))
+        profiler = None
+        if self.profile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            with activate(trace), span('report', repo=repo, commit=commit):
+                self.generateReport(base_path, repo, commit, branch, pr)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            commit_path = os.path.join(base_path, repo, 'commit', commit)
+            try:
+                if trace is not None:
+                    trace.write(os.path.join(commit_path, TRACE_FILE))
+                if profiler is not None:
+                    profiler.dump_stats(
+                        os.path.join(commit_path, PROFILE_FILE))
+            except EnvironmentError as error:
+                self.log_message(
+                    'Failed to write the profile for %s:%s: %s',
+                    repo, commit, error)
 
-            if time.time() >= when:
-                data = self._to_be_generated.pop(
-                    first_in_queue[0])
+    def _checkCancelled(self, repository, commit):
+        """
+        Raise ReportCancelled if the report in progress for `commit` was
+        superseded by a newer commit.
+        """
+        event = self._cancel_events.get(JobStore.key(repository, commit))
+        if event is not None and event.is_set():
+            raise ReportCancelled(repository, commit)
 
-                self.log_message('Ready to generate report for: %s', data)
-                base_path, repo, commit, branch, pr, tstamp = data
-                self.generateReport(base_path, repo, commit, branch, pr)
-                wait = 1
+    def _reportDone(self, repository):
+        """
+        Called from the report pool when a report for `repository`
+        was generated.
+        """
+        self.queue.put((JOB_DONE, repository))
+
+    def _cancelReport(self, key, tstamp):
+        """
+        Cancel the pending or running report for the commit with `key`,
+        superseded by a job queued at `tstamp`.
+
+        The jobs for this commit queued before `tstamp` are ignored.
+        """
+        self.log_message('Cancelling superseded report: %s', key)
+        self._superseded.pop(key, None)
+        self._superseded[key] = tstamp
+        while len(self._superseded) > MAXIMUM_SUPERSEDED:
+            self._superseded.popitem(last=False)
+
+        repo = key.rsplit(':', 1)[0]
+        job = self._to_be_generated.cancel(key)
+        if job is None and key in self._waiting.get(repo, {}):
+            job = self._waiting[repo].pop(key)
+        if job is not None:
+            self._setReportStatus(repo, job[2], REPORT_CANCELLED)
+            if self.job_store is not None:
+                self.job_store.remove(repo, job[2], job[-1])
+
+        event = self._cancel_events.get(key)
+        if event is not None:
+            event.set()
+
+    def _supersede(self, job):
+        """
+        Cancel the reports for the previous commits of the branch and of
+        the PR of `job`.
+
+        Return False if the commit of `job` was superseded by a job queued
+        after `job`.
+
+        As in the index, the head is the commit with the last upload, so a
+        job queued later for a superseded commit, for example from a late
+        builder or after a revert, makes it the head again. Its report is
+        generated, but the reports of the commits which superseded it are
+        not cancelled.
+        """
+        base_path, repo, commit, branch, pr, tstamp = job
+        key = JobStore.key(repo, commit)
+        superseded = self._superseded.get(key)
+        if superseded is not None and tstamp <= superseded:
+            self.log_message('Ignoring superseded commit: %s', key)
+            return False
+
+        for kind, name in (('branch', branch), ('pr', pr)):
+            if name is None:
+                continue
+            previous = self._heads.get((repo, kind, name))
+            self._heads[(repo, kind, name)] = key
+            if superseded is None and previous not in (None, key):
+                self._cancelReport(previous, tstamp)
+        return True
+
+    def _scheduleReport(self, job):
+        """
+        Schedule the report for `job` after the debounce time, replacing
+        the pending report for the same commit. The report is scheduled
+        right away when all the expected builders have uploaded.
+
+        Pending and running reports for older commits of the same branch
+        or PR are cancelled.
+        """
+        if not self._supersede(job):
+            self._setReportStatus(job[1], job[2], REPORT_CANCELLED)
+            if self.job_store is not None:
+                self.job_store.remove(job[1], job[2], job[-1])
+            return
+
+        base_path, repo, commit, branch, pr, tstamp = job
+        key = JobStore.key(repo, commit)
+        waiting = self._waiting.get(repo)
+        if waiting:
+            waiting.pop(key, None)
+
+        when = tstamp + self._time_to_wait
+        if has_all_builders(
+                self.expected_builders, repo,
+                os.path.join(base_path, repo, 'commit', commit)):
+            # No need to wait for other uploads.
+            self.log_message('All builders uploaded for: %s', key)
+            when = tstamp
+        self._to_be_generated.schedule(key, when, job)
+
+    def _startReport(self, job):
+        """
+        Start generating the report for `job` in the pool.
+        """
+        self._running.add(job[1])
+        self._cancel_events[JobStore.key(job[1], job[2])] = threading.Event()
+        self.log_message('Ready to generate report for: %s', job)
+        self._pool.apply_async(
+            self._generateReportSafe, (job,), callback=self._reportDone)
+
+    def _startReports(self):
+        """
+        Start generating the reports which are due, at most one at a time
+        for each repository, as they share the git checkout.
+
+        Due reports for a busy repository wait for its current report.
+
+        Return the number of seconds until the next report is due, or None
+        if no report is scheduled.
+        """
+        now = time.time()
+        for key, job in self._to_be_generated.popDue(now):
+            repo = job[1]
+            if repo in self._running:
+                self._waiting.setdefault(repo, OrderedDict())[key] = job
             else:
-                wait = when - time.time()
-                self.log_message('Wait time for next report: %f' % wait)
+                self._startReport(job)
+
+        when = self._to_be_generated.nextTime()
+        if when is None:
+            self.log_message('No report scheduled.')
+            return None
+
+        wait = max(0, when - now)
+        self.log_message('Wait time for next report: %f' % wait)
+        return wait
+
+    def _processQueue(self):
+        """
+        Start the reports which are due and handle the next value from
+        the queue.
+        """
+        wait = self._startReports()
+        try:
+            value = self.queue.get(True, wait)
+        except Empty:
+            return
+
+        if value is None:
+            self.log_message('Received signal to stop.')
+            self._stop = True
+        elif value[0] == JOB_DONE:
+            repo = value[1]
+            self.log_message('Report done for: %s', repo)
+            self._running.discard(repo)
+            waiting = self._waiting.get(repo)
+            if waiting:
+                key, job = waiting.popitem(last=False)
+                if not waiting:
+                    del self._waiting[repo]
+                self._startReport(job)
+        else:
+            self.log_message('New value from queue: %s', value)
+            self._scheduleReport(value)
+
+        if (self._stop and not self._to_be_generated and
+                not self._waiting and not self._running):
+            # Means there is nothing else to consume.
+            self.log_message('Nothing to consume, exiting process.')
+            raise KeyboardInterrupt()
 
 
 def main():  # pragma: no cover
@@ -468,7 +1289,19 @@ def main():  # pragma: no cover
 
     args = parser.parse_args(sys.argv[1:])
 
-    config = SafeConfigParser({'github_token': None})
+    config = SafeConfigParser({
+        'github_token': None,
+        'workers': '8',
+        'max_upload_size': '%d' % (CoveratorHandler.MAX_UPLOAD_SIZE,),
+        'report_workers': '1',
+        'worktree_cache_size': '10',
+        'analysis_cache_size': '100000',
+        'symlinks': 'true',
+        'trace_reports': 'false',
+        'profile_reports': 'false',
+        })
+    # Keep the case of the repository names.
+    config.optionxform = str
     config.read(args.config)
 
     github_token = config.get('server', 'github_token')
@@ -480,28 +1313,68 @@ def main():  # pragma: no cover
         repo, tok = token.split(':')
         codecov_tokens[repo.strip()] = tok.strip()
 
+    # The builders expected for each repository, as
+    # `repository = builder1, builder2`.
+    expected_builders = {}
+    if config.has_section('expected_builders'):
+        for repo in config.options('expected_builders'):
+            if repo in config.defaults():
+                continue
+            builders = config.get('expected_builders', repo).split(',')
+            expected_builders[repo] = set(
+                builder.strip() for builder in builders if builder.strip())
+
     path = config.get('server', 'path')
 
     CoveratorHandler.PATH = os.path.abspath(path)
     CoveratorHandler.MINIMUM_FILES = config.getint(
         'server', 'min_buildslaves')
+    CoveratorHandler.MAX_UPLOAD_SIZE = config.getint(
+        'server', 'max_upload_size')
+    CoveratorHandler.EXPECTED_BUILDERS = expected_builders
+    CoveratorHandler.SYMLINKS = config.getboolean('server', 'symlinks')
+    index = MetadataIndex(
+        os.path.join(CoveratorHandler.PATH, STATE_DIR, 'index.sqlite'))
+    CoveratorHandler.INDEX = index
+    CoveratorHandler.API = JsonApi(index)
+    metrics_path = os.path.join(
+        CoveratorHandler.PATH, STATE_DIR, 'metrics.json')
+    CoveratorHandler.METRICS_SNAPSHOT = metrics_path
 
     time_to_wait = config.getint(
         'server', 'seconds_before_generate_report')
+    analysis_cache = None
+    analysis_cache_size = config.getint('server', 'analysis_cache_size')
+    if analysis_cache_size > 0:
+        analysis_cache = AnalysisCache(
+            os.path.join(CoveratorHandler.PATH, STATE_DIR, 'analysis.sqlite'),
+            analysis_cache_size)
 
     CoveratorHandler.report_generator = ReportGenerator(
-        github_token, coverator_url, codecov_tokens, time_to_wait)
+        github_token, coverator_url, codecov_tokens, time_to_wait,
+        workers=config.getint('server', 'report_workers'),
+        worktree_cache_size=config.getint('server', 'worktree_cache_size'),
+        job_store=JobStore(os.path.join(
+            CoveratorHandler.PATH, STATE_DIR, 'jobs.sqlite')),
+        expected_builders=expected_builders,
+        analysis_cache=analysis_cache,
+        index=index,
+        metrics_path=metrics_path,
+        trace=config.getboolean('server', 'trace_reports'),
+        profile=config.getboolean('server', 'profile_reports'))
     CoveratorHandler.report_generator.start()
 
-    server = HTTPServer(
+    server = PooledHTTPServer(
         ('', config.getint('server', 'port')),
-        CoveratorHandler)
+        CoveratorHandler,
+        workers=config.getint('server', 'workers'))
 
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         pass
     finally:
+        server.server_close()
         # Stops the report generator process
         CoveratorHandler.report_generator.queue.put(None)
 
@@ -0,0 +1,176 @@
+from coverage.config import CoverageConfig
+from coverator.analysis import AnalysisCache, SourceAnalysis, git_blobs
+
+from os import path as osp
+from unittest import TestCase
+
+import git
+import shutil
+import tempfile
+
+
+SOURCE = """\
+def check(value):
+    if value:
+        return 1
+    return (
+        2)
+"""
+
+
+class TestSourceAnalysis(TestCase):
+    """
+    Tests for SourceAnalysis.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = osp.join(self.tempdir, 'source.py')
+        with open(self.path, 'w') as stream:
+            stream.write(SOURCE)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_lines(self):
+        """
+        Executed lines from multi-line statements are reported on the
+        first line of the statement.
+        """
+        sut = SourceAnalysis.fromFile(self.path, CoverageConfig())
+
+        result = sut.lines([1, 2, 5])
+
+        self.assertEqual(
+            [(1, 1, None), (2, 1, None), (3, 0, None), (4, 1, None)], result)
+
+    def test_lines_branches(self):
+        """
+        With arcs, the branch lines have the number of exits taken and
+        the missing exits.
+        """
+        sut = SourceAnalysis.fromFile(
+            self.path, CoverageConfig(), has_arcs=True)
+
+        result = sut.lines([1, 2, 4], [(-1, 1), (1, -1), (2, 4), (4, -1)])
+
+        self.assertEqual((2, 1, [3]), result[1][2])
+
+    def test_excluded(self):
+        """
+        Lines excluded in the configuration are not statements.
+        """
+        config = CoverageConfig()
+        config.exclude_list.append('return 1')
+
+        sut = SourceAnalysis.fromFile(self.path, config)
+
+        self.assertEqual(set([1, 2, 4]), sut.statements)
+        self.assertEqual(set([3]), sut.excluded)
+
+    def test_toRaw(self):
+        """
+        The analysis can be created back from its raw form.
+        """
+        sut = SourceAnalysis.fromFile(
+            self.path, CoverageConfig(), has_arcs=True)
+
+        result = SourceAnalysis.fromRaw(sut.toRaw())
+
+        self.assertEqual(sut.toRaw(), result.toRaw())
+        self.assertEqual(
+            sut.lines([1, 2], [(-1, 1), (2, 3)]),
+            result.lines([1, 2], [(-1, 1), (2, 3)]))
+
+
+class TestAnalysisCache(TestCase):
+    """
+    Tests for AnalysisCache.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.analysis = SourceAnalysis(
+            statements=set([1, 2]), multiline={}, arcs=set(),
+            exit_counts={}, no_branch=set())
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_load_store(self):
+        """
+        Stored analyses are loaded back, counting the hits and misses.
+        """
+        sut = AnalysisCache(osp.join(self.tempdir, 'cache.sqlite'))
+        sut.store({'blob-1': self.analysis})
+
+        result = sut.load(['blob-1', 'blob-2'])
+
+        self.assertEqual(['blob-1'], list(result))
+        self.assertEqual(set([1, 2]), result['blob-1'].statements)
+        self.assertEqual(1, sut.hits)
+        self.assertEqual(1, sut.misses)
+
+    def test_evict(self):
+        """
+        The least recently used entries are removed when there are more
+        than the size of the cache.
+        """
+        sut = AnalysisCache(osp.join(self.tempdir, 'cache.sqlite'), size=2)
+        sut.store({'blob-1': self.analysis})
+        sut.store({'blob-2': self.analysis})
+        sut.load(['blob-1'])
+
+        sut.store({'blob-3': self.analysis})
+
+        self.assertEqual(2, len(sut))
+        self.assertEqual(
+            set(['blob-1', 'blob-3']),
+            set(sut.load(['blob-1', 'blob-2', 'blob-3'])))
+
+    def test_key(self):
+        """
+        The key depends on the exclusion rules and on the arcs.
+        """
+        config = CoverageConfig()
+        key = AnalysisCache.key('blob', config, False)
+
+        self.assertNotEqual(key, AnalysisCache.key('blob', config, True))
+        config.exclude_list.append('pragma: no branch')
+        self.assertNotEqual(key, AnalysisCache.key('blob', config, False))
+
+    def test_git_blobs(self):
+        """
+        The blob SHA of the files are listed by absolute path.
+        """
+        path = osp.join(self.tempdir, 'source.py')
+        with open(path, 'w') as stream:
+            stream.write(SOURCE)
+        repo = git.Repo.init(self.tempdir)
+        repo.index.add([path])
+        repo.index.commit('initial')
+
+        result = git_blobs(self.tempdir)
+
+        self.assertEqual({path: repo.head.commit.tree['source.py'].hexsha},
+                         result)
+
+    def test_git_blobs_worktree(self):
+        """
+        The blob SHA are listed for the worktrees used for the reports.
+        """
+        source_path = osp.join(self.tempdir, 'source')
+        repo = git.Repo.init(source_path)
+        with open(osp.join(source_path, 'source.py'), 'w') as stream:
+            stream.write(SOURCE)
+        repo.index.add([osp.join(source_path, 'source.py')])
+        repo.index.commit('initial')
+        worktree_path = osp.join(self.tempdir, 'worktree')
+        repo.git.worktree('add', '--detach', worktree_path, 'HEAD')
+
+        result = git_blobs(worktree_path)
+
+        self.assertEqual(
+            {osp.join(worktree_path, 'source.py'):
+             repo.head.commit.tree['source.py'].hexsha},
+            result)
@@ -0,0 +1,103 @@
+from coverator.api import JsonApi
+from coverator.index import MetadataIndex
+
+from os import path as osp
+from unittest import TestCase
+
+import json
+import shutil
+import tempfile
+
+
+class TestJsonApi(TestCase):
+    """
+    Tests for JsonApi.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.index = MetadataIndex(osp.join(self.tempdir, 'index.sqlite'))
+        self.index.recordUpload(
+            'chevah/server', 'commit-1', 'linux', 'master', tstamp=1)
+        self.index.recordUpload(
+            'chevah/server', 'commit-2', 'linux', 'feature', '42', tstamp=2)
+        self.index.recordUpload('other', 'commit-3', 'linux', tstamp=3)
+        self.sut = JsonApi(self.index)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def get(self, path):
+        """
+        Return the status and the decoded JSON for `path`.
+        """
+        code, body = self.sut.handle(path)
+        return code, json.loads(body)
+
+    def test_repos(self):
+        """
+        The repositories are listed by pages.
+        """
+        self.assertEqual((200, {
+            'items': [{'name': 'other'}],
+            'page': 2,
+            'per_page': 1,
+            'total': 2,
+            }), self.get('/api/repos?page=2&per_page=1'))
+
+    def test_branches_prs(self):
+        """
+        The branches and PRs are listed with their head commit.
+        """
+        code, result = self.get('/api/repos/chevah/server/branches')
+
+        self.assertEqual(200, code)
+        self.assertEqual(
+            [('feature', 'commit-2'), ('master', 'commit-1')],
+            [(item['name'], item['head']) for item in result['items']])
+        code, result = self.get('/api/repos/chevah%2Fserver/prs')
+        self.assertEqual(
+            [('42', 'commit-2')],
+            [(item['name'], item['head']) for item in result['items']])
+
+    def test_commits(self):
+        """
+        The commits are listed the last one first, with their coverage,
+        for the repository, a branch or a PR.
+        """
+        self.index.setCoverage('chevah/server', 'commit-1', 75.0)
+
+        code, result = self.get('/api/repos/chevah/server/commits')
+
+        self.assertEqual(200, code)
+        self.assertEqual(2, result['total'])
+        self.assertEqual(
+            [('commit-2', None), ('commit-1', 75.0)],
+            [(item['commit'], item['coverage_total'])
+             for item in result['items']])
+        code, result = self.get('/api/repos/chevah/server/commits?pr=42')
+        self.assertEqual(
+            ['commit-2'], [item['commit'] for item in result['items']])
+
+    def test_errors(self):
+        """
+        Unknown resources and invalid pagination arguments are errors.
+        """
+        self.assertEqual(404, self.get('/api/unknown')[0])
+        self.assertEqual(404, self.get('/api/repos/other/tags')[0])
+        self.assertEqual(400, self.get('/api/repos?page=0')[0])
+        self.assertEqual(400, self.get('/api/repos?per_page=all')[0])
+
+    def test_cache(self):
+        """
+        The responses are cached until the index is changed.
+        """
+        first = self.get('/api/repos')
+        self.assertEqual(first, self.get('/api/repos'))
+        self.assertEqual((1, 1), (self.sut.hits, self.sut.misses))
+
+        self.index.recordUpload('new', 'commit-4', 'linux')
+        code, result = self.get('/api/repos')
+
+        self.assertEqual((1, 2), (self.sut.hits, self.sut.misses))
+        self.assertEqual(3, result['total'])
@@ -0,0 +1,101 @@
+from coverator.checkout import WorktreeCache
+
+from os import path as osp
+from unittest import TestCase
+
+import git
+import os
+import shutil
+import tempfile
+
+
+class TestWorktreeCache(TestCase):
+    """
+    Tests for WorktreeCache, using a local repository as upstream.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.upstream_path = osp.join(self.tempdir, 'upstream')
+        self.repository_path = osp.join(self.tempdir, 'storage', 'repo')
+        os.makedirs(self.repository_path)
+        self.upstream = git.Repo.init(self.upstream_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def commit(self, content):
+        """
+        Commit a new version of `file.txt` to the upstream repository.
+        """
+        path = osp.join(self.upstream_path, 'file.txt')
+        with open(path, 'w') as stream:
+            stream.write(content)
+        self.upstream.index.add([path])
+        return self.upstream.index.commit(content).hexsha
+
+    def test_checkout(self):
+        """
+        The commit is checked out in a worktree of a bare mirror.
+        """
+        commit = self.commit('first')
+        sut = WorktreeCache()
+
+        result = sut.checkout(self.upstream_path, self.repository_path, commit)
+
+        self.assertEqual(
+            sut.worktreePath(self.repository_path, commit), result)
+        self.assertEqual('first', open(osp.join(result, 'file.txt')).read())
+        self.assertTrue(
+            git.Repo(sut.mirrorPath(self.repository_path)).bare)
+
+    def test_checkout_fetch(self):
+        """
+        New commits are fetched in the existing mirror.
+        """
+        sut = WorktreeCache()
+        sut.checkout(
+            self.upstream_path, self.repository_path, self.commit('first'))
+        commit = self.commit('second')
+
+        result = sut.checkout(self.upstream_path, self.repository_path, commit)
+
+        self.assertEqual('second', open(osp.join(result, 'file.txt')).read())
+
+    def test_checkout_cached(self):
+        """
+        A worktree from the cache is used without fetching.
+        """
+        commit = self.commit('first')
+        sut = WorktreeCache()
+        sut.checkout(self.upstream_path, self.repository_path, commit)
+        shutil.rmtree(self.upstream_path)
+
+        result = sut.checkout(self.upstream_path, self.repository_path, commit)
+
+        self.assertEqual('first', open(osp.join(result, 'file.txt')).read())
+
+    def test_evict(self):
+        """
+        The least recently used worktrees are removed when there are more
+        than the cache size.
+        """
+        first = self.commit('first')
+        second = self.commit('second')
+        third = self.commit('third')
+        sut = WorktreeCache(size=2)
+        sut.checkout(self.upstream_path, self.repository_path, first)
+        sut.checkout(self.upstream_path, self.repository_path, second)
+        # Use the first one again, so the second one is the oldest.
+        os.utime(sut.worktreePath(self.repository_path, second), (1, 1))
+        sut.checkout(self.upstream_path, self.repository_path, first)
+
+        sut.checkout(self.upstream_path, self.repository_path, third)
+
+        self.assertEqual(
+            sorted([first, third]),
+            sorted(os.listdir(
+                osp.join(self.repository_path, WorktreeCache.WORKTREES))))
+        worktrees = git.Repo(
+            sut.mirrorPath(self.repository_path)).git.worktree('list')
+        self.assertNotIn(second, worktrees)
@@ -0,0 +1,168 @@
+from coverator.client import upload_coverage, upload_files
+from coverator.load import make_payload
+from coverator.server import CoveratorHandler, PooledHTTPServer
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from os import path as osp
+from test.test_httpservers import NoLogRequestHandler
+from unittest import TestCase
+
+import cgi
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+
+class StoreHandler(NoLogRequestHandler, CoveratorHandler):
+    """
+    Stores the uploads without generating reports.
+    """
+
+    MINIMUM_FILES = sys.maxsize
+
+
+class FailingHandler(NoLogRequestHandler, BaseHTTPRequestHandler):
+    """
+    Responds with the statuses from the `statuses` list of the server,
+    then with 200.
+    """
+
+    def do_POST(self):
+        form = cgi.FieldStorage(
+            fp=self.rfile, headers=self.headers,
+            environ={'REQUEST_METHOD': 'POST'})
+        self.server.builds.append(form.getvalue('build'))
+        status = 200
+        if self.server.statuses:
+            status = self.server.statuses.pop(0)
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class TestClient(TestCase):
+    """
+    Tests for uploading the data files.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+    def serve(self, server):
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(thread.join)
+        self.addCleanup(server.shutdown)
+        return 'http://localhost:%d/' % (server.server_address[1],)
+
+    def makePayload(self, name):
+        path = osp.join(self.tempdir, name)
+        make_payload(path, 1000)
+        return path
+
+    def test_upload_files(self):
+        """
+        The files matching the patterns are uploaded as parts of the
+        builder.
+        """
+        StoreHandler.PATH = osp.join(self.tempdir, 'storage')
+        url = self.serve(
+            PooledHTTPServer(('localhost', 0), StoreHandler, workers=2))
+        for name in ('.coverage.1', '.coverage.2', 'other.data'):
+            self.makePayload(name)
+
+        result = upload_files(
+            [osp.join(self.tempdir, '.coverage.*'),
+             osp.join(self.tempdir, 'other.data'),
+             osp.join(self.tempdir, '.coverage.1')],
+            'test/repository', 'linux', 'commit-1', url=url)
+
+        self.assertEqual(0, result)
+        self.assertEqual(
+            ['coverage.data.linux+1', 'coverage.data.linux+2',
+             'coverage.data.linux+3'],
+            sorted(name for name in os.listdir(osp.join(
+                StoreHandler.PATH, 'test', 'repository', 'commit',
+                'commit-1')) if name.startswith('coverage.data.')))
+
+    def test_upload_files_fewer(self):
+        """
+        The parts uploaded by an earlier run of the builder with more
+        files are replaced.
+        """
+        StoreHandler.PATH = osp.join(self.tempdir, 'storage')
+        url = self.serve(
+            PooledHTTPServer(('localhost', 0), StoreHandler, workers=2))
+        for name in ('.coverage.1', '.coverage.2'):
+            self.makePayload(name)
+        upload_files(
+            [osp.join(self.tempdir, '.coverage.*')],
+            'test/repository', 'linux', 'commit-1', url=url)
+
+        result = upload_files(
+            [osp.join(self.tempdir, '.coverage.1')],
+            'test/repository', 'linux', 'commit-1', url=url)
+
+        self.assertEqual(0, result)
+        self.assertEqual(
+            ['coverage.data.linux'],
+            sorted(name for name in os.listdir(osp.join(
+                StoreHandler.PATH, 'test', 'repository', 'commit',
+                'commit-1')) if name.startswith('coverage.data.')))
+
+    def test_upload_files_missing(self):
+        """
+        It fails when no file matches the patterns.
+        """
+        result = upload_files([osp.join(self.tempdir, '.coverage.*')])
+
+        self.assertEqual(1, result)
+
+    def test_upload_coverage_retries(self):
+        """
+        The upload is retried after a 5xx response, but not after a 4xx
+        response.
+        """
+        server = HTTPServer(('localhost', 0), FailingHandler)
+        server.builds = []
+        server.statuses = [503, 500]
+        url = self.serve(server)
+        path = self.makePayload('.coverage')
+
+        result = upload_coverage(
+            path, build='linux', url=url, verbose=False, retries=2,
+            backoff=0)
+
+        self.assertEqual(0, result)
+        self.assertEqual(['linux'] * 3, server.builds)
+
+        server.statuses = [503, 403]
+        result = upload_coverage(
+            path, build='linux', url=url, verbose=False, retries=2,
+            backoff=0)
+
+        self.assertEqual(403, result)
+        self.assertEqual(['linux'] * 5, server.builds)
+
+    def test_upload_files_aggregated(self):
+        """
+        The result of the first failed upload is returned, after all the
+        files were uploaded.
+        """
+        server = HTTPServer(('localhost', 0), FailingHandler)
+        server.builds = []
+        server.statuses = [400]
+        url = self.serve(server)
+        self.makePayload('.coverage.1')
+        self.makePayload('.coverage.2')
+
+        result = upload_files(
+            [osp.join(self.tempdir, '.coverage.*')], build='linux', url=url,
+            retries=0, workers=1)
+
+        self.assertEqual(400, result)
+        self.assertEqual(['linux+1', 'linux+2'], server.builds)
@@ -0,0 +1,275 @@
+from coverator.combine import (
+    CoverageCombiner,
+    CoverageCounter,
+    CoverageDataError,
+    PathAliases,
+    combine_files,
+    read_coverage_config,
+    read_data_file,
+    write_data_file,
+    )
+
+from os import path as osp
+from unittest import TestCase
+
+import gzip
+import os
+import shutil
+import tempfile
+
+
+class TestPathAliases(TestCase):
+    """
+    Tests for PathAliases.
+    """
+
+    def test_map_no_aliases(self):
+        """
+        Without aliases, paths are only normalized to forward slashes.
+        """
+        sut = PathAliases()
+
+        self.assertEqual('C:/src/test/a.py', sut.map('C:\\src\\test\\a.py'))
+        self.assertEqual('/src/test/a.py', sut.map('/src/test/a.py'))
+
+    def test_map_wildcard(self):
+        """
+        A wildcard pattern will map both POSIX and Windows paths to
+        the result, resolved against the root.
+        """
+        sut = PathAliases('/checkout')
+        sut.add('*/test', 'test/')
+        sut.add('*\\test', 'test/')
+
+        self.assertEqual(
+            '/checkout/test/a.py', sut.map('/builder/1/test/a.py'))
+        self.assertEqual(
+            '/checkout/test/a.py', sut.map('C:\\builder\\1\\test\\a.py'))
+        self.assertEqual('/other/a.py', sut.map('/other/a.py'))
+
+    def test_add_ending_wildcard(self):
+        """
+        Patterns can not end with a wildcard.
+        """
+        sut = PathAliases()
+
+        self.assertRaises(CoverageDataError, sut.add, '/src/*', 'test/')
+
+    def test_fromConfig(self):
+        """
+        The aliases are read from the [paths] section of .coveragerc.
+        """
+        datadir = osp.join(
+            os.path.dirname(os.path.realpath(__file__)), 'data')
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        shutil.copy(
+            osp.join(datadir, 'coveragerc'), osp.join(tempdir, '.coveragerc'))
+
+        sut = PathAliases.fromConfig(read_coverage_config(tempdir), tempdir)
+
+        self.assertEqual(
+            '%s/test/file.py' % tempdir,
+            sut.map('C:\\1\\chevah\\test\\file.py'))
+
+
+class TestCoverageCombiner(TestCase):
+    """
+    Tests for CoverageCombiner and the data file helpers.
+    """
+
+    def setUp(self):
+        self.datadir = osp.join(
+            os.path.dirname(os.path.realpath(__file__)), 'data')
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_read_data_file_invalid(self):
+        """
+        An error is raised for files which are not coverage data files.
+        """
+        path = osp.join(self.tempdir, 'bad')
+        with open(path, 'w') as stream:
+            stream.write('{"lines": {}}')
+
+        self.assertRaises(CoverageDataError, read_data_file, path)
+
+    def test_read_data_file_compressed(self):
+        """
+        Compressed data files are read.
+        """
+        source = osp.join(self.datadir, 'coverage_0')
+        path = osp.join(self.tempdir, 'compressed')
+        with gzip.open(path, 'wb') as stream:
+            stream.write(open(source, 'rb').read())
+
+        self.assertEqual(read_data_file(source), read_data_file(path))
+
+    def test_read_data_file_corrupted(self):
+        """
+        An error is raised for compressed files which can not be
+        decompressed.
+        """
+        path = osp.join(self.tempdir, 'corrupted')
+        with open(path, 'wb') as stream:
+            stream.write(b'\x1f\x8b' + b'garbage' * 10)
+        truncated_path = osp.join(self.tempdir, 'truncated')
+        with gzip.open(truncated_path, 'wb') as stream:
+            stream.write(open(osp.join(self.datadir, 'coverage_0')).read())
+        with open(truncated_path, 'rb') as stream:
+            content = stream.read()
+        with open(truncated_path, 'wb') as stream:
+            stream.write(content[:len(content) // 2])
+
+        self.assertRaises(CoverageDataError, read_data_file, path)
+        self.assertRaises(CoverageDataError, read_data_file, truncated_path)
+
+    def test_read_data_file_max_size(self):
+        """
+        An error is raised for files larger than the maximum size once
+        decompressed.
+        """
+        path = osp.join(self.tempdir, 'large')
+        write_data_file(path, {'lines': {'a.py': list(range(10000))}})
+        compressed_path = osp.join(self.tempdir, 'compressed')
+        with gzip.open(compressed_path, 'wb') as stream:
+            stream.write(open(path, 'rb').read())
+        size = os.path.getsize(path)
+
+        self.assertRaises(
+            CoverageDataError, read_data_file, compressed_path, size - 1)
+        self.assertEqual(
+            read_data_file(path), read_data_file(compressed_path, size))
+
+    def test_update_lines(self):
+        """
+        Executed lines are merged per source file.
+        """
+        sut = CoverageCombiner()
+
+        sut.update({'lines': {'a.py': [1, 2], 'b.py': [1]}})
+        sut.update({'lines': {'a.py': [2, 3]}})
+
+        self.assertEqual({'a.py': set([1, 2, 3]), 'b.py': set([1])}, sut.lines)
+        self.assertEqual(
+            {'lines': {'a.py': [1, 2, 3], 'b.py': [1]}}, sut.toRaw())
+
+    def test_update_arcs(self):
+        """
+        Arcs are merged and kept when all files have arcs.
+        """
+        sut = CoverageCombiner()
+
+        sut.update({'arcs': {'a.py': [[-1, 1], [1, 2]]}})
+        sut.update({'arcs': {'a.py': [[1, 2], [2, -1]]}})
+
+        self.assertEqual(
+            {'arcs': {'a.py': [[-1, 1], [1, 2], [2, -1]]}}, sut.toRaw())
+
+    def test_update_mixed(self):
+        """
+        When mixing lines and arcs, the result only has lines.
+        """
+        sut = CoverageCombiner()
+
+        sut.update({'arcs': {'a.py': [[-1, 1], [1, 3]]}})
+        sut.update({'lines': {'a.py': [2], 'b.py': [5]}})
+
+        self.assertEqual(
+            {'lines': {'a.py': [1, 2, 3], 'b.py': [5]}}, sut.toRaw())
+
+    def test_combine_files(self):
+        """
+        POSIX and Windows data files are combined into a single file
+        using the path aliases, leaving the source files in place.
+        """
+        aliases = PathAliases('/checkout')
+        aliases.add('*/test', 'test/')
+        sources = [
+            osp.join(self.datadir, name)
+            for name in ('coverage_0', 'coverage_1', 'coverage_1_win')]
+        output = osp.join(self.tempdir, 'combined')
+
+        combine_files(sources, output, aliases)
+
+        result = read_data_file(output)
+        self.assertEqual(['/checkout/test/file.py'], list(result['lines']))
+        expected = set()
+        for source in sources:
+            for lines in read_data_file(source)['lines'].values():
+                expected.update(lines)
+        self.assertEqual(
+            sorted(expected), result['lines']['/checkout/test/file.py'])
+        for source in sources:
+            self.assertTrue(osp.exists(source))
+
+    def test_write_data_file(self):
+        """
+        The written file can be read back.
+        """
+        path = osp.join(self.tempdir, 'data')
+
+        write_data_file(path, {'lines': {'a.py': [1]}})
+
+        self.assertEqual({'lines': {'a.py': [1]}}, read_data_file(path))
+
+
+class TestCoverageCounter(TestCase):
+    """
+    Tests for CoverageCounter.
+    """
+
+    def test_add_remove(self):
+        """
+        A line is kept while at least one data file executed it.
+        """
+        sut = CoverageCounter()
+
+        sut.add({'lines': {'C:\\src\\a.py': [1, 2]}})
+        sut.add({'lines': {'C:/src/a.py': [2, 3]}})
+        sut.remove({'lines': {'C:/src/a.py': [1, 2]}})
+
+        self.assertEqual({'lines': {'C:/src/a.py': [2, 3]}}, {
+            'lines': dict(
+                (name, sorted(lines))
+                for name, lines in sut.toRaw()['lines'].items())})
+
+    def test_remove_all(self):
+        """
+        Files are removed when no data file executed them.
+        """
+        sut = CoverageCounter()
+
+        sut.add({'arcs': {'a.py': [[-1, 1], [1, -1]]}, 'lines': {}})
+        sut.remove({'arcs': {'a.py': [[-1, 1], [1, -1]]}})
+
+        self.assertEqual({}, sut.toRaw())
+
+    def test_save_load(self):
+        """
+        The counters can be saved and loaded back.
+        """
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = osp.join(tempdir, 'state')
+        sut = CoverageCounter()
+        sut.add({'arcs': {'a.py': [[-1, 1]]}, 'lines': {'b.py': [4]}})
+
+        sut.save(path)
+        result = CoverageCounter.load(path)
+
+        self.assertEqual(sut.lines, result.lines)
+        self.assertEqual(sut.arcs, result.arcs)
+        self.assertEqual(
+            {'arcs': {'a.py': [[-1, 1]]}, 'lines': {'b.py': [4]}},
+            result.toRaw())
+
+    def test_load_missing(self):
+        """
+        Empty counters are loaded when there is no saved file.
+        """
+        result = CoverageCounter.load('/no/such/file')
+
+        self.assertEqual({}, result.toRaw())
@@ -0,0 +1,151 @@
+from coverage.config import CoverageConfig
+from coverator.combine import CoverageCombiner
+from coverator.diffcoverage import (
+    ChangedLinesCache,
+    diff_coverage,
+    parse_diff,
+    )
+from coverator.xmlreport import XmlReport
+
+from os import path as osp
+from unittest import TestCase
+
+import git
+import shutil
+import tempfile
+
+
+DIFF = """\
+diff --git a/pkg/a.py b/pkg/a.py
+index 1111111..2222222 100644
+--- a/pkg/a.py
++++ b/pkg/a.py
+@@ -1,3 +1,4 @@
+ first = 1
+-second = 2
++second = 3
++third = 3
+ fourth = 4
+@@ -10,2 +11,2 @@ def check():
+-    return 1
++    return 2
+ end = True
+diff --git a/pkg/removed.py b/pkg/removed.py
+deleted file mode 100644
+index 3333333..0000000
+--- a/pkg/removed.py
++++ /dev/null
+@@ -1 +0,0 @@
+-removed = True
+"""
+
+
+class TestParseDiff(TestCase):
+    """
+    Tests for parse_diff.
+    """
+
+    def test_parse_diff(self):
+        """
+        The added lines are found by file, from the start of the hunks.
+        """
+        result = parse_diff(DIFF)
+
+        self.assertEqual(
+            {'pkg/a.py': [2, 3, 11], 'pkg/removed.py': []}, result)
+
+
+class TestDiffCoverage(TestCase):
+    """
+    Tests for ChangedLinesCache and diff_coverage, using a repository with
+    a commit on top of master.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.repo = git.Repo.init(self.tempdir)
+        self.path = osp.join(self.tempdir, 'source.py')
+        self.commit('first = 1\n')
+        self.repo.git.checkout('-b', 'feature')
+        self.sha = self.commit('first = 1\nsecond = 2\nthird = 3\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def commit(self, content):
+        with open(self.path, 'w') as stream:
+            stream.write(content)
+        self.repo.index.add([self.path])
+        return self.repo.index.commit('change').hexsha
+
+    def test_changedLines(self):
+        """
+        The lines changed from the merge base are cached by merge base and
+        commit.
+        """
+        sut = ChangedLinesCache()
+
+        result = sut.changedLines(self.tempdir, self.sha)
+        cached = sut.changedLines(self.tempdir, self.sha)
+
+        self.assertEqual({'source.py': [2, 3]}, result)
+        self.assertIs(result, cached)
+        self.assertEqual((1, 1), (sut.hits, sut.misses))
+
+    def test_diff_coverage(self):
+        """
+        The percentage of covered changed lines is returned, and the HTML
+        report lists the changed lines which are not covered.
+        """
+        combiner = CoverageCombiner()
+        combiner.update({'lines': {self.path: [1, 2]}})
+        xml_report = XmlReport(self.tempdir, CoverageConfig())
+        output = osp.join(self.tempdir, 'diff-cover.html')
+
+        result = diff_coverage(
+            xml_report, combiner, {'source.py': [2, 3], 'other.txt': [1]},
+            output)
+
+        self.assertEqual(50, result)
+        html = open(output).read()
+        self.assertIn('source.py', html)
+        # The snippet with the missing line is included.
+        self.assertIn('<a name="source.py-3"></a>', html)
+        self.assertNotIn('other.txt', html)
+
+    def test_diff_coverage_kept_lines(self):
+        """
+        The lines kept by the XML report are used, without analyzing the
+        changed files again, and the HTML report replaces the previous one.
+        """
+        combiner = CoverageCombiner()
+        combiner.update({'lines': {self.path: [1, 2]}})
+        xml_report = XmlReport(self.tempdir, CoverageConfig())
+        xml_report.write(
+            combiner, osp.join(self.tempdir, 'coverage.xml'),
+            keep=[self.path, osp.join(self.tempdir, 'other.py')])
+        analyzed = []
+        xml_report.analyzer.analyze = lambda *args: analyzed.append(args)
+        output = osp.join(self.tempdir, 'diff-cover.html')
+        with open(output, 'w') as stream:
+            stream.write('previous')
+
+        result = diff_coverage(
+            xml_report, combiner, {'source.py': [2, 3], 'other.py': [1]},
+            output)
+
+        self.assertEqual(50, result)
+        self.assertEqual([], analyzed)
+        self.assertIn('source.py', open(output).read())
+        self.assertFalse(osp.exists(output + '.tmp'))
+
+    def test_diff_coverage_no_lines(self):
+        """
+        When no changed line is measured, the diff is fully covered.
+        """
+        xml_report = XmlReport(self.tempdir, CoverageConfig())
+
+        result = diff_coverage(
+            xml_report, CoverageCombiner(), {'source.py': [2, 3]})
+
+        self.assertEqual(100, result)
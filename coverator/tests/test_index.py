@@ -0,0 +1,164 @@
+from coverator.index import REPORT_DONE, REPORT_QUEUED, MetadataIndex
+
+from os import path as osp
+from unittest import TestCase
+
+import shutil
+import tempfile
+
+
+class TestMetadataIndex(TestCase):
+    """
+    Tests for MetadataIndex.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.sut = MetadataIndex(osp.join(self.tempdir, 'state', 'index.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_recordUpload(self):
+        """
+        The uploads are recorded for the commit, with its branch and PR.
+        """
+        self.sut.recordUpload(
+            'repo', 'commit-1', 'linux', 'master', None, size=10, tstamp=1)
+        self.sut.recordUpload(
+            'repo', 'commit-1', 'windows', None, '42', tstamp=3)
+        self.sut.recordUpload('repo', 'commit-1', 'linux', tstamp=4)
+
+        self.assertEqual({
+            'commit': 'commit-1',
+            'created': 1,
+            'updated': 4,
+            'report_status': None,
+            'report_updated': None,
+            'coverage_total': None,
+            'coverage_diff': None,
+            'builders': {'linux': 4, 'windows': 3},
+            'branch': ['master'],
+            'pr': ['42'],
+            }, self.sut.getCommit('repo', 'commit-1'))
+        self.assertIsNone(self.sut.getCommit('repo', 'other'))
+        self.assertIsNone(self.sut.getCommit('other', 'commit-1'))
+        self.assertEqual(['repo'], self.sut.repositories())
+
+    def test_recordUpload_removed(self):
+        """
+        The uploads of the removed builders are forgotten.
+        """
+        self.sut.recordUpload('repo', 'commit-1', 'linux+1', tstamp=1)
+        self.sut.recordUpload('repo', 'commit-1', 'linux+2', tstamp=1)
+        self.sut.recordUpload('repo', 'commit-1', 'windows', tstamp=1)
+
+        self.sut.recordUpload(
+            'repo', 'commit-1', 'linux', tstamp=2,
+            removed=['linux+1', 'linux+2'])
+
+        self.assertEqual(
+            {'linux': 2, 'windows': 1},
+            self.sut.getCommit('repo', 'commit-1')['builders'])
+
+    def test_commits(self):
+        """
+        The commits are returned the last one first, for the repository
+        or for a branch or PR.
+        """
+        self.sut.recordUpload('repo', 'commit-1', 'linux', 'master', tstamp=1)
+        self.sut.recordUpload('repo', 'commit-2', 'linux', 'other', tstamp=2)
+        self.sut.recordUpload(
+            'repo', 'commit-3', 'linux', 'master', '42', tstamp=3)
+
+        self.assertEqual(
+            ['commit-3', 'commit-2', 'commit-1'], self.sut.commits('repo'))
+        self.assertEqual(
+            ['commit-3', 'commit-1'],
+            self.sut.commits('repo', 'branch', 'master'))
+        self.assertEqual(['commit-3'], self.sut.commits('repo', 'pr', '42'))
+        self.assertEqual('commit-3', self.sut.head('repo', 'branch', 'master'))
+        self.assertIsNone(self.sut.head('repo', 'pr', '1'))
+        self.assertEqual(
+            ['master', 'other'], self.sut.names('repo', 'branch'))
+
+    def test_head_again(self):
+        """
+        A commit uploaded again for a branch is its head again, as for the
+        report generator.
+        """
+        self.sut.recordUpload('repo', 'commit-a', 'linux', 'feature', tstamp=1)
+        self.sut.recordUpload('repo', 'commit-b', 'linux', 'feature', tstamp=2)
+
+        self.sut.recordUpload('repo', 'commit-a', 'osx', 'feature', tstamp=3)
+
+        self.assertEqual(
+            'commit-a', self.sut.head('repo', 'branch', 'feature'))
+        self.assertEqual(
+            [('feature', 'commit-a', 3)], self.sut.heads('repo', 'branch'))
+        self.assertEqual(
+            ['commit-a', 'commit-b'],
+            self.sut.commits('repo', 'branch', 'feature'))
+
+        self.sut.recordUpload('repo', 'commit-b', 'osx', 'feature', tstamp=4)
+
+        self.assertEqual(
+            'commit-b', self.sut.head('repo', 'branch', 'feature'))
+
+    def test_setReportStatus(self):
+        """
+        The status of the report is updated for the commit, by itself or
+        with an upload.
+        """
+        self.sut.recordUpload('repo', 'commit-1', 'linux', tstamp=1)
+
+        self.sut.recordUpload(
+            'repo', 'commit-1', 'osx', tstamp=2, report_status=REPORT_QUEUED)
+        result = self.sut.getCommit('repo', 'commit-1')
+        self.assertEqual(
+            (REPORT_QUEUED, 2),
+            (result['report_status'], result['report_updated']))
+
+        self.sut.setReportStatus('repo', 'commit-1', REPORT_DONE, 3)
+
+        result = self.sut.getCommit('repo', 'commit-1')
+        self.assertEqual(
+            (REPORT_DONE, 3),
+            (result['report_status'], result['report_updated']))
+
+    def test_summaries(self):
+        """
+        The metadata of the commits is returned by pages, with the
+        coverage of the reports.
+        """
+        for tstamp in range(1, 6):
+            self.sut.recordUpload(
+                'repo', 'commit-%d' % tstamp, 'linux', 'master',
+                tstamp=tstamp)
+        self.sut.setCoverage('repo', 'commit-4', 80.5, 100.0)
+
+        result = self.sut.summaries('repo', 'branch', 'master', 2, 1)
+
+        self.assertEqual(
+            [('commit-4', 80.5, 100.0), ('commit-3', None, None)],
+            [(row['commit'], row['coverage_total'], row['coverage_diff'])
+             for row in result])
+        self.assertEqual(
+            ['commit-5', 'commit-4'],
+            [row['commit'] for row in self.sut.summaries('repo', limit=2)])
+        self.assertEqual(5, self.sut.countCommits('repo'))
+        self.assertEqual(0, self.sut.countCommits('repo', 'pr', '1'))
+        self.assertEqual(
+            [('master', 'commit-5', 5)], self.sut.heads('repo', 'branch'))
+
+    def test_revision(self):
+        """
+        The revision is increased by each change.
+        """
+        revision = self.sut.revision()
+
+        self.sut.recordUpload('repo', 'commit-1', 'linux')
+        self.sut.setReportStatus('repo', 'commit-1', REPORT_DONE)
+        self.sut.setCoverage('repo', 'commit-1', 50.0)
+
+        self.assertEqual(revision + 3, self.sut.revision())
@@ -0,0 +1,61 @@
+from coverator.jobs import JobStore
+
+from os import path as osp
+from unittest import TestCase
+
+import shutil
+import tempfile
+
+
+class TestJobStore(TestCase):
+    """
+    Tests for JobStore.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = osp.join(self.tempdir, 'state', 'jobs.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_add(self):
+        """
+        Jobs are persisted and returned with the oldest first.
+        """
+        sut = JobStore(self.path)
+
+        sut.add(('/base', 'repo', 'commit-2', 'master', '42', 2.0))
+        sut.add(('/base', 'repo', 'commit-1', None, None, 1.0))
+
+        self.assertEqual([
+            ('/base', 'repo', 'commit-1', None, None, 1.0),
+            ('/base', 'repo', 'commit-2', 'master', '42', 2.0),
+            ], JobStore(self.path).pending())
+
+    def test_add_deduplicate(self):
+        """
+        A new job for the same commit replaces the pending one.
+        """
+        sut = JobStore(self.path)
+
+        sut.add(('/base', 'repo', 'commit', None, None, 1.0))
+        sut.add(('/base', 'repo', 'commit', 'master', None, 3.0))
+
+        self.assertEqual(
+            [('/base', 'repo', 'commit', 'master', None, 3.0)],
+            sut.pending())
+
+    def test_remove(self):
+        """
+        A job is removed, unless it was added again in the meantime.
+        """
+        sut = JobStore(self.path)
+        sut.add(('/base', 'repo', 'commit-1', None, None, 1.0))
+        sut.add(('/base', 'repo', 'commit-2', None, None, 5.0))
+
+        sut.remove('repo', 'commit-1', 1.0)
+        sut.remove('repo', 'commit-2', 4.0)
+
+        self.assertEqual(
+            [('/base', 'repo', 'commit-2', None, None, 5.0)], sut.pending())
@@ -0,0 +1,120 @@
+from coverator.combine import read_data_file
+from coverator.load import (
+    UPLOAD_OK,
+    format_histogram,
+    format_report,
+    make_payload,
+    percentile,
+    run_load,
+    )
+from coverator.server import CoveratorHandler, PooledHTTPServer
+
+from os import path as osp
+from test.test_httpservers import NoLogRequestHandler
+from unittest import TestCase
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+
+class LoadHandler(NoLogRequestHandler, CoveratorHandler):
+    """
+    Stores the uploads without generating reports.
+    """
+
+    MINIMUM_FILES = sys.maxsize
+
+
+class TestLoad(TestCase):
+    """
+    Tests for the load generator.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+    def test_make_payload(self):
+        """
+        The synthesized data file has about the requested size.
+        """
+        path = osp.join(self.tempdir, 'coverage.data')
+
+        make_payload(path, 50000)
+
+        self.assertGreaterEqual(os.path.getsize(path), 50000)
+        self.assertLess(os.path.getsize(path), 52000)
+        self.assertTrue(read_data_file(path)['lines'])
+
+    def test_run_load(self):
+        """
+        The data files are uploaded for each builder and commit.
+        """
+        LoadHandler.PATH = osp.join(self.tempdir, 'storage')
+        server = PooledHTTPServer(('localhost', 0), LoadHandler, workers=2)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(thread.join)
+        self.addCleanup(server.shutdown)
+        payload = osp.join(self.tempdir, 'coverage.data')
+        make_payload(payload, 1000)
+
+        result = run_load(
+            'http://localhost:%d/' % (server.server_address[1],),
+            [payload], builders=3, commits=2, concurrency=2, rate=100)
+
+        self.assertEqual([UPLOAD_OK] * 6, [status for _, status in result])
+        commits = os.listdir(
+            osp.join(LoadHandler.PATH, 'load', 'test', 'commit'))
+        self.assertEqual(2, len(commits))
+        self.assertEqual(
+            ['coverage.data.builder-0', 'coverage.data.builder-1',
+             'coverage.data.builder-2'],
+            sorted(name for name in os.listdir(osp.join(
+                LoadHandler.PATH, 'load', 'test', 'commit', commits[0]))
+                if name.startswith('coverage.data.')))
+
+    def test_percentile(self):
+        """
+        The percentile is the value at the nearest rank.
+        """
+        values = [5, 1, 4, 2, 3]
+
+        self.assertEqual(1, percentile(values, 0))
+        self.assertEqual(3, percentile(values, 50))
+        self.assertEqual(5, percentile(values, 90))
+        self.assertEqual(5, percentile(values, 100))
+        self.assertEqual(0, percentile([], 50))
+
+    def test_format_histogram(self):
+        """
+        The latencies are counted by bucket, from the first to the last
+        used bucket.
+        """
+        result = format_histogram([0.02, 0.02, 0.09, 400], width=4)
+
+        self.assertEqual([
+            ' <= 0.025s      2 ####',
+            '  <= 0.05s      0',
+            '   <= 0.1s      1 ##',
+            ], result[:3])
+        self.assertEqual('    > 300s      1 ##', result[-1])
+
+    def test_format_report(self):
+        """
+        The failed uploads are counted by result.
+        """
+        result = format_report(
+            [(0.1, UPLOAD_OK), (0.2, 503), (0.3, 'ConnectionError')], 2)
+
+        self.assertEqual(
+            'Uploads: 3, failed: 2, in 2.00s, 1.50 uploads/s.', result[0])
+        self.assertEqual(
+            ['  503: 1', '  ConnectionError: 1'], result[1:3])
+        self.assertEqual(
+            'Latency p50: 0.200s, p90: 0.300s, p99: 0.300s, max: 0.300s',
+            result[3])
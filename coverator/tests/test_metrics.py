@@ -0,0 +1,82 @@
+from coverator.metrics import COUNTER, Metrics
+
+from os import path as osp
+from unittest import TestCase
+
+import shutil
+import tempfile
+
+
+class TestMetrics(TestCase):
+    """
+    Tests for Metrics.
+    """
+
+    def test_render(self):
+        """
+        Counters and gauges are rendered with their labels, sorted by name.
+        """
+        sut = Metrics()
+        sut.inc('coverator_uploads_total', code='200')
+        sut.inc('coverator_uploads_total', 2, code='200')
+        sut.set('coverator_reports_running', 1.5)
+        sut.set('coverator_cache_hits_total', 7, COUNTER, cache='a"b')
+
+        self.assertEqual(
+            '# HELP coverator_cache_hits_total Cache hits, by cache.\n'
+            '# TYPE coverator_cache_hits_total counter\n'
+            'coverator_cache_hits_total{cache="a\\"b"} 7\n'
+            '# HELP coverator_reports_running Reports being generated.\n'
+            '# TYPE coverator_reports_running gauge\n'
+            'coverator_reports_running 1.5\n'
+            '# HELP coverator_uploads_total Upload requests, by response '
+            'status.\n'
+            '# TYPE coverator_uploads_total counter\n'
+            'coverator_uploads_total{code="200"} 3\n',
+            sut.render())
+
+    def test_histogram(self):
+        """
+        Histograms have cumulative buckets, the sum and the count.
+        """
+        sut = Metrics()
+        sut.observe('latency', 0.5, buckets=(1, 2), stage='xml')
+        sut.observe('latency', 1.5, stage='xml')
+        sut.observe('latency', 3, stage='xml')
+
+        self.assertEqual(
+            '# TYPE latency histogram\n'
+            'latency_bucket{stage="xml",le="1"} 1\n'
+            'latency_bucket{stage="xml",le="2"} 2\n'
+            'latency_bucket{stage="xml",le="+Inf"} 3\n'
+            'latency_sum{stage="xml"} 5\n'
+            'latency_count{stage="xml"} 3\n',
+            sut.render())
+
+    def test_kind(self):
+        """
+        A metric keeps the kind from its first update.
+        """
+        sut = Metrics()
+        sut.inc('total')
+
+        with self.assertRaises(ValueError):
+            sut.observe('total', 1)
+
+    def test_save_load(self):
+        """
+        The metrics are saved to a snapshot file, and empty metrics are
+        loaded when the file does not exist.
+        """
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = osp.join(tempdir, 'metrics.json')
+        sut = Metrics()
+        sut.inc('total', kind='report')
+        with sut.time('duration'):
+            pass
+
+        sut.save(path)
+
+        self.assertEqual(sut.render(), Metrics.load(path).render())
+        self.assertEqual('', Metrics.load(path + '.missing').render())
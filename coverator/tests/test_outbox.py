@@ -0,0 +1,231 @@
+from coverator.outbox import RetryLater, StatusOutbox
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from test.test_httpservers import NoLogRequestHandler
+from unittest import TestCase
+
+import json
+import threading
+
+
+class FakeGitHubHandler(NoLogRequestHandler, BaseHTTPRequestHandler):
+    """
+    Serves the parts of the GitHub API used for the commit statuses.
+
+    The responses to send before the normal ones are taken from the
+    `errors` list of the server.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def _respond(self, code, data=None, headers={}):
+        body = b''
+        if data is not None:
+            body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '%d' % (len(body),))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self):
+        if not self.server.errors:
+            return False
+        code, headers = self.server.errors.pop(0)
+        self._respond(code, {'message': 'error'}, headers)
+        return True
+
+    def do_GET(self):
+        self.server.requests.append(
+            ('GET', self.path, self.headers.get('If-None-Match')))
+        if self._error():
+            return
+        if self.headers.get('If-None-Match') == '"v1"':
+            self._respond(304, headers={'ETag': '"v1"'})
+            return
+        self._respond(200, {
+            'full_name': self.path[len('/repos/'):],
+            'statuses_url': 'http://%s:%d%s/statuses/{sha}' % (
+                self.server.server_address + (self.path,)),
+            }, {'ETag': '"v1"'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length).decode('utf-8'))
+        self.server.requests.append(
+            ('POST', self.path, self.headers.get('Authorization')))
+        if self._error():
+            return
+        self.server.statuses.append((self.path, body))
+        self._respond(201, body)
+
+
+class TestStatusOutbox(TestCase):
+    """
+    Tests for StatusOutbox, using a fake GitHub API.
+    """
+
+    def setUp(self):
+        self.server = HTTPServer(('localhost', 0), FakeGitHubHandler)
+        self.server.requests = []
+        self.server.statuses = []
+        self.server.errors = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.sut = StatusOutbox(
+            'some-token',
+            api_url='http://%s:%d/' % self.server.server_address,
+            retries=2,
+            backoff=0.01,
+            )
+
+    def tearDown(self):
+        self.sut.session.close()
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def test_send(self):
+        """
+        The status is created for the commit, using the statuses URL of the
+        repository.
+        """
+        self.sut.send('owner/repo.git', 'abc', {'state': 'success'})
+
+        self.assertEqual(1, self.sut.sent)
+        self.assertEqual(
+            [('/repos/owner/repo/statuses/abc', {'state': 'success'})],
+            self.server.statuses)
+        self.assertEqual(
+            ('POST', '/repos/owner/repo/statuses/abc', 'token some-token'),
+            self.server.requests[-1])
+
+    def test_getRepository_cached(self):
+        """
+        The repository is requested once and then revalidated with a
+        conditional request after it expires.
+        """
+        first = self.sut.getRepository('owner/repo')
+        self.sut.getRepository('owner/repo')
+        self.assertEqual(
+            [('GET', '/repos/owner/repo', None)], self.server.requests)
+
+        # Expire the cached repository.
+        etag, data, _ = self.sut._repositories['owner/repo']
+        self.sut._repositories['owner/repo'] = (etag, data, 0)
+        result = self.sut.getRepository('owner/repo')
+
+        self.assertEqual(first, result)
+        self.assertEqual(
+            ('GET', '/repos/owner/repo', '"v1"'), self.server.requests[-1])
+
+    def waitForStatuses(self, count):
+        """
+        Wait until `count` statuses were sent or failed.
+        """
+        for _ in range(200):
+            if self.sut.sent + self.sut.failed >= count:
+                break
+            self.sut.join(0.01)
+
+    def test_retry_rate_limit(self):
+        """
+        The status is retried later when the rate limit is exceeded or on
+        server errors.
+        """
+        self.server.errors = [
+            (403, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '0'}),
+            (429, {'Retry-After': '0'}),
+            ]
+        self.sut.start()
+        self.sut.post('owner/repo', 'abc', 'success', 'url', 'done', 'all')
+        self.waitForStatuses(1)
+
+        self.server.errors = [(502, {})]
+        self.sut.post('owner/repo', 'def', 'failure', 'url', 'done', 'all')
+        self.waitForStatuses(2)
+        self.sut.stop()
+
+        self.assertEqual((2, 0, 3), (
+            self.sut.sent, self.sut.failed, self.sut.retried))
+        self.assertEqual(2, len(self.server.statuses))
+        self.assertEqual(6, len(self.server.requests))
+
+    def test_retry_give_up(self):
+        """
+        The status fails after the configured number of retries.
+        """
+        self.server.errors = [(500, {})] * 3
+        self.sut.start()
+        self.sut.post('owner/repo', 'abc', 'success', 'url', 'done', 'all')
+        self.waitForStatuses(1)
+        self.sut.stop()
+
+        self.assertEqual((0, 1, 2), (
+            self.sut.sent, self.sut.failed, self.sut.retried))
+        self.assertEqual(3, len(self.server.requests))
+
+    def test_retry_other_statuses(self):
+        """
+        The other statuses are sent while a status waits for the rate
+        limit, and the statuses still waiting are not sent on stop.
+        """
+        self.server.errors = [(429, {'Retry-After': '60'})]
+        self.sut.start()
+        self.sut.post('owner/limited', 'abc', 'success', 'url', 'done', 'all')
+        self.sut.post('owner/repo', 'def', 'success', 'url', 'done', 'all')
+        self.waitForStatuses(1)
+        self.sut.stop()
+
+        self.assertEqual((1, 0, 1), (
+            self.sut.sent, self.sut.failed, self.sut.retried))
+        self.assertEqual(
+            ['/repos/owner/repo/statuses/def'],
+            [path for path, _ in self.server.statuses])
+
+    def test_request_retry_later(self):
+        """
+        A failed request is not retried right away, but the error tells
+        when it can be retried.
+        """
+        self.server.errors = [(429, {'Retry-After': '7'}), (500, {})]
+
+        with self.assertRaises(RetryLater) as context:
+            self.sut.getRepository('owner/repo')
+        self.assertEqual(7, context.exception.wait)
+        with self.assertRaises(RetryLater) as context:
+            self.sut.getRepository('owner/repo')
+        self.assertIsNone(context.exception.wait)
+
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_client_error(self):
+        """
+        Client errors other than the rate limit are not retried.
+        """
+        self.server.errors = [(404, {})]
+
+        with self.assertRaises(Exception) as context:
+            self.sut.getRepository('owner/repo')
+
+        self.assertNotIsInstance(context.exception, RetryLater)
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_post_coalesced(self):
+        """
+        The statuses are sent from the thread, and only the last status
+        which was not sent yet is sent for a commit and context.
+        """
+        self.sut.post('owner/repo', 'abc', 'pending', 'url', 'wait', 'diff')
+        self.sut.post('owner/repo', 'abc', 'success', 'url', 'done', 'diff')
+        self.sut.post('owner/repo', 'abc', 'success', 'url', 'done', 'all')
+
+        self.sut.start()
+        self.sut.stop()
+
+        self.assertEqual(
+            [('diff', 'success'), ('all', 'success')],
+            [(body['context'], body['state'])
+             for _, body in self.server.statuses])
+        self.assertEqual((2, 0), (self.sut.sent, self.sut.failed))
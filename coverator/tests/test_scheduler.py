@@ -0,0 +1,56 @@
+from coverator.scheduler import DebounceScheduler
+
+from unittest import TestCase
+
+
+class TestDebounceScheduler(TestCase):
+    """
+    Tests for DebounceScheduler.
+    """
+
+    def test_popDue(self):
+        """
+        The due values are returned in the order of their time.
+        """
+        sut = DebounceScheduler()
+        sut.schedule('b', 20, 'value-b')
+        sut.schedule('a', 10, 'value-a')
+        sut.schedule('c', 30, 'value-c')
+
+        self.assertEqual([], sut.popDue(5))
+        self.assertEqual(
+            [('a', 'value-a'), ('b', 'value-b')], sut.popDue(20))
+        self.assertEqual(1, len(sut))
+        self.assertEqual(30, sut.nextTime())
+
+    def test_schedule_replace(self):
+        """
+        Scheduling a key again replaces its value and time.
+        """
+        sut = DebounceScheduler()
+        sut.schedule('a', 10, 'old')
+        sut.schedule('b', 15, 'value-b')
+
+        sut.schedule('a', 20, 'new')
+
+        self.assertEqual(2, len(sut))
+        self.assertEqual('new', sut.get('a'))
+        self.assertEqual(15, sut.nextTime())
+        self.assertEqual(
+            [('b', 'value-b'), ('a', 'new')], sut.popDue(100))
+
+    def test_cancel(self):
+        """
+        A cancelled value is not returned.
+        """
+        sut = DebounceScheduler()
+        sut.schedule('a', 10, 'value-a')
+        sut.schedule('b', 20, 'value-b')
+
+        self.assertEqual('value-a', sut.cancel('a'))
+        self.assertIsNone(sut.cancel('a'))
+
+        self.assertNotIn('a', sut)
+        self.assertEqual(20, sut.nextTime())
+        self.assertEqual([('b', 'value-b')], sut.popDue(100))
+        self.assertIsNone(sut.nextTime())
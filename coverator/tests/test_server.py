@@ -1,10 +1,31 @@
+from coverator.analysis import AnalysisCache
+from coverator.api import JsonApi
+from coverator.combine import (
+    COVERAGE_STATE_FILE,
+    CoverageCombiner,
+    CoverageCounter,
+    compress_file,
+    is_compressed,
+    read_data_file,
+    write_data_file,
+    )
+from coverator.index import REPORT_DONE, REPORT_QUEUED, MetadataIndex
+from coverator.jobs import JobStore
+from coverator.metrics import Metrics
+from coverator.outbox import StatusOutbox
+from coverator import server
 from coverator.server import (
+    JOB_DONE,
     CoveratorHandler,
+    PooledHTTPServer,
     ReportGenerator,
     )
+from coverator.uploader import CodecovUploader
+from coverator.xmlreport import XmlReport
 
-from github import Github
-from multiprocessing import Queue
+from BaseHTTPServer import BaseHTTPRequestHandler
+from coverage.config import CoverageConfig
+from httplib import HTTPConnection
 from os import path as osp
 from requests import Request
 from test.test_httpservers import BaseTestCase, NoLogRequestHandler
@@ -12,9 +33,17 @@ from unittest import TestCase
 
 import copy
 import git
+import gzip
+import io
+import json
 import os
+import pstats
+import socket
+import sqlite3
 import tempfile
 import shutil
+import threading
+import time
 
 
 class TestCoveratorHandler(BaseTestCase):
@@ -35,6 +64,12 @@ class TestCoveratorHandler(BaseTestCase):
         self.tempdir = tempfile.mktemp(dir=basetempdir)
         self.request_handler.PATH = self.tempdir
         self.request_handler.MINIMUM_FILES = 2
+        self.request_handler.EXPECTED_BUILDERS = {}
+        self.request_handler.INDEX = None
+        self.request_handler.SYMLINKS = True
+        self.request_handler.API = None
+        self.request_handler.METRICS = Metrics()
+        self.request_handler.METRICS_SNAPSHOT = None
         self.datadir = osp.join(
             os.path.dirname(os.path.realpath(__file__)), 'data')
 
@@ -91,6 +126,250 @@ class TestCoveratorHandler(BaseTestCase):
             open(osp.join(self.datadir, 'coverage_0')).read(),
             open(uploaded_path).read())
 
+    def writeReport(self, name='coverage.xml', content=b'<coverage/>'):
+        """
+        Write a report file for a commit and return its path.
+        """
+        path = osp.join(self.tempdir, 'repo', 'commit', 'abc', name)
+        os.makedirs(osp.dirname(path))
+        with open(path, 'wb') as stream:
+            stream.write(content)
+        return path
+
+    def test_get_etag(self):
+        """
+        Files are sent with an ETag, and are not sent again when the client
+        has the same version.
+        """
+        self.writeReport()
+
+        response = BaseTestCase.request(self, '/repo/commit/abc/coverage.xml')
+
+        self.assertEqual(200, response.status)
+        self.assertEqual(b'<coverage/>', response.read())
+        self.assertEqual('no-cache', response.getheader('Cache-Control'))
+        etag = response.getheader('ETag')
+        response = BaseTestCase.request(
+            self, '/repo/commit/abc/coverage.xml',
+            headers={'If-None-Match': etag})
+        self.assertEqual(304, response.status)
+        self.assertEqual(b'', response.read())
+        self.assertEqual(etag, response.getheader('ETag'))
+
+    def test_get_precompressed(self):
+        """
+        The compressed report is sent to the clients accepting gzip, when
+        it is up to date.
+        """
+        path = self.writeReport()
+        server._write_compressed(path)
+        with open(path + '.gz', 'rb') as stream:
+            compressed = stream.read()
+
+        response = BaseTestCase.request(
+            self, '/repo/commit/abc/coverage.xml',
+            headers={'Accept-Encoding': 'deflate, gzip'})
+
+        self.assertEqual(200, response.status)
+        self.assertEqual('gzip', response.getheader('Content-Encoding'))
+        self.assertEqual('Accept-Encoding', response.getheader('Vary'))
+        self.assertEqual('application/xml', response.getheader('Content-type'))
+        self.assertEqual(compressed, response.read())
+
+        response = BaseTestCase.request(
+            self, '/repo/commit/abc/coverage.xml',
+            headers={'Accept-Encoding': 'gzip;q=0'})
+        self.assertEqual(None, response.getheader('Content-Encoding'))
+        self.assertEqual(b'<coverage/>', response.read())
+
+        # A stale compressed file is not used.
+        os.utime(path + '.gz', (1, 1))
+        response = BaseTestCase.request(
+            self, '/repo/commit/abc/coverage.xml',
+            headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(None, response.getheader('Content-Encoding'))
+        self.assertEqual(b'<coverage/>', response.read())
+
+    def test_get_large(self):
+        """
+        Files larger than a chunk are sent whole.
+        """
+        content = b'x' * (3 * server.UPLOAD_CHUNK_SIZE + 1)
+        self.writeReport('diff-cover.html', content)
+
+        response = BaseTestCase.request(
+            self, '/repo/commit/abc/diff-cover.html')
+
+        self.assertEqual(200, response.status)
+        self.assertEqual(content, response.read())
+
+    def test_post_too_large(self):
+        """
+        Uploads larger than the configured maximum size are rejected.
+        """
+        self.request_handler.MAX_UPLOAD_SIZE = 100
+        self.addCleanup(
+            setattr, self.request_handler, 'MAX_UPLOAD_SIZE',
+            CoveratorHandler.MAX_UPLOAD_SIZE)
+
+        response = self.request(
+            files={'file': open(osp.join(self.datadir, 'coverage_0'))},
+            )
+
+        self.assertEqual(response.status, 413)
+        self.assertFalse(os.path.exists(self.tempdir))
+
+    def test_post_atomic_write(self):
+        """
+        The uploaded file is written to a temporary file which is then
+        renamed, so no temporary file is left behind.
+        """
+        response = self.request(
+            files={'file': open(osp.join(self.datadir, 'coverage_0'))},
+            )
+
+        self.assertEqual(response.status, 200)
+        commit_path = osp.join(
+            self.tempdir, 'no-repository', 'commit', 'no-commit')
+        self.assertEqual(
+            ['coverage.data.no-buildslave', 'coverage.state'],
+            sorted(os.listdir(commit_path)))
+
+    def test_post_compressed(self):
+        """
+        A gzip compressed data file is stored compressed and its data
+        is added to the combined state.
+        """
+        source_path = osp.join(self.datadir, 'coverage_0')
+        response = self.request(
+            files={'file': (
+                'coverage_0',
+                compress_file(source_path),
+                'application/octet-stream',
+                {'Content-Encoding': 'gzip'},
+                )},
+            )
+
+        self.assertEqual(response.status, 200)
+        commit_path = osp.join(
+            self.tempdir, 'no-repository', 'commit', 'no-commit')
+        uploaded_path = osp.join(commit_path, 'coverage.data.no-buildslave')
+        self.assertTrue(is_compressed(uploaded_path))
+        self.assertEqual(
+            read_data_file(source_path), read_data_file(uploaded_path))
+        expected = CoverageCounter()
+        expected.add(read_data_file(source_path))
+        self.assertEqual(
+            expected.lines,
+            CoverageCounter.load(
+                osp.join(commit_path, COVERAGE_STATE_FILE)).lines)
+
+    def test_post_corrupted(self):
+        """
+        A data file which can not be read is rejected and it does not
+        replace the previous data file of the builder.
+        """
+        commit_path = osp.join(
+            self.tempdir, 'no-repository', 'commit', 'no-commit')
+        uploaded_path = osp.join(commit_path, 'coverage.data.no-buildslave')
+        source_path = osp.join(self.datadir, 'coverage_0')
+        response = self.request(files={'file': open(source_path)})
+        self.assertEqual(response.status, 200)
+
+        response = self.request(
+            files={'file': (
+                'coverage_0',
+                io.BytesIO(b'\x1f\x8b' + b'garbage' * 10),
+                'application/octet-stream',
+                {'Content-Encoding': 'gzip'},
+                )},
+            )
+
+        self.assertEqual(response.status, 400)
+        self.assertEqual(
+            read_data_file(source_path), read_data_file(uploaded_path))
+        self.assertEqual(
+            ['coverage.data.no-buildslave', 'coverage.state'],
+            sorted(os.listdir(commit_path)))
+
+        response = self.request(
+            files={'file': open(osp.join(self.datadir, 'coverage_1'))})
+        self.assertEqual(response.status, 200)
+
+    def test_post_decompressed_too_large(self):
+        """
+        Compressed data files larger than the maximum upload size once
+        decompressed are rejected.
+        """
+        source_path = osp.join(self.tempdir, 'large')
+        os.makedirs(self.tempdir)
+        write_data_file(source_path, {'lines': dict(
+            ('file_%d.py' % (index,), list(range(100)))
+            for index in range(1000))})
+        self.request_handler.MAX_UPLOAD_SIZE = 100000
+        self.addCleanup(
+            setattr, self.request_handler, 'MAX_UPLOAD_SIZE',
+            CoveratorHandler.MAX_UPLOAD_SIZE)
+
+        response = self.request(
+            files={'file': (
+                'coverage_0',
+                compress_file(source_path),
+                'application/octet-stream',
+                {'Content-Encoding': 'gzip'},
+                )},
+            )
+
+        self.assertEqual(response.status, 400)
+        commit_path = osp.join(
+            self.tempdir, 'no-repository', 'commit', 'no-commit')
+        self.assertEqual([], os.listdir(commit_path))
+        self.assertGreater(
+            os.path.getsize(source_path),
+            self.request_handler.MAX_UPLOAD_SIZE)
+
+    def test_post_unsupported_encoding(self):
+        """
+        Data files compressed with an unknown encoding are rejected.
+        """
+        response = self.request(
+            files={'file': (
+                'coverage_0',
+                open(osp.join(self.datadir, 'coverage_0'), 'rb'),
+                'application/octet-stream',
+                {'Content-Encoding': 'zstd'},
+                )},
+            )
+
+        self.assertEqual(response.status, 415)
+        self.assertFalse(os.path.exists(self.tempdir))
+
+    def test_post_replace_builder_data(self):
+        """
+        The combined state for the commit is updated with each upload and
+        a new upload from the same builder replaces its previous data.
+        """
+        commit_path = osp.join(
+            self.tempdir, 'no-repository', 'commit', 'no-commit')
+        state_path = osp.join(commit_path, COVERAGE_STATE_FILE)
+
+        for name, build in (
+                ('coverage_0', 'slave-0'),
+                ('coverage_2', 'slave-2'),
+                ('coverage_1', 'slave-2'),
+                ):
+            response = self.request(
+                files={'file': open(osp.join(self.datadir, name))},
+                data={'build': build},
+                )
+            self.assertEqual(response.status, 200)
+
+        expected = CoverageCounter()
+        expected.add(read_data_file(osp.join(self.datadir, 'coverage_0')))
+        expected.add(read_data_file(osp.join(self.datadir, 'coverage_1')))
+        self.assertEqual(
+            expected.lines, CoverageCounter.load(state_path).lines)
+
     def test_post_branch(self):
         """
         Will create a symlink for the branch.
@@ -214,17 +493,137 @@ class TestCoveratorHandler(BaseTestCase):
         self.assertTrue(os.path.islink(pr_path))
         self.assertEqual(commit_path, os.path.realpath(pr_path))
 
+    def test_post_index(self):
+        """
+        With an index, the upload is recorded and the branch symlink points
+        to the commit with the last upload for the branch, which is an older
+        commit uploaded again.
+        """
+        index = MetadataIndex(osp.join(self.tempdir, 'index.sqlite'))
+        self.request_handler.INDEX = index
+        for commit, build in (
+                ('first', 'linux'), ('second', 'linux'), ('first', 'osx')):
+            response = self.request(
+                files={'file': open(osp.join(self.datadir, 'coverage_0'))},
+                data={
+                    'repository': 'repo',
+                    'build': build,
+                    'branch': 'master',
+                    'commit': commit,
+                    },
+                )
+            self.assertEqual(200, response.status)
+
+        self.assertEqual(
+            ['linux', 'osx'],
+            sorted(index.getCommit('repo', 'first')['builders']))
+        self.assertEqual(
+            ['first', 'second'], index.commits('repo', 'branch', 'master'))
+        repo_path = osp.join(self.tempdir, 'repo')
+        self.assertEqual(
+            osp.join(repo_path, 'commit', 'first'),
+            os.path.realpath(osp.join(repo_path, 'branch', 'master')))
+        self.assertEqual(
+            ['coverage.data.linux', 'coverage.data.osx', 'coverage.state'],
+            sorted(os.listdir(osp.join(repo_path, 'commit', 'first'))))
+
+    def test_post_index_queued(self):
+        """
+        The upload requesting a report records the queued status of the
+        report in the index.
+        """
+        jobs = []
+
+        class MockReportGenerator:
+            def queueReport(self, job):
+                jobs.append(job)
+
+        self.request_handler.report_generator = MockReportGenerator()
+        self.request_handler.EXPECTED_BUILDERS = {'repo': set(['linux'])}
+        index = MetadataIndex(osp.join(self.tempdir, 'index.sqlite'))
+        self.request_handler.INDEX = index
+        revision = index.revision()
+
+        response = self.request(
+            files={'file': open(osp.join(self.datadir, 'coverage_0'))},
+            data={'repository': 'repo', 'build': 'linux', 'commit': 'abc'},
+            )
+
+        self.assertEqual(200, response.status)
+        self.assertEqual(1, len(jobs))
+        self.assertEqual(
+            REPORT_QUEUED, index.getCommit('repo', 'abc')['report_status'])
+        self.assertEqual(revision + 1, index.revision())
+
+    def test_get_api(self):
+        """
+        The API requests are answered from the index.
+        """
+        index = MetadataIndex(osp.join(self.tempdir, 'index.sqlite'))
+        index.recordUpload('repo', 'commit', 'linux')
+        self.request_handler.API = JsonApi(index)
+
+        response = BaseTestCase.request(self, '/api/repos')
+
+        self.assertEqual(200, response.status)
+        self.assertEqual(
+            'application/json', response.getheader('content-type'))
+        self.assertEqual(
+            [{'name': 'repo'}], json.loads(response.read())['items'])
+
+    def test_get_metrics(self):
+        """
+        The metrics of the uploads are served together with the ones saved
+        by the report generator.
+        """
+        snapshot = Metrics()
+        snapshot.set('coverator_reports_running', 2)
+        os.makedirs(self.tempdir)
+        self.request_handler.METRICS_SNAPSHOT = osp.join(
+            self.tempdir, 'metrics.json')
+        snapshot.save(self.request_handler.METRICS_SNAPSHOT)
+        self.request(
+            files={'file': open(osp.join(self.datadir, 'coverage_0'))})
+
+        response = BaseTestCase.request(self, '/metrics')
+
+        self.assertEqual(200, response.status)
+        self.assertEqual(
+            'text/plain; version=0.0.4; charset=utf-8',
+            response.getheader('content-type'))
+        body = response.read()
+        self.assertIn('coverator_uploads_total{code="200"} 1\n', body)
+        self.assertIn('coverator_upload_seconds_count 1\n', body)
+        self.assertIn('coverator_upload_bytes_count 1\n', body)
+        self.assertIn('coverator_reports_running 2\n', body)
+
+    def test_post_no_symlinks(self):
+        """
+        The symlinks for the branches and PRs are optional.
+        """
+        self.request_handler.SYMLINKS = False
+
+        response = self.request(
+            files={'file': open(osp.join(self.datadir, 'coverage_0'))},
+            data={'branch': 'test-branch', 'pr': '42', 'commit': 'abc'},
+            )
+
+        self.assertEqual(200, response.status)
+        self.assertEqual(
+            ['commit'],
+            os.listdir(osp.join(self.tempdir, 'no-repository')))
+
     def test_post_combine_after_minimum_files(self):
         """
         Will add to the queue to be processed by the consumer process
         after a minimum number of files from different slaves have been
         uploaded.
         """
-        queue = Queue()
+        jobs = []
 
         class MockReportGenerator:
-            def __init__(self):
-                self.queue = queue
+            def queueReport(self, job):
+                jobs.append(job)
 
         self.request_handler.report_generator = MockReportGenerator()
 
@@ -255,7 +654,7 @@ class TestCoveratorHandler(BaseTestCase):
                     'coverage.data.%s' % slave)
             self.assertTrue(os.path.exists(slave_path))
 
-        value = queue.get_nowait()
+        value, = jobs
 
         self.assertEquals((
             self.request_handler.PATH,
@@ -264,6 +663,133 @@ class TestCoveratorHandler(BaseTestCase):
             'test-branch',
             '42'), value[:-1])
 
+    def test_post_all_expected_builders(self):
+        """
+        Will add to the queue as soon as all the builders expected for
+        the repository have uploaded, even if there are less than the
+        minimum number of files.
+        """
+        jobs = []
+
+        class MockReportGenerator:
+            def queueReport(self, job):
+                jobs.append(job)
+
+        self.request_handler.report_generator = MockReportGenerator()
+        self.request_handler.EXPECTED_BUILDERS = {
+            'test/repository': set(['slave1', 'slave2'])}
+
+        for i, slave in enumerate(['slave1', 'slave2']):
+            self.assertEqual([], jobs)
+            response = self.request(
+                files={'file': open(osp.join(
+                    self.datadir, 'coverage_%d' % i))},
+                data={
+                    'build': slave,
+                    'repository': 'test/repository',
+                    'commit': '0f3adff9d8f6a72c919822b8cde073a9e20505e0',
+                    },
+                )
+            self.assertEqual(response.status, 200)
+
+        value, = jobs
+        self.assertEqual(
+            '0f3adff9d8f6a72c919822b8cde073a9e20505e0', value[2])
+
+    def test_post_builder_parts(self):
+        """
+        The data files uploaded as parts of a builder are kept, and count
+        as one builder.
+        """
+        jobs = []
+
+        class MockReportGenerator:
+            def queueReport(self, job):
+                jobs.append(job)
+
+        self.request_handler.report_generator = MockReportGenerator()
+        self.request_handler.EXPECTED_BUILDERS = {
+            'test/repository': set(['slave1', 'slave2'])}
+        commit_path = osp.join(
+            self.request_handler.PATH, 'test/repository', 'commit',
+            '0f3adff9d8f6a72c919822b8cde073a9e20505e0')
+
+        for i, slave in enumerate(['slave1+1', 'slave1+2', 'slave2']):
+            self.assertEqual([], jobs)
+            response = self.request(
+                files={'file': open(osp.join(
+                    self.datadir, 'coverage_%d' % i))},
+                data={
+                    'build': slave,
+                    'repository': 'test/repository',
+                    'commit': '0f3adff9d8f6a72c919822b8cde073a9e20505e0',
+                    },
+                )
+            self.assertEqual(response.status, 200)
+            self.assertTrue(osp.exists(
+                osp.join(commit_path, 'coverage.data.%s' % slave)))
+
+        self.assertEqual(1, len(jobs))
+
+    def test_post_builder_stale_parts(self):
+        """
+        The parts left by an earlier upload of the builder with more
+        parts are removed, together with their data.
+        """
+        commit = '0f3adff9d8f6a72c919822b8cde073a9e20505e0'
+        commit_path = osp.join(
+            self.request_handler.PATH, 'test/repository', 'commit', commit)
+        sources = [
+            osp.join(self.datadir, name)
+            for name in ('coverage_0', 'coverage_1', 'coverage_1_win')]
+
+        def upload(source, build, parts):
+            response = self.request(
+                files={'file': open(source)},
+                data={
+                    'build': build,
+                    'parts': parts,
+                    'repository': 'test/repository',
+                    'commit': commit,
+                    },
+                )
+            self.assertEqual(response.status, 200)
+
+        def check(names, sources):
+            self.assertEqual(names, sorted(
+                name for name in os.listdir(commit_path)
+                if name.startswith('coverage.data.')))
+            expected = CoverageCounter()
+            for source in sources:
+                expected.add(read_data_file(source))
+            state = CoverageCounter.load(
+                osp.join(commit_path, COVERAGE_STATE_FILE))
+            self.assertEqual(expected.lines, state.lines)
+
+        upload(sources[0], 'other', 1)
+        for part, source in enumerate(sources, 1):
+            upload(source, 'slave1+%d' % (part,), 3)
+        check([
+            'coverage.data.other', 'coverage.data.slave1+1',
+            'coverage.data.slave1+2', 'coverage.data.slave1+3',
+            ], [sources[0]] + sources)
+
+        upload(sources[1], 'slave1+1', 2)
+        check([
+            'coverage.data.other', 'coverage.data.slave1+1',
+            'coverage.data.slave1+2',
+            ], [sources[0], sources[1], sources[1]])
+
+        upload(sources[2], 'slave1', 1)
+        check(
+            ['coverage.data.other', 'coverage.data.slave1'],
+            [sources[0], sources[2]])
+
+        response = self.request(
+            files={'file': open(sources[0])},
+            data={'build': 'slave1', 'parts': 'many', 'commit': commit})
+        self.assertEqual(response.status, 400)
+
     def test_translate_path(self):
         """
         Will use the configurable class variable PATH when translating
@@ -280,6 +806,71 @@ class TestCoveratorHandler(BaseTestCase):
         self.assertEqual(u'/a/generic/path/test/', result)
 
 
+class TestPooledHTTPServer(TestCase):
+    """
+    Tests for PooledHTTPServer.
+    """
+
+    class request_handler(NoLogRequestHandler, BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    def setUp(self):
+        self.server = PooledHTTPServer(
+            ('localhost', 0), self.request_handler, workers=2)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def test_slow_request(self):
+        """
+        A slow request does not block the other requests.
+        """
+        slow_client = socket.create_connection(self.server.server_address)
+        self.addCleanup(slow_client.close)
+        slow_client.sendall(b'GET / HTTP/1.1\r\nHost: test\r\n')
+
+        connection = HTTPConnection(*self.server.server_address, timeout=5)
+        connection.request('GET', '/')
+        response = connection.getresponse()
+
+        self.assertEqual(200, response.status)
+        slow_client.sendall(b'Connection: close\r\n\r\n')
+        self.assertTrue(slow_client.recv(1024).startswith(b'HTTP/1.0 200'))
+
+    def test_server_close(self):
+        """
+        The requests accepted before the server is closed are handled
+        before the worker threads are stopped.
+        """
+        slow_client = socket.create_connection(self.server.server_address)
+        self.addCleanup(slow_client.close)
+        slow_client.sendall(b'GET / HTTP/1.1\r\nHost: test\r\n')
+        # The slow request is accepted before this one.
+        connection = HTTPConnection(*self.server.server_address, timeout=5)
+        connection.request('GET', '/')
+        self.assertEqual(200, connection.getresponse().status)
+        self.server.shutdown()
+        self.thread.join()
+        finish = threading.Timer(
+            0.1, slow_client.sendall, [b'Connection: close\r\n\r\n'])
+        finish.start()
+        self.addCleanup(finish.join)
+
+        self.server.server_close()
+
+        self.assertEqual(
+            [False, False],
+            [worker.is_alive() for worker in self.server._workers])
+        self.assertTrue(slow_client.recv(1024).startswith(b'HTTP/1.0 200'))
+
+
 class TestReportGenerator(TestCase):
     """
     Unit tests for the ReportGenerator.
@@ -341,6 +932,7 @@ class TestReportGenerator(TestCase):
         """
         sut = ReportGenerator()
         self.assertEquals(None, sut.github)
+        self.assertEquals(None, sut.codecov)
         self.assertEquals('https://github.com', sut.github_base_url)
         self.assertEquals({}, sut.codecov_tokens)
         self.assertEquals(None, sut.url)
@@ -352,11 +944,19 @@ class TestReportGenerator(TestCase):
         sut = ReportGenerator(
             github_token='some-token',
             url='http://testurl/')
-        self.assertIsInstance(sut.github, Github)
+        self.assertIsInstance(sut.github, StatusOutbox)
         self.assertEquals('https://some-token@github.com', sut.github_base_url)
         self.assertEquals({}, sut.codecov_tokens)
         self.assertEquals('http://testurl/', sut.url)
 
+    def test_init_codecov_tokens(self):
+        """
+        Initializing with codecov tokens.
+        """
+        sut = ReportGenerator(codecov_tokens={'repo': 'some-token'})
+        self.assertIsInstance(sut.codecov, CodecovUploader)
+        self.assertEquals({'repo': 'some-token'}, sut.codecov_tokens)
+
     def test_generateReport(self):
         """
         Will combine the data files for the specified directory and generate
@@ -380,3 +980,337 @@ class TestReportGenerator(TestCase):
 
         commit_path = osp.join(self.tempdir, repo_name, 'commit', commit)
         self.assertTrue(osp.exists(osp.join(commit_path, 'coverage.xml')))
+        self.assertEqual(
+            open(osp.join(commit_path, 'coverage.xml'), 'rb').read(),
+            gzip.open(osp.join(commit_path, 'coverage.xml.gz')).read())
+
+    def test_generateReport_metrics(self):
+        """
+        The report stages are measured, and the metrics are saved with the
+        state of the reports.
+        """
+        repo_name = 'test/repository'
+        commit = self.mkGitRepo(repo_name)
+        sut = ReportGenerator(
+            metrics_path=osp.join(self.tempdir, 'metrics.json'))
+        sut.github_base_url = None
+        sut._scheduleReport(('/base', 'repo', 'commit', None, None, 1))
+
+        sut._generateReportSafe(
+            (self.tempdir, repo_name, commit, None, None, 1))
+        sut._saveMetrics()
+
+        result = Metrics.load(sut.metrics_path).render()
+        self.assertIn(
+            'coverator_report_stage_seconds_count{stage="combine"} 1\n',
+            result)
+        self.assertIn(
+            'coverator_report_stage_seconds_count{stage="xml"} 1\n', result)
+        self.assertIn('coverator_reports_total{result="done"} 1\n', result)
+        self.assertIn('coverator_reports_scheduled 1\n', result)
+        self.assertIn(
+            'coverator_cache_misses_total{cache="changed_lines"} 0\n',
+            result)
+
+    def test_generateReport_trace(self):
+        """
+        When enabled, the trace and the profile of the report are written
+        next to the report.
+        """
+        repo_name = 'test/repository'
+        commit = self.mkGitRepo(repo_name)
+        sut = ReportGenerator(trace=True, profile=True)
+        sut.github_base_url = None
+
+        sut._generateReportSafe(
+            (self.tempdir, repo_name, commit, None, None, 1))
+
+        commit_path = osp.join(self.tempdir, repo_name, 'commit', commit)
+        with open(osp.join(commit_path, 'trace.json')) as stream:
+            result = json.load(stream)
+        self.assertEqual(
+            '%s:%s' % (repo_name, commit), result['otherData']['job'])
+        names = [event['name'] for event in result['traceEvents']]
+        self.assertIn('report', names)
+        self.assertIn('combine', names)
+        self.assertIn('xml', names)
+        self.assertIn(
+            osp.join(self.tempdir, repo_name, 'git-repo', 'test', 'file.py'),
+            names)
+        self.assertTrue(pstats.Stats(osp.join(commit_path, 'profile.pstats')))
+
+    def test_generateReport_worktree(self):
+        """
+        When a git URL is configured, the report is generated from a
+        worktree of the commit.
+        """
+        repo_name = 'test/repository'
+        commit = self.mkGitRepo(repo_name)
+        upstream_path = osp.join(self.tempdir, 'upstream')
+        os.makedirs(osp.join(upstream_path, 'test'))
+        os.symlink(
+            osp.join(self.tempdir, repo_name, 'git-repo'),
+            osp.join(upstream_path, repo_name))
+
+        sut = ReportGenerator()
+        sut.github_base_url = upstream_path
+
+        sut.generateReport(self.tempdir, repo_name, commit, 'master', '42')
+
+        commit_path = osp.join(self.tempdir, repo_name, 'commit', commit)
+        worktree_path = sut.worktrees.worktreePath(
+            osp.join(self.tempdir, repo_name), commit)
+        xml = open(osp.join(commit_path, 'coverage.xml')).read()
+        self.assertIn('<source>%s</source>' % (worktree_path,), xml)
+        self.assertIn('filename="test/file.py"', xml)
+
+    def test_generateReport_analysis_cache(self):
+        """
+        The analysis of the source files is reused by the reports for
+        the next commits.
+        """
+        repo_name = 'test/repository'
+        commit = self.mkGitRepo(repo_name)
+        cache = AnalysisCache(osp.join(self.tempdir, 'analysis.sqlite'))
+        sut = ReportGenerator(analysis_cache=cache)
+        sut.github_base_url = None
+
+        sut.generateReport(self.tempdir, repo_name, commit, 'master', None)
+        sut.generateReport(self.tempdir, repo_name, commit, 'master', None)
+
+        self.assertEqual(1, cache.misses)
+        self.assertEqual(1, cache.hits)
+
+    def test_diffCover(self):
+        """
+        The diff coverage is computed for the changes from master and the
+        HTML report is written next to the XML report.
+        """
+        repo_name = 'test/repository'
+        commit = self.mkGitRepo(repo_name)
+        git_repo_path = osp.join(self.tempdir, repo_name, 'git-repo')
+        commit_path = osp.join(self.tempdir, repo_name, 'commit', commit)
+        combiner = CoverageCombiner()
+        xml_report = XmlReport(git_repo_path, CoverageConfig())
+        sut = ReportGenerator()
+        changed = sut.changed_lines.changedLines(git_repo_path, commit)
+
+        result = sut.diffCover(xml_report, combiner, changed, commit_path)
+
+        # There are no changes from master.
+        self.assertEqual(100, result)
+        self.assertTrue(osp.exists(osp.join(commit_path, 'diff-cover.html')))
+
+    def test_startReports_per_repository(self):
+        """
+        Due reports are started in parallel for different repositories,
+        but only one at a time for the same repository.
+        """
+        started = []
+
+        class FakePool(object):
+            def apply_async(self, function, args, callback):
+                started.append(args[0][:-1])
+
+        sut = ReportGenerator(time_to_wait=10)
+        sut._pool = FakePool()
+        for repo, commit, tstamp in (
+                ('repo-a', 'commit-1', 1),
+                ('repo-a', 'commit-2', 2),
+                ('repo-b', 'commit-3', 3),
+                ('repo-c', 'commit-4', time.time() + 100),
+                ):
+            sut._scheduleReport(('/base', repo, commit, None, None, tstamp))
+
+        wait = sut._startReports()
+
+        self.assertEqual([
+            ('/base', 'repo-a', 'commit-1', None, None),
+            ('/base', 'repo-b', 'commit-3', None, None),
+            ], started)
+        self.assertEqual(set(['repo-a', 'repo-b']), sut._running)
+        self.assertTrue(100 < wait <= 110)
+
+        self.assertEqual(['repo-a'], list(sut._waiting))
+
+        sut.queue.put((JOB_DONE, 'repo-a'))
+        sut._processQueue()
+
+        self.assertEqual(
+            ('/base', 'repo-a', 'commit-2', None, None), started[-1])
+        self.assertEqual(set(['repo-a', 'repo-b']), sut._running)
+        self.assertEqual({}, sut._waiting)
+        self.assertEqual(
+            [('repo-c:commit-4', ('/base', 'repo-c', 'commit-4', None, None,
+                                  tstamp))],
+            sut._to_be_generated.items())
+
+    def test_scheduleReport_debounce(self):
+        """
+        Queuing a commit again delays its report, even when the report was
+        waiting for another report of the same repository.
+        """
+        sut = ReportGenerator(time_to_wait=10)
+        sut._running.add('repo-a')
+        sut._scheduleReport(('/base', 'repo-a', 'commit', None, None, 1))
+        sut._startReports()
+        self.assertEqual(1, len(sut._waiting['repo-a']))
+
+        sut._scheduleReport(('/base', 'repo-a', 'commit', None, None, 50))
+
+        self.assertEqual({}, sut._waiting['repo-a'])
+        self.assertEqual(60, sut._to_be_generated.nextTime())
+
+    def test_scheduleReport_all_builders(self):
+        """
+        The report is scheduled without waiting when all the expected
+        builders have uploaded for the commit.
+        """
+        commit_path = osp.join(self.tempdir, 'repo', 'commit', 'commit')
+        os.makedirs(commit_path)
+        for builder in ('linux', 'windows'):
+            open(osp.join(
+                commit_path, 'coverage.data.%s' % builder), 'w').close()
+        sut = ReportGenerator(
+            time_to_wait=10,
+            expected_builders={'repo': set(['linux', 'windows'])})
+
+        sut._scheduleReport((self.tempdir, 'repo', 'commit', None, None, 5))
+        self.assertEqual(5, sut._to_be_generated.nextTime())
+
+        sut.expected_builders['repo'].add('osx')
+        sut._scheduleReport((self.tempdir, 'repo', 'commit', None, None, 6))
+        self.assertEqual(16, sut._to_be_generated.nextTime())
+
+    def test_scheduleReport_supersede(self):
+        """
+        A new commit for a branch or PR cancels the pending reports for
+        the previous commits. Their jobs queued before the new commit are
+        then ignored.
+        """
+        store = JobStore(osp.join(self.tempdir, 'jobs.sqlite'))
+        sut = ReportGenerator(time_to_wait=10, job_store=store)
+        first = ('/base', 'repo', 'commit-1', 'branch', '42', 1)
+        other = ('/base', 'repo', 'commit-2', 'other-branch', None, 2)
+        second = ('/base', 'repo', 'commit-3', None, '42', 3)
+        for job in (first, other, second):
+            sut.queueReport(job)
+            sut._scheduleReport(job)
+
+        self.assertEqual(
+            sorted(['repo:commit-2', 'repo:commit-3']),
+            sorted(key for key, job in sut._to_be_generated.items()))
+        self.assertEqual([other, second], store.pending())
+
+        sut._scheduleReport(('/base', 'repo', 'commit-1', 'branch', '42', 2))
+
+        self.assertNotIn('repo:commit-1', sut._to_be_generated)
+
+    def test_scheduleReport_head_again(self):
+        """
+        A superseded commit queued again for its PR, for example from a
+        late builder, is the head of the PR again, without cancelling the
+        report of the newer commit.
+        """
+        sut = ReportGenerator(time_to_wait=10)
+        sut._scheduleReport(('/base', 'repo', 'commit-1', None, '42', 1))
+        sut._scheduleReport(('/base', 'repo', 'commit-2', None, '42', 2))
+
+        sut._scheduleReport(('/base', 'repo', 'commit-1', None, '42', 3))
+
+        self.assertEqual(
+            ['repo:commit-1', 'repo:commit-2'],
+            sorted(key for key, job in sut._to_be_generated.items()))
+        self.assertEqual(
+            'repo:commit-1', sut._heads[('repo', 'pr', '42')])
+
+        # A newer commit still supersedes it.
+        sut._scheduleReport(('/base', 'repo', 'commit-3', None, '42', 4))
+        self.assertEqual(
+            ['repo:commit-2', 'repo:commit-3'],
+            sorted(key for key, job in sut._to_be_generated.items()))
+
+    def test_scheduleReport_cancel_running(self):
+        """
+        A report in progress is cancelled when a newer commit is queued
+        for its PR.
+        """
+        repo_name = 'test/repository'
+        commit = self.mkGitRepo(repo_name)
+        sut = ReportGenerator(time_to_wait=0)
+        sut.github_base_url = None
+
+        class FakePool(object):
+            def apply_async(self, function, args, callback):
+                pass
+
+        sut._pool = FakePool()
+        job = (self.tempdir, repo_name, commit, None, '42', 1)
+        sut._scheduleReport(job)
+        sut._startReports()
+
+        sut._scheduleReport(
+            (self.tempdir, repo_name, 'new-commit', None, '42', 2))
+
+        self.assertEqual(repo_name, sut._generateReportSafe(job))
+        commit_path = osp.join(self.tempdir, repo_name, 'commit', commit)
+        self.assertFalse(osp.exists(osp.join(commit_path, 'coverage.xml')))
+        self.assertEqual({}, sut._cancel_events)
+
+    def test_queueReport_resume(self):
+        """
+        Queued reports are saved in the job store and are scheduled again
+        by a new generator, until they are generated.
+        """
+        store = JobStore(osp.join(self.tempdir, 'jobs.sqlite'))
+        job = ('/base', 'repo-a', 'commit-1', 'master', None, 1.0)
+        sut = ReportGenerator(job_store=store)
+        sut.generateReport = lambda *args: None
+
+        sut.queueReport(job)
+
+        self.assertEqual(job, sut.queue.get(timeout=5))
+        resumed = ReportGenerator(job_store=store)
+        resumed._resumeReports()
+        self.assertEqual(
+            [('repo-a:commit-1', job)], resumed._to_be_generated.items())
+
+        self.assertEqual('repo-a', sut._generateReportSafe(job))
+        self.assertEqual([], store.pending())
+
+    def test_generateReportSafe_index(self):
+        """
+        The status of the report is updated in the index.
+        """
+        index = MetadataIndex(osp.join(self.tempdir, 'index.sqlite'))
+        index.recordUpload('repo-a', 'commit-1', 'linux')
+        sut = ReportGenerator(index=index)
+        statuses = []
+        sut.generateReport = lambda *args: statuses.append(
+            index.getCommit('repo-a', 'commit-1')['report_status'])
+        job = ('/base', 'repo-a', 'commit-1', 'master', None, 1.0)
+
+        sut.queueReport(job)
+        sut._generateReportSafe(job)
+
+        self.assertEqual(['running'], statuses)
+        self.assertEqual(
+            REPORT_DONE,
+            index.getCommit('repo-a', 'commit-1')['report_status'])
+
+    def test_generateReportSafe_index_error(self):
+        """
+        The repository is returned even when the status of the report can
+        not be recorded, so that its next reports are generated.
+        """
+        class BrokenIndex(object):
+            def setReportStatus(self, repository, commit, status):
+                raise sqlite3.OperationalError('database is locked')
+
+        sut = ReportGenerator(index=BrokenIndex())
+        reports = []
+        sut.generateReport = lambda *args: reports.append(args)
+        job = ('/base', 'repo-a', 'commit-1', 'master', None, 1.0)
+
+        self.assertEqual('repo-a', sut._generateReportSafe(job))
+        self.assertEqual([], reports)
@@ -0,0 +1,83 @@
+from coverator.tracing import (
+    FILE,
+    STAGE,
+    Trace,
+    activate,
+    current_trace,
+    span,
+    )
+
+from os import path as osp
+from unittest import TestCase
+
+import json
+import shutil
+import tempfile
+
+
+class TestTrace(TestCase):
+    """
+    Tests for Trace and the spans of the active trace.
+    """
+
+    def test_span(self):
+        """
+        The spans are recorded as complete events, in microseconds.
+        """
+        sut = Trace('repo:commit')
+
+        with sut.span('combine', builders=2):
+            pass
+
+        event, = sut.events
+        self.assertEqual('combine', event['name'])
+        self.assertEqual(STAGE, event['cat'])
+        self.assertEqual('X', event['ph'])
+        self.assertEqual({'builders': 2}, event['args'])
+        self.assertGreaterEqual(event['dur'], 0)
+
+    def test_activate(self):
+        """
+        The spans are recorded in the trace active for the thread, even when
+        the code in the span fails.
+        """
+        sut = Trace()
+
+        with activate(sut):
+            self.assertIs(sut, current_trace())
+            with span('xml'):
+                with self.assertRaises(KeyError):
+                    with span('file.py', FILE, step='analyze'):
+                        raise KeyError()
+
+        self.assertIsNone(current_trace())
+        self.assertEqual(
+            [('file.py', FILE), ('xml', STAGE)],
+            [(event['name'], event['cat']) for event in sut.events])
+
+    def test_span_inactive(self):
+        """
+        When no trace is active, the spans do nothing.
+        """
+        with span('xml'):
+            pass
+
+        self.assertIsNone(current_trace())
+
+    def test_write(self):
+        """
+        The trace is written in the Chrome trace event format.
+        """
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        sut = Trace('repo:commit')
+        with sut.span('combine'):
+            pass
+
+        sut.write(osp.join(tempdir, 'trace.json'))
+
+        with open(osp.join(tempdir, 'trace.json')) as stream:
+            result = json.load(stream)
+        self.assertEqual('repo:commit', result['otherData']['job'])
+        self.assertEqual(
+            ['combine'], [event['name'] for event in result['traceEvents']])
@@ -0,0 +1,182 @@
+from coverator.uploader import UPLOAD_FILE, CodecovUploader, write_upload
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from os import path as osp
+from test.test_httpservers import NoLogRequestHandler
+from unittest import TestCase
+
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import threading
+import urlparse
+
+
+class StubCodecovHandler(NoLogRequestHandler, BaseHTTPRequestHandler):
+    """
+    Serves the v4 upload API of codecov.io, with the storage for the
+    uploaded reports on the same server.
+
+    The response codes to send before the normal ones are taken from the
+    `errors` list of the server.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def _respond(self, code, body=b''):
+        self.send_response(code)
+        self.send_header('Content-Length', '%d' % (len(body),))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        self.server.requests.append(('POST', url.path))
+        if self.server.errors:
+            self._respond(self.server.errors.pop(0), b'error')
+            return
+        self.server.queries.append(dict(urlparse.parse_qsl(url.query)))
+        self._respond(200, (
+            'https://codecov.io/result\n'
+            'http://%s:%d/storage/report\n' % self.server.server_address
+            ).encode('utf-8'))
+
+    def do_PUT(self):
+        self.server.requests.append(('PUT', self.path))
+        length = int(self.headers.get('Content-Length'))
+        self.server.uploads.append((
+            self.headers.get('Content-Encoding'), self.rfile.read(length)))
+        self._respond(200)
+
+
+class TestCodecovUploader(TestCase):
+    """
+    Tests for CodecovUploader, using a stub codecov.io API.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.report_path = osp.join(self.tempdir, 'coverage.xml')
+        with open(self.report_path, 'w') as stream:
+            stream.write('<coverage/>')
+
+        self.server = HTTPServer(('localhost', 0), StubCodecovHandler)
+        self.server.requests = []
+        self.server.queries = []
+        self.server.uploads = []
+        self.server.errors = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.sut = CodecovUploader(
+            url='http://%s:%d' % self.server.server_address,
+            retries=1,
+            backoff=0.01,
+            )
+
+    def tearDown(self):
+        self.sut.session.close()
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.tempdir)
+
+    def test_write_upload(self):
+        """
+        The upload has the files from the repository and the report.
+        """
+        output = osp.join(self.tempdir, UPLOAD_FILE)
+
+        write_upload(output, self.report_path, ['setup.py', 'pkg/a.py'])
+
+        self.assertEqual(
+            b'setup.py\npkg/a.py\n<<<<<< network\n# path=coverage.xml\n'
+            b'<coverage/>\n<<<<<< EOF\n',
+            gzip.open(output).read())
+
+    def test_write_upload_replace(self):
+        """
+        A previous upload which is still read is not changed when the
+        upload is written again.
+        """
+        output = osp.join(self.tempdir, UPLOAD_FILE)
+        write_upload(output, self.report_path, ['setup.py'])
+        previous = open(output, 'rb')
+        self.addCleanup(previous.close)
+        content = previous.read(10)
+
+        write_upload(output, self.report_path, ['other.py'])
+
+        content += previous.read()
+        self.assertEqual(
+            b'setup.py\n<<<<<< network\n# path=coverage.xml\n'
+            b'<coverage/>\n<<<<<< EOF\n',
+            gzip.GzipFile(fileobj=io.BytesIO(content)).read())
+        self.assertEqual(
+            b'other.py\n<<<<<< network\n# path=coverage.xml\n'
+            b'<coverage/>\n<<<<<< EOF\n',
+            gzip.open(output).read())
+        self.assertEqual(
+            [UPLOAD_FILE, 'coverage.xml'], sorted(os.listdir(self.tempdir)))
+
+    def test_upload(self):
+        """
+        The report is requested an upload URL and then sent compressed to
+        this URL, from the uploader thread.
+        """
+        self.sut.start()
+        self.sut.upload(
+            'some-token', self.report_path, 'abc', branch='master', pr='12')
+        self.sut.stop()
+
+        self.assertEqual(1, self.sut.uploaded)
+        self.assertEqual(
+            [('POST', '/upload/v4'), ('PUT', '/storage/report')],
+            self.server.requests)
+        self.assertEqual([{
+            'commit': 'abc',
+            'token': 'some-token',
+            'build': 'coverator',
+            'package': 'coverator',
+            'branch': 'master',
+            'pr': '12',
+            }], self.server.queries)
+        encoding, data = self.server.uploads[0]
+        self.assertEqual('gzip', encoding)
+        with open(osp.join(self.tempdir, UPLOAD_FILE), 'rb') as stream:
+            self.assertEqual(stream.read(), data)
+
+    def test_retry(self):
+        """
+        Failed uploads are retried later, until they run out of retries.
+        """
+        self.server.errors = [503, 503, 503]
+        other_path = osp.join(self.tempdir, 'other', 'coverage.xml')
+        os.makedirs(osp.dirname(other_path))
+        shutil.copy(self.report_path, other_path)
+        self.sut.start()
+        self.sut.upload('some-token', self.report_path, 'abc')
+        self.sut.upload('some-token', other_path, 'def')
+        # Wait for the retries.
+        for _ in range(200):
+            if self.sut.uploaded + self.sut.failed == 2:
+                break
+            self.sut.join(0.01)
+        self.sut.stop()
+
+        self.assertEqual((1, 1, 2), (
+            self.sut.uploaded, self.sut.failed, self.sut.retried))
+
+    def test_rejected(self):
+        """
+        Uploads rejected by codecov.io are not retried.
+        """
+        self.server.errors = [400]
+        self.sut.start()
+        self.sut.upload('bad-token', self.report_path, 'abc')
+        self.sut.stop()
+
+        self.assertEqual((0, 1, 0), (
+            self.sut.uploaded, self.sut.failed, self.sut.retried))
+        self.assertEqual([('POST', '/upload/v4')], self.server.requests)
@@ -0,0 +1,143 @@
+from coverage.config import CoverageConfig
+from coverator.analysis import AnalysisCache
+from coverator.combine import CoverageCombiner
+from coverator.xmlreport import rate, write_xml_report
+
+from os import path as osp
+from unittest import TestCase
+from xml.etree import ElementTree
+
+import git
+import os
+import shutil
+import tempfile
+
+
+SOURCE = """\
+def check(value):
+    if value:
+        return 1
+    return (
+        2)
+"""
+
+
+class TestWriteXmlReport(TestCase):
+    """
+    Tests for write_xml_report.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.makedirs(osp.join(self.tempdir, 'pkg'))
+        self.path = osp.join(self.tempdir, 'pkg', 'source.py')
+        with open(self.path, 'w') as stream:
+            stream.write(SOURCE)
+        self.output = osp.join(self.tempdir, 'coverage.xml')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_rate(self):
+        """
+        Rates are formatted with 4 significant digits, and there is full
+        coverage when there is nothing to cover.
+        """
+        self.assertEqual('0.6667', rate(2, 3))
+        self.assertEqual('1', rate(0, 0))
+
+    def test_lines(self):
+        """
+        The report has a class for each source file, grouped in packages
+        by directory, with paths relative to the checkout.
+        """
+        combiner = CoverageCombiner()
+        combiner.update({'lines': {self.path: [1, 2, 3]}})
+
+        result = write_xml_report(
+            combiner, self.output, self.tempdir, CoverageConfig())
+
+        self.assertEqual(75.0, result)
+        root = ElementTree.parse(self.output).getroot()
+        self.assertEqual('3', root.get('lines-covered'))
+        self.assertEqual('4', root.get('lines-valid'))
+        self.assertEqual('0.75', root.get('line-rate'))
+        self.assertEqual(
+            [self.tempdir], [node.text for node in root.iter('source')])
+        package, = root.iter('package')
+        self.assertEqual('pkg', package.get('name'))
+        source, = package.iter('class')
+        self.assertEqual('pkg/source.py', source.get('filename'))
+        self.assertEqual('source.py', source.get('name'))
+        self.assertEqual(
+            [('1', '1'), ('2', '1'), ('3', '1'), ('4', '0')],
+            [(line.get('number'), line.get('hits'))
+             for line in source.iter('line')])
+
+    def test_arcs(self):
+        """
+        With arc data, the branch coverage is reported.
+        """
+        combiner = CoverageCombiner()
+        combiner.update({'arcs': {
+            self.path: [[-1, 1], [1, -1], [2, 4], [4, -1]]}})
+
+        write_xml_report(
+            combiner, self.output, self.tempdir, CoverageConfig())
+
+        root = ElementTree.parse(self.output).getroot()
+        self.assertEqual('1', root.get('branches-covered'))
+        self.assertEqual('2', root.get('branches-valid'))
+        line = [
+            line for line in root.iter('line') if line.get('number') == '2'
+            ][0]
+        self.assertEqual('50% (1/2)', line.get('condition-coverage'))
+        self.assertEqual('3', line.get('missing-branches'))
+
+    def test_skip_missing(self):
+        """
+        Files which are not in the checkout and omitted files are not
+        reported.
+        """
+        config = CoverageConfig()
+        config.report_omit = ['other/*']
+        os.makedirs(osp.join(self.tempdir, 'other'))
+        omitted = osp.join(self.tempdir, 'other', 'omitted.py')
+        shutil.copy(self.path, omitted)
+        combiner = CoverageCombiner()
+        combiner.update({'lines': {
+            self.path: [1],
+            '/builder/pkg/source.py': [1],
+            omitted: [1],
+            }})
+
+        write_xml_report(combiner, self.output, self.tempdir, config)
+
+        root = ElementTree.parse(self.output).getroot()
+        self.assertEqual(
+            ['pkg/source.py'],
+            [node.get('filename') for node in root.iter('class')])
+
+    def test_cache(self):
+        """
+        The analysis of the files from a git checkout is cached by blob
+        SHA and reused for the next report.
+        """
+        repo = git.Repo.init(self.tempdir)
+        repo.index.add([self.path])
+        repo.index.commit('initial')
+        cache = AnalysisCache(osp.join(self.tempdir, 'cache.sqlite'))
+        combiner = CoverageCombiner()
+        combiner.update({'lines': {self.path: [1, 2, 3]}})
+        write_xml_report(
+            combiner, self.output, self.tempdir, CoverageConfig(), cache)
+        first = open(self.output).read()
+        self.assertEqual((0, 1), (cache.hits, cache.misses))
+        self.assertEqual(1, len(cache))
+
+        write_xml_report(
+            combiner, self.output, self.tempdir, CoverageConfig(), cache)
+
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        self.assertEqual(
+            first.split('\n')[2:], open(self.output).read().split('\n')[2:])
@@ -0,0 +1,117 @@
+"""
+Traces of the report jobs, in the Chrome trace event format.
+
+A trace is activated for the thread generating a report, and the spans
+are recorded by the code called for the report without passing the trace
+around. When no trace is active, a span does nothing.
+
+The traces can be opened with chrome://tracing or https://ui.perfetto.dev.
+"""
+from __future__ import unicode_literals
+
+from contextlib import contextmanager
+
+import json
+import os
+import threading
+import time
+
+
+# Categories of the spans.
+STAGE = 'stage'
+SUBPROCESS = 'subprocess'
+FILE = 'file'
+
+_local = threading.local()
+
+
+class Trace(object):
+    """
+    The spans recorded for a job.
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self.events = []
+        self._pid = os.getpid()
+
+    @contextmanager
+    def span(self, name, category=STAGE, **args):
+        """
+        Record the time spent in the context as a complete event.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            self.events.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': int(start * 1000000),
+                'dur': int((end - start) * 1000000),
+                'pid': self._pid,
+                'tid': threading.current_thread().ident,
+                'args': args,
+                })
+
+    def write(self, path):
+        """
+        Write the trace as JSON to `path`.
+        """
+        data = {
+            'traceEvents': self.events,
+            'displayTimeUnit': 'ms',
+            'otherData': {'job': self.name},
+            }
+        temporary_path = '%s.tmp' % (path,)
+        with open(temporary_path, 'wb') as stream:
+            stream.write(json.dumps(data).encode('utf-8'))
+        os.rename(temporary_path, path)
+
+
+class _NoSpan(object):
+    """
+    The span used when no trace is active.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def current_trace():
+    """
+    Return the trace active for the current thread, or None.
+    """
+    return getattr(_local, 'trace', None)
+
+
+@contextmanager
+def activate(trace):
+    """
+    Record the spans from the current thread in `trace`, during the
+    context.
+    """
+    previous = current_trace()
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+def span(name, category=STAGE, **args):
+    """
+    Return the context recording the span `name` in the active trace.
+    """
+    trace = current_trace()
+    if trace is None:
+        return _NO_SPAN
+    return trace.span(name, category, **args)
@@ -0,0 +1,245 @@
+"""
+Upload of the XML reports to codecov.io.
+
+This replaces calling the `codecov` command line tool for each report,
+which had to discover the environment and read the report again, and
+opened a new connection for each upload.
+
+The upload follows the v4 flow from the codecov tool. The report is
+compressed next to the XML report when it is queued, and it is sent from a
+background thread over a pool of persistent HTTP connections. Failed
+uploads are retried later, instead of being lost.
+"""
+from __future__ import unicode_literals
+
+from coverator.metrics import Metrics
+from coverator.scheduler import DebounceScheduler
+from coverator.tracing import SUBPROCESS, span
+from git import Git
+from Queue import Empty, Queue as ThreadQueue
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+
+import gzip
+import io
+import os
+import requests
+import shutil
+import tempfile
+import threading
+import time
+
+
+CODECOV_URL = 'https://codecov.io'
+
+# The file with the compressed upload, next to the XML report.
+UPLOAD_FILE = 'codecov.gz'
+
+
+def write_upload(output, report_path, files=()):
+    """
+    Write to `output` the compressed upload for the XML report from
+    `report_path`, as sent by the codecov tool.
+
+    `files` are the paths from the repository, used by codecov to fix the
+    paths from the report.
+
+    The upload is written to a temporary file which then replaces
+    `output`, so that a previous upload which is still sent or waiting
+    to be retried is never truncated.
+    """
+    temporary = tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(output) or '.', prefix='.upload-', delete=False)
+    try:
+        with open(report_path, 'rb') as report:
+            stream = gzip.GzipFile(
+                os.path.basename(output), 'wb', fileobj=temporary)
+            try:
+                for name in files:
+                    stream.write(('%s\n' % (name,)).encode('utf-8'))
+                stream.write(
+                    b'<<<<<< network\n# path=' +
+                    os.path.basename(report_path).encode('utf-8') + b'\n')
+                shutil.copyfileobj(report, stream)
+                stream.write(b'\n<<<<<< EOF\n')
+            finally:
+                stream.close()
+        temporary.close()
+        os.rename(temporary.name, output)
+    except Exception:
+        temporary.close()
+        os.remove(temporary.name)
+        raise
+
+
+class UploadError(Exception):
+    """
+    The upload was rejected by codecov.io.
+    """
+
+
+class CodecovUploader(threading.Thread):
+    """
+    Uploads the reports to the codecov.io API from `url`.
+
+    A failed upload is retried up to `retries` times, waiting `backoff`
+    seconds and then twice as long for each new attempt. Uploads rejected
+    by codecov.io, for example for a wrong token, are not retried.
+    """
+
+    def __init__(
+            self, url=CODECOV_URL, retries=5, backoff=30, timeout=60,
+            log=None, metrics=None):
+        super(CodecovUploader, self).__init__(name='codecov-uploader')
+        self.daemon = True
+        self.url = url.rstrip('/')
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.uploaded = 0
+        self.failed = 0
+        self.retried = 0
+        self._log = log or (lambda format, *args: None)
+        self._metrics = metrics or Metrics()
+        self._queue = ThreadQueue()
+        # The failed uploads waiting to be retried, by upload file.
+        self._retries = DebounceScheduler()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=4)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['User-Agent'] = 'coverator'
+
+    def upload(self, token, report_path, commit, branch=None, pr=None,
+               git_repo_path=None):
+        """
+        Queue the XML report from `report_path` to be uploaded for
+        `commit`.
+
+        The compressed upload is created right away, with the files from
+        the checkout at `git_repo_path`, as the checkout might be reused
+        for another commit before the upload is sent.
+        """
+        files = ()
+        if git_repo_path is not None:
+            with span('git ls-files', SUBPROCESS):
+                files = Git(git_repo_path).ls_files().splitlines()
+        upload_path = os.path.join(os.path.dirname(report_path), UPLOAD_FILE)
+        write_upload(upload_path, report_path, files)
+
+        query = {
+            'commit': commit,
+            'token': token,
+            'build': 'coverator',
+            'package': 'coverator',
+            }
+        if branch:
+            query['branch'] = branch
+        if pr:
+            query['pr'] = pr
+        self._queue.put((upload_path, query, 1))
+
+    def stop(self):
+        """
+        Send the queued uploads and stop the thread.
+
+        The uploads waiting to be retried are not sent.
+        """
+        self._queue.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            now = time.time()
+            for _, upload in self._retries.popDue(now):
+                self._queue.put(upload)
+
+            timeout = None
+            next_time = self._retries.nextTime()
+            if next_time is not None:
+                timeout = max(next_time - now, 0)
+            try:
+                upload = self._queue.get(timeout=timeout)
+            except Empty:
+                continue
+            if upload is None:
+                break
+            self._process(*upload)
+
+        for _, (_, query, _) in self._retries.items():
+            self._log(
+                'Upload to codecov.io not retried for %s', query['commit'])
+        self.session.close()
+
+    def _process(self, upload_path, query, attempt):
+        """
+        Send the upload and schedule it again if it failed.
+        """
+        try:
+            with self._metrics.time('coverator_codecov_upload_seconds'):
+                self.send(upload_path, query)
+        except UploadError as error:
+            self.failed += 1
+            self._log(
+                'Upload to codecov.io rejected for %s: %s',
+                query['commit'], error)
+        except (RequestException, EnvironmentError) as error:
+            if attempt > self.retries:
+                self.failed += 1
+                self._log(
+                    'Giving up on upload to codecov.io for %s after %d '
+                    'attempts: %s', query['commit'], attempt, error)
+                return
+            wait = self.backoff * 2 ** (attempt - 1)
+            self.retried += 1
+            self._log(
+                'Upload to codecov.io failed for %s, retrying in %.1f '
+                'seconds: %s', query['commit'], wait, error)
+            self._retries.schedule(
+                upload_path, time.time() + wait,
+                (upload_path, query, attempt + 1))
+        except Exception as error:
+            self.failed += 1
+            self._log(
+                'Failed to upload to codecov.io for %s: %s',
+                query['commit'], error)
+
+    def send(self, upload_path, query):
+        """
+        Upload the compressed report from `upload_path` right away.
+        """
+        response = self.session.post(
+            '%s/upload/v4' % (self.url,),
+            params=query,
+            headers={
+                'Accept': 'text/plain',
+                'X-Reduced-Redundancy': 'false',
+                'X-Content-Type': 'application/x-gzip',
+                },
+            timeout=self.timeout,
+            )
+        if 400 <= response.status_code < 500 and response.status_code != 429:
+            raise UploadError(
+                'HTTP %d: %s' % (response.status_code, response.text.strip()))
+        response.raise_for_status()
+        urls = response.text.strip().split()
+        if len(urls) < 2:
+            raise UploadError('Unexpected response: %s' % (response.text,))
+        result_url, upload_url = urls[:2]
+
+        with io.open(upload_path, 'rb') as stream:
+            response = self.session.put(
+                upload_url,
+                data=stream,
+                headers={
+                    'Content-Type': 'application/x-gzip',
+                    'Content-Encoding': 'gzip',
+                    'Content-Length': '%d' % (os.path.getsize(upload_path),),
+                    'x-amz-acl': 'public-read',
+                    },
+                timeout=self.timeout,
+                )
+        response.raise_for_status()
+        self.uploaded += 1
+        self._log('Uploaded to codecov.io: %s', result_url)
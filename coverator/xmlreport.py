@@ -0,0 +1,318 @@
+"""
+Native Cobertura XML report for the combined coverage data.
+
+This replaces calling `coverage xml` in a subprocess, which had to read the
+combined data file again and import coverage.py for each report. The report
+has the same content as the one from coverage.py, so diff-cover and codecov
+read it in the same way.
+
+The source files are analyzed one at a time and only the XML for the
+current package is kept in memory.
+"""
+from __future__ import unicode_literals
+
+from coverage import __version__ as COVERAGE_VERSION
+from coverage.misc import join_regex
+from coverator.analysis import SourceAnalyzer
+from coverator.tracing import FILE, span
+from xml.sax.saxutils import escape
+
+import fnmatch
+import itertools
+import os
+import re
+import shutil
+import tempfile
+import time
+
+
+DTD_URL = (
+    'https://raw.githubusercontent.com/cobertura/web/master/'
+    'htdocs/xml/coverage-04.dtd')
+
+
+def rate(hit, total):
+    """
+    Return the fraction of `hit` / `total`, formatted as coverage.py does.
+    """
+    if total == 0:
+        return '1'
+    return '%.4g' % (float(hit) / total)
+
+
+def element(name, attributes, close=False):
+    """
+    Return the start tag for the element `name`, with the attributes
+    sorted by name.
+    """
+    result = ['<', name]
+    for key in sorted(attributes):
+        result.append(' %s="%s"' % (
+            key, escape('%s' % (attributes[key],), {'"': '&quot;'})))
+    result.append('/>' if close else '>')
+    return ''.join(result)
+
+
+def _matcher(patterns, root):
+    """
+    Return a function matching a path on the `[report]` include or omit
+    `patterns`. Patterns not starting with a wildcard are relative to
+    `root`, as coverage.py does for the current directory.
+    """
+    if not patterns:
+        return None
+    translated = []
+    for pattern in patterns:
+        if not pattern.startswith(('*', '?')):
+            pattern = os.path.join(root, pattern)
+        translated.append(
+            re.sub(r'\\?/', r'[\\\\/]', fnmatch.translate(pattern)))
+    return re.compile(join_regex(translated)).match
+
+
+class XmlReport(object):
+    """
+    Writes the Cobertura XML report for the files from a CoverageCombiner,
+    checked out at `root`.
+
+    `config` is the coverage.py configuration of the checkout.
+
+    When `cache` is an AnalysisCache, the source files are only analyzed
+    when their git blob is not already in the cache.
+    """
+
+    def __init__(self, root, config, cache=None):
+        self.root = root.rstrip('/')
+        self.config = config
+        self.analyzer = SourceAnalyzer(self.root, config, cache)
+        self._include = _matcher(config.report_include, self.root)
+        self._omit = _matcher(config.report_omit, self.root)
+        # The lines reported for the files kept by write, by filename.
+        self._kept_lines = {}
+        self.source_paths = set()
+        for source in config.source or ():
+            source = os.path.join(self.root, source).rstrip('/')
+            if os.path.exists(source):
+                self.source_paths.add(source)
+
+    def _relativeName(self, filename):
+        """
+        Return the name of `filename` from the report, relative to a
+        source path or to the root.
+        """
+        for source_path in self.source_paths:
+            if filename.startswith(source_path + '/'):
+                return filename[len(source_path) + 1:]
+        if filename.startswith(self.root + '/'):
+            return filename[len(self.root) + 1:]
+        return filename
+
+    def _packageName(self, rel_name):
+        dirname = os.path.dirname(rel_name) or '.'
+        return '.'.join(
+            dirname.split('/')[:self.config.xml_package_depth])
+
+    def _isReported(self, filename):
+        if self._include is not None and not self._include(filename):
+            return False
+        if self._omit is not None and self._omit(filename):
+            return False
+        return True
+
+    def fileLines(self, combiner, filename):
+        """
+        Return the (line, hits, branch) tuples reported for `filename`, or
+        None if the file is not in the report.
+
+        The lines of the files kept by write are not analyzed again.
+        """
+        if filename in self._kept_lines:
+            return self._kept_lines[filename]
+        if filename not in combiner.lines and filename not in combiner.arcs:
+            return None
+        if not self._isReported(filename):
+            return None
+        has_arcs = combiner.hasArcs()
+        analysis = self.analyzer.analyze([filename], has_arcs).get(filename)
+        if analysis is None:
+            return None
+        return self._lines(combiner, filename, analysis, has_arcs)
+
+    def _lines(self, combiner, filename, analysis, has_arcs):
+        executed_arcs = None
+        if has_arcs:
+            executed_arcs = combiner.arcs.get(filename, ())
+        return analysis.lines(
+            combiner.executedLines(filename), executed_arcs)
+
+    def _classXml(self, rel_name, lines, has_arcs):
+        """
+        Return the XML for the `class` element of a source file with the
+        reported `lines`, with the (hits, lines, branches hit, branches)
+        totals.
+        """
+        xml_lines = []
+        hits = branches = branches_hit = 0
+        for line, hit, branch in lines:
+            hits += hit
+            attributes = {'number': line, 'hits': hit}
+            if branch is not None:
+                total, taken, missing = branch
+                branches += total
+                branches_hit += taken
+                attributes['branch'] = 'true'
+                attributes['condition-coverage'] = '%d%% (%d/%d)' % (
+                    100 * taken // total, taken, total)
+                if missing:
+                    attributes['missing-branches'] = ','.join(
+                        'exit' if end < 0 else '%d' % (end,)
+                        for end in missing)
+            xml_lines.append(
+                '\t\t\t\t\t\t%s\n' % (element('line', attributes, True),))
+
+        dirname = os.path.dirname(rel_name) or '.'
+        attributes = {
+            'branch-rate': rate(branches_hit, branches) if has_arcs else '0',
+            'complexity': '0',
+            'filename': rel_name,
+            'line-rate': rate(hits, len(lines)),
+            'name': os.path.relpath(rel_name, dirname),
+            }
+        result = [
+            '\t\t\t\t%s\n' % (element('class', attributes),),
+            '\t\t\t\t\t<methods/>\n',
+            ]
+        if xml_lines:
+            result.append('\t\t\t\t\t<lines>\n')
+            result.extend(xml_lines)
+            result.append('\t\t\t\t\t</lines>\n')
+        else:
+            result.append('\t\t\t\t\t<lines/>\n')
+        result.append('\t\t\t\t</class>\n')
+        return ''.join(result), (hits, len(lines), branches_hit, branches)
+
+    def write(self, combiner, output, keep=()):
+        """
+        Write the report for the data from `combiner` to the `output` path
+        and return the percentage of covered lines and branches.
+
+        Files which are not found in the checkout or which are not Python
+        are not reported.
+
+        The lines reported for the `keep` files are kept, to be returned by
+        fileLines, as only the XML for the current package is kept in memory.
+        """
+        has_arcs = combiner.hasArcs()
+        self._kept_lines = dict.fromkeys(keep)
+        files = []
+        for filename in combiner.measuredFiles():
+            if not self._isReported(filename):
+                continue
+            rel_name = self._relativeName(filename)
+            files.append((self._packageName(rel_name), rel_name, filename))
+            if rel_name != filename:
+                self.source_paths.add(filename[:-len(rel_name) - 1])
+        files.sort()
+
+        totals = [0, 0, 0, 0]
+        directory = os.path.dirname(os.path.abspath(output))
+        # The totals are only known at the end, so the packages are written
+        # to a temporary file and copied after the header.
+        with tempfile.TemporaryFile(dir=directory) as body:
+            packages = itertools.groupby(files, key=lambda entry: entry[0])
+            for package_name, package_files in packages:
+                package_files = list(package_files)
+                analyses = self.analyzer.analyze(
+                    [filename for _, _, filename in package_files], has_arcs)
+                package_xml = []
+                package_totals = [0, 0, 0, 0]
+                for _, rel_name, filename in package_files:
+                    if filename not in analyses:
+                        continue
+                    with span(filename, FILE, step='xml'):
+                        lines = self._lines(
+                            combiner, filename, analyses[filename], has_arcs)
+                        class_xml, class_totals = self._classXml(
+                            rel_name, lines, has_arcs)
+                    if filename in self._kept_lines:
+                        self._kept_lines[filename] = lines
+                    package_xml.append(class_xml)
+                    for position, value in enumerate(class_totals):
+                        package_totals[position] += value
+
+                if not package_xml:
+                    continue
+                hits, lines, branches_hit, branches = package_totals
+                attributes = {
+                    'branch-rate': (
+                        rate(branches_hit, branches) if has_arcs else '0'),
+                    'complexity': '0',
+                    'line-rate': rate(hits, lines),
+                    'name': package_name,
+                    }
+                body.write(('\t\t%s\n\t\t\t<classes>\n' % (
+                    element('package', attributes),)).encode('utf-8'))
+                for class_xml in package_xml:
+                    body.write(class_xml.encode('utf-8'))
+                body.write('\t\t\t</classes>\n\t\t</package>\n'.encode(
+                    'utf-8'))
+                for position, value in enumerate(package_totals):
+                    totals[position] += value
+
+            body.seek(0)
+            self._writeDocument(output, body, totals, has_arcs)
+
+        hits, lines, branches_hit, branches = totals
+        if lines + branches == 0:
+            return 0.0
+        return 100.0 * (hits + branches_hit) / (lines + branches)
+
+    def _writeDocument(self, output, body, totals, has_arcs):
+        """
+        Write the XML document to `output`, with the packages read from the
+        `body` file.
+        """
+        hits, lines, branches_hit, branches = totals
+        attributes = {
+            'branch-rate': '0',
+            'branches-covered': 0,
+            'branches-valid': 0,
+            'complexity': '0',
+            'line-rate': rate(hits, lines),
+            'lines-covered': hits,
+            'lines-valid': lines,
+            'timestamp': int(time.time() * 1000),
+            'version': COVERAGE_VERSION,
+            }
+        if has_arcs:
+            attributes.update({
+                'branch-rate': rate(branches_hit, branches),
+                'branches-covered': branches_hit,
+                'branches-valid': branches,
+                })
+
+        header = [
+            '<?xml version="1.0" ?>\n',
+            '%s\n' % (element('coverage', attributes),),
+            '\t<!-- Generated by coverator -->\n',
+            '\t<!-- Based on %s -->\n' % (DTD_URL,),
+            '\t<sources>\n',
+            ]
+        for source_path in sorted(self.source_paths):
+            header.append('\t\t<source>%s</source>\n' % (escape(source_path),))
+        header.append('\t</sources>\n\t<packages>\n')
+
+        temporary_path = output + '.tmp'
+        with open(temporary_path, 'wb') as stream:
+            stream.write(''.join(header).encode('utf-8'))
+            shutil.copyfileobj(body, stream)
+            stream.write('\t</packages>\n</coverage>\n'.encode('utf-8'))
+        os.rename(temporary_path, output)
+
+
+def write_xml_report(combiner, output, root, config, cache=None):
+    """
+    Write the Cobertura XML report for the data from `combiner` to the
+    `output` path, for the source files checked out at `root`.
+    """
+    return XmlReport(root, config, cache).write(combiner, output)
@@ -40,14 +40,12 @@ distribution = setup(
         ),
     long_description="",
     url='http://www.chevah.com',
-    packages=find_packages('.'),
+    packages=find_packages('.', exclude=['benchmarks', 'benchmarks.*']),
     install_requires=[
         'coverage==4.5',
         'requests==2.17.3',
-        'codecov==2.0.3',
         'diff-cover==0.9.11',
         'GitPython==1.0.1',
-        'pygithub==1.34',
         ],
     extras_require = {
         'dev': [